@@ -0,0 +1,135 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+
+class WorkQueue:
+    """
+    Requests of one endpoint class waiting for the event loop.
+    """
+    __slots__ = ('name', 'max_queued', 'queue_timeout', 'items', 'served', 'rejected', 'expired')
+
+    def __init__(self, name: str, max_queued: int, queue_timeout: float) -> None:
+        self.name = name
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.items = deque()
+        self.served = 0
+        self.rejected = 0
+        self.expired = 0
+
+    @property
+    def retry_after(self) -> int:
+        return max(math.ceil(self.queue_timeout), 1)
+
+
+class AdmissionController:
+    """
+    Bounded queues of received requests, shared by all connections of the server.
+    Requests are not served inside data_received: cheap and expensive endpoints
+    wait in separate queues, served in turns in batches between reads of the sockets.
+    A request to a full queue, or one that waited longer than the queue timeout,
+    is answered with 503 and Retry-After at once instead of being served late.
+    """
+
+    def __init__(
+            self,
+            max_queued: int = 1000,
+            max_queued_expensive: int = 100,
+            queue_timeout: float = 1.0,
+            queue_timeout_expensive: float = 2.0,
+            batch_size: int = 64
+    ) -> None:
+        """
+        :param max_queued: requests to cheap endpoints waiting at once;
+        :param max_queued_expensive: requests to expensive endpoints waiting at once;
+        :param queue_timeout: seconds a request to a cheap endpoint can wait;
+        :param queue_timeout_expensive: seconds a request to an expensive endpoint can wait;
+        :param batch_size: requests served before the loop reads the sockets again.
+        """
+        self.cheap = WorkQueue('cheap', max_queued, queue_timeout)
+        self.expensive = WorkQueue('expensive', max_queued_expensive, queue_timeout_expensive)
+        self.batch_size = batch_size
+        self._scheduled = False
+
+    def submit(
+            self,
+            expensive: bool,
+            serve: Callable[[], None],
+            reject: Callable[[int], None],
+            fail: Optional[Callable[[], None]] = None
+    ) -> int:
+        """
+        Queue the request, returns 0 or seconds to retry after if the queue is full.
+        :param expensive: request to an expensive endpoint;
+        :param serve: serves the request;
+        :param reject: answers the request expired in the queue with 503,
+            called with seconds to retry after;
+        :param fail: answers or closes the request whose serve raised an exception.
+        """
+        queue = self.expensive if expensive else self.cheap
+        if len(queue.items) >= queue.max_queued:
+            queue.rejected += 1
+            logger.debug('%s queue is full, request rejected.', queue.name)
+            return queue.retry_after
+        queue.items.append((time.monotonic(), serve, reject, fail))
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._serve_batch)
+        return 0
+
+    def _next(self, queue: WorkQueue, now: float) -> Optional[tuple]:
+        while queue.items:
+            queued_at, serve, reject, fail = queue.items.popleft()
+            if now - queued_at <= queue.queue_timeout:
+                queue.served += 1
+                return serve, fail
+            queue.expired += 1
+            reject(queue.retry_after)
+        return None
+
+    @staticmethod
+    def _serve(
+            queue: WorkQueue,
+            serve: Callable[[], None],
+            fail: Optional[Callable[[], None]]
+    ) -> None:
+        try:
+            serve()
+        except Exception:
+            logger.exception('Request from the %s queue failed.', queue.name)
+            if fail:
+                try:
+                    fail()
+                except Exception:
+                    logger.exception('Failed request from the %s queue not answered.', queue.name)
+
+    def _serve_batch(self) -> None:
+        self._scheduled = False
+        served = 0
+        while served < self.batch_size and (self.cheap.items or self.expensive.items):
+            for queue in (self.cheap, self.expensive):
+                if request := self._next(queue, time.monotonic()):
+                    self._serve(queue, *request)
+                    served += 1
+        if self.cheap.items or self.expensive.items:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._serve_batch)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            queue.name: {
+                'queued': len(queue.items),
+                'served': queue.served,
+                'rejected': queue.rejected,
+                'expired': queue.expired
+            }
+            for queue in (self.cheap, self.expensive)
+        }
@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import json
+import time
+from typing import Iterator, Optional
+
+import h11
+
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+REDACTED = '<redacted>'
+REDACTED_HEADERS = (b'authorization', b'cookie')
+
+
+class TrafficRecorder:
+    """
+    Append-only capture of served requests, one JSON line per request:
+    start offset "t" in seconds, method "m", target "p", headers "h",
+    base64 body "b", authorized user "u", response status "s" and latency "d" in ms.
+    Tokens are never written, replay maps the user back to a token.
+    Lines are buffered in memory and written by the flush job.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_buffered: int = 1000) -> None:
+        """
+        :param path: capture file, appended to if it exists;
+        :param flush_interval: seconds between writes of buffered lines;
+        :param max_buffered: buffered lines written at once without waiting for the job.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.recorded = 0
+        self._started = time.monotonic()
+        self._buffer = []
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(
+            self,
+            request: h11.Request,
+            body: bytes,
+            user_name: Optional[str],
+            status: Optional[int],
+            started: float,
+            duration: float
+    ) -> None:
+        """
+        :param started: time.monotonic() at the request start;
+        :param duration: seconds the request took.
+        """
+        entry = {
+            't': round(started - self._started, 6),
+            'm': request.method.decode('ascii'),
+            'p': request.target.decode('ascii', 'replace'),
+            'h': [
+                [name.decode('latin-1'), self._header_value(name, value)]
+                for name, value in request.headers
+            ],
+            's': status,
+            'd': round(duration * 1000, 3)
+        }
+        if body:
+            entry['b'] = base64.b64encode(body).decode('ascii')
+        if user_name is not None:
+            entry['u'] = user_name
+        self._buffer.append(json.dumps(entry, separators=(',', ':')))
+        self.recorded += 1
+        if len(self._buffer) >= self.max_buffered:
+            self.flush()
+
+    @staticmethod
+    def _header_value(name: bytes, value: bytes) -> str:
+        return REDACTED if name in REDACTED_HEADERS else value.decode('latin-1')
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        self._file.write('\n'.join(self._buffer) + '\n')
+        self._file.flush()
+        self._buffer.clear()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+        logger.info('Captured %s requests to %s.', self.recorded, self.path)
+
+
+def read_capture(path: str) -> Iterator[dict]:
+    """
+    Captured requests in the recorded order, bodies decoded to bytes.
+    """
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                entry['b'] = base64.b64decode(entry['b']) if 'b' in entry else b''
+                yield entry
@@ -1,51 +1,132 @@
 from __future__ import annotations
 
-import json
+import functools
+import itertools
 import os.path
+import random
 import socket
+import time
+import uuid
 from http import HTTPStatus
-from typing import Optional
+from typing import Callable, Optional
 
 import h11
 
 from enums import ChatType
+from serialization import JSONCodec, get_codec
 from utils import get_logger_for_module
 
 
 logger = get_logger_for_module(__name__)
 
 
+def _reconnecting(method: Callable) -> Callable:
+    """
+    Repeat the request on a new connection, when the connection to the server is lost.
+    A repeated write keeps its idempotency key, so the server does not apply it twice.
+    """
+    @functools.wraps(method)
+    def wrapper(self: Client, *args, **kwargs):
+        if self._in_request:
+            return method(self, *args, **kwargs)
+        self._in_request = True
+        self._idempotency_key = uuid.uuid4().hex
+        try:
+            for attempt in itertools.count():
+                try:
+                    if self.sock is None:
+                        self._open_connection()
+                        self._resume()
+                    return method(self, *args, **kwargs)
+                except (OSError, h11.ProtocolError) as error:
+                    self._drop_connection()
+                    if attempt >= self.reconnect_attempts:
+                        raise
+                    delay = self._reconnect_delay(attempt)
+                    logger.warning(
+                        f'Connection to {self.server_host}:{self.server_port} lost ({error}), '
+                        f'reconnect in {delay:.2f} s.'
+                    )
+                    time.sleep(delay)
+        finally:
+            self._in_request = False
+    return wrapper
+
+
 class Client:
     """
     Client for custom http-server.
     When the object is created, it automatically connects to the server,
     authenticates, and requests general chat information.
+    A lost connection is opened again with a jittered exponential backoff,
+    then the messages missed in the chats seen before are fetched after
+    the last seen message id of every chat.
     """
 
     def __init__(
             self,
             user_name: str,
             server_host: str = '127.0.0.1',
-            server_port: int = 8000
+            server_port: int = 8000,
+            wire_format: str = 'json',
+            tokens_file: str = 'client.txt',
+            reconnect_attempts: int = 5,
+            reconnect_backoff: float = 0.5,
+            reconnect_backoff_max: float = 30.0
     ) -> None:
         """
 
         :param user_name: client user name;
         :param server_host: server host;
-        :param server_port: server port.
+        :param server_port: server port;
+        :param wire_format: bodies encoding, 'json' or 'msgpack';
+        :param tokens_file: file the issued tokens are kept in;
+        :param reconnect_attempts: reconnects in a row before the error is raised;
+        :param reconnect_backoff: seconds the first reconnect waits at most,
+            doubled with every next attempt;
+        :param reconnect_backoff_max: seconds a reconnect waits at most.
         """
         self.user_name = user_name
+        self._codec = get_codec(wire_format)
         self.server_host = server_host
         self.server_port = server_port
-        self.sock = socket.create_connection((server_host, server_port))
-        self.conn = h11.Connection(our_role=h11.CLIENT)
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff = reconnect_backoff
+        self.reconnect_backoff_max = reconnect_backoff_max
+        self._in_request = False
+        self._idempotency_key = None
+        self._last_seen = {}
+        self._missed_messages = {}
+        self.sock = None
+        self._open_connection()
         self._token = None
-        self._get_token()
+        self._get_token(tokens_file)
         self.connect_to_chat()
         self._response = None
         self._last_chat_info = None
         self._last_status = None
 
+    def _open_connection(self) -> None:
+        self.sock = socket.create_connection((self.server_host, self.server_port))
+        self.conn = h11.Connection(our_role=h11.CLIENT)
+
+    def _drop_connection(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def _reconnect_delay(self, attempt: int) -> float:
+        """
+        Full jitter: clients dropped at once by a restart spread their reconnects.
+        """
+        return random.uniform(
+            0,
+            min(self.reconnect_backoff_max, self.reconnect_backoff * 2 ** attempt)
+        )
+
     def _send(self, *events: h11.Event) -> None:
         for event in events:
             data = self.conn.send(event)
@@ -60,8 +141,61 @@ class Client:
             if event is h11.NEED_DATA:
                 self.conn.receive_data(self.sock.recv(max_bytes_per_recv))
                 continue
+            if isinstance(event, h11.ConnectionClosed):
+                raise ConnectionResetError('Server closed the connection.')
             return event
 
+    def _read_response(self) -> tuple[Optional[int], Optional[dict]]:
+        status_code = None
+        body = b''
+        while True:
+            event = self.next_event()
+            if isinstance(event, h11.EndOfMessage):
+                self.conn.start_next_cycle()
+                return status_code, self._codec.decode(body) if body else None
+            elif isinstance(event, h11.Response):
+                status_code = event.status_code
+            elif isinstance(event, h11.Data):
+                body += event.data
+
+    @staticmethod
+    def _chat_key(chat_name: str, room: Optional[str]) -> tuple[str, str]:
+        return ('room', room) if room else ('chat_with', chat_name)
+
+    def _remember_last_seen(self, chat_key: tuple[str, str], data: dict) -> None:
+        ids = [
+            message['id']
+            for message in data.get('messages', []) + data.get('unread_messages', [])
+        ]
+        self._last_seen[chat_key] = max([*ids, self._last_seen.get(chat_key, 0)])
+
+    def _resume(self) -> None:
+        """
+        Fetch, page by page, the messages posted after the last seen message
+        of every chat connected to before the connection was lost.
+        """
+        for chat_key in list(self._last_seen):
+            while True:
+                field, name = chat_key
+                body = self._codec.encode({field: name, 'after_id': self._last_seen[chat_key]})
+                self._send_request_to_endpoint(
+                    endpoint='/connect',
+                    method='POST',
+                    body=body,
+                    auth=True
+                )
+                status_code, data = self._read_response()
+                if status_code != HTTPStatus.OK or not data:
+                    logger.error(f'Can not resume chat {name}, error code: {status_code}.')
+                    break
+                missed = data.get('unread_messages', [])
+                self._missed_messages.setdefault(chat_key, []).extend(missed)
+                self._remember_last_seen(chat_key, data)
+                if missed:
+                    logger.info(f'Got {len(missed)} missed messages of chat {name}.')
+                if not data.get('next'):
+                    break
+
     def _is_can_get_token_from_file(self, file_name: str) -> Optional[bool]:
         """
         In client, token is equal to password, and server send token only once.
@@ -76,31 +210,35 @@ class Client:
                     return True
 
     def _get_headers(self, auth: bool, body: bytes) -> list[tuple]:
-        if auth:
-            return [
-                ('Authorization', f'{self._token}'),
-                ('Host', f'{self.server_host}'),
-                ("Content-Length", str(len(body)))
-            ]
-        return [
+        headers = [
             ('Host', f'{self.server_host}'),
             ("Content-Length", str(len(body)))
         ]
+        if auth:
+            headers.insert(0, ('Authorization', f'{self._token}'))
+        if self._codec is not JSONCodec:
+            headers.append(('Content-Type', self._codec.content_type))
+            headers.append(('Accept', self._codec.content_type))
+        return headers
 
     def _send_request_to_endpoint(
             self,
             endpoint: str,
             method: str,
             body: bytes,
-            auth: bool = False
+            auth: bool = False,
+            idempotency_key: Optional[str] = None
     ) -> Optional[bool]:
         if not endpoint.startswith('/') and endpoint.endswith('/') and method not in ['POST', 'GET']:
             logger.error('Enter correct endpoint("/example") and/or method')
             return
+        headers = self._get_headers(body=body, auth=auth)
+        if idempotency_key:
+            headers.append(('Idempotency-Key', idempotency_key))
         self._send(h11.Request(
             method=method,
             target=endpoint,
-            headers=self._get_headers(body=body, auth=auth))
+            headers=headers)
         )
         self._send(h11.Data(data=body))
         self._send(h11.EndOfMessage())
@@ -120,7 +258,7 @@ class Client:
         self._result = None
         if os.path.exists(file_name) and self._is_can_get_token_from_file(file_name):
             return
-        body = json.dumps({'user_name': self.user_name}).encode('utf-8')
+        body = self._codec.encode({'user_name': self.user_name})
         if not self._send_request_to_endpoint(
                 endpoint='/get-token',
                 method='POST',
@@ -136,20 +274,23 @@ class Client:
                 if event.status_code == HTTPStatus.OK:
                     continue
             if isinstance(event, h11.Data):
-                data = json.loads(event.data.decode('utf-8'))
+                data = self._codec.decode(event.data)
                 self._get_token_from_server(data=data, file_name=file_name)
 
+    @_reconnecting
     def connect_to_chat(
             self,
             chat_name: str = 'public_chat',
-            redirect: bool = False
+            redirect: bool = False,
+            room: Optional[str] = None
     ) -> None:
         """
         Makes a request to chat.
         :param chat_name: name of chat/user.
         :param redirect: redirect mode.
+        :param room: name of public room, used instead of chat_name.
         """
-        body = json.dumps({'chat_with': chat_name}).encode('utf-8')
+        body = self._codec.encode({'room': room} if room else {'chat_with': chat_name})
         if not self._send_request_to_endpoint(
                 endpoint='/connect',
                 method='POST',
@@ -173,7 +314,7 @@ class Client:
                 ):
                     error_code += event.status_code
             if isinstance(event, h11.Data):
-                data = json.loads(event.data.decode('utf-8'))
+                data = self._codec.decode(event.data)
                 if data.get('messages'):
                     logger.info(f'Get messages: {data}')
                 elif error := data.get('error'):
@@ -181,6 +322,8 @@ class Client:
                         f'Error in connection to chat {chat_name}.'
                         f'Error code: {error_code}. Error message: {error}'
                     )
+                if not error_code:
+                    self._remember_last_seen(self._chat_key(chat_name, room), data)
                 self._last_chat_info = data
                 if not redirect:
                     self._response = data
@@ -189,14 +332,15 @@ class Client:
             self,
             receiver: str = 'public_chat',
             report: bool = False,
-            chat_type: Optional[ChatType] = None
+            chat_type: Optional[ChatType] = None,
+            room: Optional[str] = None
     ) -> None:
         self._response = None
         redirect, response = self.even_cycle()
         if redirect:
             logger.info('Redirect to chat')
             if not report:
-                self.connect_to_chat(receiver, redirect=True)
+                self.connect_to_chat(receiver, redirect=True, room=room)
             else:
                 if chat_type == ChatType.PUBLIC:
                     self.connect_to_chat()
@@ -205,32 +349,62 @@ class Client:
         if response:
             self._response = response[0]
 
+    @_reconnecting
     def send_message(
             self,
             receiver: str = 'public_chat',
-            message: str = ''
+            message: str = '',
+            room: Optional[str] = None
     ) -> None:
         """
         Send message to chat, and redirect back to chat.
         :param receiver: receiver of message.
         :param message:  text of the message.
+        :param room: name of public room, used instead of receiver.
         """
         if not message:
             logger.error('Enter message, please.')
             return
-        body = json.dumps({
-            'send_to': receiver,
-            'message': message
-        }).encode('utf-8')
+        data = {'room': room} if room else {'send_to': receiver}
+        body = self._codec.encode({**data, 'message': message})
         if not self._send_request_to_endpoint(
                 endpoint='/send',
                 method='POST',
                 body=body,
-                auth=True
+                auth=True,
+                idempotency_key=self._idempotency_key
         ):
             return
-        self._get_response_and_redirect(receiver=receiver)
+        self._get_response_and_redirect(receiver=receiver, room=room)
+
+    @_reconnecting
+    def create_room(self, name: str) -> None:
+        """
+        Create public room, and redirect to it.
+        :param name: name of the room.
+        """
+        self._send_room_request('/rooms', name)
+
+    @_reconnecting
+    def join_room(self, name: str) -> None:
+        """
+        Join public room, and redirect to it.
+        :param name: name of the room.
+        """
+        self._send_room_request('/rooms/join', name)
 
+    def _send_room_request(self, endpoint: str, name: str) -> None:
+        if not self._send_request_to_endpoint(
+                endpoint=endpoint,
+                method='POST',
+                body=self._codec.encode({'name': name}),
+                auth=True,
+                idempotency_key=self._idempotency_key
+        ):
+            return
+        self._get_response_and_redirect(room=name)
+
+    @_reconnecting
     def add_comment(
             self,
             message_id: int,
@@ -244,19 +418,21 @@ class Client:
         if not comment:
             logger.error('Enter comment, please.')
             return
-        body = json.dumps({
+        body = self._codec.encode({
             'message_id': message_id,
             'comment': comment
-        }).encode('utf-8')
+        })
         if not self._send_request_to_endpoint(
                 endpoint='/comment',
                 method='POST',
                 body=body,
-                auth=True
+                auth=True,
+                idempotency_key=self._idempotency_key
         ):
             return
         self._get_response_and_redirect()
 
+    @_reconnecting
     def report(
             self,
             report_on: str,
@@ -270,15 +446,16 @@ class Client:
         if not chat_type:
             logger.error('Enter chat_type argument, please.')
             return
-        body = json.dumps({
+        body = self._codec.encode({
             'report_on': report_on,
             'chat_type': chat_type.value
-        }).encode('utf-8')
+        })
         if not self._send_request_to_endpoint(
                 endpoint='/report',
                 method='POST',
                 body=body,
-                auth=True
+                auth=True,
+                idempotency_key=self._idempotency_key
         ):
             return
         self._get_response_and_redirect(
@@ -309,7 +486,7 @@ class Client:
                 ):
                     error_code += event.status_code
             if isinstance(event, h11.Data):
-                data = json.loads(event.data.decode('utf-8'))
+                data = self._codec.decode(event.data)
                 if data.get('info'):
                     redirect += 1
                     logger.info(f'Success: {data}')
@@ -323,11 +500,12 @@ class Client:
                 response.append(data)
         return redirect, response
 
+    @_reconnecting
     def get_status(self) -> None:
         """
         get status of client and chats.
         """
-        body = json.dumps({'user_name': self.user_name}).encode('utf-8')
+        body = self._codec.encode({'user_name': self.user_name})
         if not self._send_request_to_endpoint(
                 endpoint='/status',
                 method='GET',
@@ -351,7 +529,7 @@ class Client:
                 ):
                     error_code += event.status_code
             if isinstance(event, h11.Data):
-                data = json.loads(event.data.decode('utf-8'))
+                data = self._codec.decode(event.data)
                 if data.get('connected_as'):
                     logger.info(f'Get status: {data}')
                 elif error := data.get('error'):
@@ -373,9 +551,18 @@ class Client:
     def last_status(self) -> Optional[dict]:
         return self._last_status
 
+    @property
+    def missed_messages(self) -> dict[tuple[str, str], list[dict]]:
+        """
+        Messages fetched on reconnects, by ('room' or 'chat_with', name) of the chat.
+        """
+        return self._missed_messages
+
     def close_connection(self) -> None:
         """
         close connection between client and server.
         """
+        if self.sock is None:
+            return
         self._send(h11.ConnectionClosed())
-        self.sock.close()
+        self._drop_connection()
@@ -0,0 +1,102 @@
+import datetime
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from storage import MessageRecord
+
+
+class HistoryWindow:
+    """
+    Newest messages of a chat at some version, newest first,
+    and the responses already built from them.
+    """
+    __slots__ = ('messages', 'complete', 'expires', 'infos', 'bodies')
+
+    def __init__(self, messages: list[MessageRecord], complete: bool, expires: float) -> None:
+        self.messages = messages
+        self.complete = complete
+        self.expires = expires
+        self.infos = None
+        self.bodies = {}
+
+    def page(
+            self,
+            last_connect: datetime.datetime,
+            messages_number: int
+    ) -> Optional[tuple[int, int]]:
+        """
+        Bounds of the unread messages and of the page read before the last connect,
+        None if the window does not hold all of them.
+        """
+        split = start = len(self.messages)
+        for index, message in enumerate(self.messages):
+            if message.pub_date <= last_connect and split > index:
+                split = index
+            if message.pub_date < last_connect:
+                start = index
+                break
+        if not self.complete and start + messages_number > len(self.messages):
+            return None
+        return split, start
+
+
+class ReadCoalescer:
+    """
+    Shares history reads of a chat between requests arriving close together.
+    The newest messages of a chat are read once per chat version and page size,
+    callers that have the same number of unread messages share one encoded
+    response. Writes made by this server bump the chat version, writes made
+    elsewhere are picked up after the ttl.
+    """
+
+    def __init__(
+            self,
+            unread_window: int = 50,
+            ttl: float = 1.0,
+            max_windows: int = 1000
+    ) -> None:
+        """
+        :param unread_window: unread messages a shared window holds above the page size;
+        :param ttl: seconds a window is used for;
+        :param max_windows: number of kept windows, least recently used are dropped.
+        """
+        self.unread_window = unread_window
+        self.ttl = ttl
+        self.max_windows = max_windows
+        self._versions = {}
+        self._generation = 0
+        self._windows = OrderedDict()
+
+    def invalidate(self, chat_id: Optional[int] = None) -> None:
+        """
+        Mark the chat, or all chats if omitted, as changed.
+        """
+        if chat_id is None:
+            self._generation += 1
+        else:
+            self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def window(
+            self,
+            chat_id: int,
+            messages_number: int,
+            load: Callable[[int], list[MessageRecord]]
+    ) -> HistoryWindow:
+        """
+        :param load: reads the given number of the newest messages of the chat.
+        """
+        key = (chat_id, messages_number, self._versions.get(chat_id, 0), self._generation)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window and window.expires > now:
+            self._windows.move_to_end(key)
+            return window
+        limit = messages_number + self.unread_window
+        messages = load(limit)
+        window = HistoryWindow(messages, len(messages) < limit, now + self.ttl)
+        self._windows[key] = window
+        self._windows.move_to_end(key)
+        while len(self._windows) > self.max_windows:
+            self._windows.popitem(last=False)
+        return window
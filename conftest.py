@@ -1,36 +1,64 @@
-import asyncio
-import multiprocessing
-import time
-
 import pytest
 
 from client import Client
+from database import DatabaseSettings, create_db_engine
+from models import create_schema
 from protocol import HTTPProtocol
-from server import Server
+from server import EmbeddedServer
+from storage import MemoryStorage, SQLStorage
+
+
+@pytest.fixture(scope="session")
+def test_server():
+    with EmbeddedServer() as server:
+        yield server
+
+
+@pytest.fixture(scope="session")
+def db_engine(test_server):
+    return test_server.engine
+
+
+@pytest.fixture
+def sql_engine(tmp_path):
+    engine = create_db_engine(DatabaseSettings(url=f'sqlite:///{tmp_path}/messenger.sqlite'))
+    create_schema(engine)
+    return engine
 
 
-def server(host, port):
-    server_obj = Server(host, port)
-    asyncio.run(server_obj.run())
+@pytest.fixture(params=['sql', 'memory'])
+def storage(request, tmp_path):
+    if request.param == 'sql':
+        storage = SQLStorage(request.getfixturevalue('sql_engine'))
+    else:
+        storage = MemoryStorage(data_dir=str(tmp_path))
+    yield storage
+    storage.close()
 
 
-@pytest.fixture(autouse=True, scope="session")
-def start_server():
-    p = multiprocessing.Process(target=server, args=('127.0.0.1', 8000))
-    p.start()
-    time.sleep(3)
-    yield
-    p.terminate()
+@pytest.fixture(scope="session")
+def tokens_file(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('tokens') / 'client.txt')
 
 
 @pytest.fixture
-def client_one():
-    return Client(server_host='127.0.0.1', server_port=8000, user_name='test_client1')
+def client_one(test_server, tokens_file):
+    return Client(
+        server_host='127.0.0.1',
+        server_port=test_server.port,
+        user_name='test_client1',
+        tokens_file=tokens_file
+    )
 
 
 @pytest.fixture
-def client_two():
-    return Client(server_host='127.0.0.1', server_port=8000, user_name='test_client2')
+def client_two(test_server, tokens_file):
+    return Client(
+        server_host='127.0.0.1',
+        server_port=test_server.port,
+        user_name='test_client2',
+        tokens_file=tokens_file
+    )
 
 
 @pytest.fixture
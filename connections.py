@@ -0,0 +1,213 @@
+import asyncio
+import math
+import os
+import resource
+import socket
+from typing import Callable, Optional
+
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable[[], None]) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel driven by one loop callback per tick.
+    Timers fire with the precision of the tick, cancelled timers
+    are dropped when their slot comes round.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 512) -> None:
+        """
+        :param resolution: seconds per tick;
+        :param slots: number of wheel slots, longer delays take several rounds.
+        """
+        self.resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        self._tick = 0
+        self._loop = None
+        self._next_tick_time = 0.0
+        self._handle = None
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self._slots)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self._loop = loop or asyncio.get_running_loop()
+        self._next_tick_time = self._loop.time() + self.resolution
+        self._handle = self._loop.call_at(self._next_tick_time, self._advance)
+
+    def stop(self) -> None:
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            slot.clear()
+
+    def time(self) -> float:
+        return self._loop.time()
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        timer = Timer(self._loop.time() + delay, callback)
+        self._insert(timer, delay)
+        return timer
+
+    def _insert(self, timer: Timer, delay: float) -> None:
+        ticks = max(math.ceil(delay / self.resolution), 1)
+        self._slots[(self._tick + ticks) % len(self._slots)].append(timer)
+
+    def _advance(self) -> None:
+        now = self._loop.time()
+        while self._next_tick_time <= now:
+            self._tick += 1
+            self._next_tick_time += self.resolution
+            index = self._tick % len(self._slots)
+            slot, self._slots[index] = self._slots[index], []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.deadline > now:
+                    self._insert(timer, timer.deadline - now)
+                    continue
+                try:
+                    timer.callback()
+                except Exception:
+                    logger.exception('Timer callback failed.')
+        self._handle = self._loop.call_at(self._next_tick_time, self._advance)
+
+
+class ConnectionManager:
+    """
+    Connection limits and timeouts shared by all connections of the server.
+    """
+
+    def __init__(
+            self,
+            keep_alive_timeout: float = 75.0,
+            request_timeout: float = 30.0,
+            max_connections: int = 50000,
+            max_connections_per_ip: Optional[int] = None,
+            timer_resolution: float = 1.0
+    ) -> None:
+        """
+        :param keep_alive_timeout: seconds an idle connection is kept open between requests;
+        :param request_timeout: seconds to receive a whole request after its first byte;
+        :param max_connections: open connections limit, new connections above it are closed;
+        :param max_connections_per_ip: open connections limit per address, unlimited if omitted;
+        :param timer_resolution: precision of the timeouts in seconds.
+        """
+        self.keep_alive_timeout = keep_alive_timeout
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.timers = TimerWheel(resolution=timer_resolution)
+        self.active = 0
+        self.per_ip = {}
+        self.protocols = set()
+        self.draining = False
+        self._drained = None
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.timers.start(loop)
+        raise_open_files_limit(self.max_connections)
+
+    def stop(self) -> None:
+        self.timers.stop()
+
+    def time(self) -> float:
+        return self.timers.time()
+
+    def acquire(self, ip: Optional[str], protocol: Optional[asyncio.Protocol] = None) -> bool:
+        """
+        Take a connection slot for the address, returns False over the limits.
+        The protocol is kept to be drained on shutdown.
+        """
+        if self.active >= self.max_connections:
+            logger.warning('Connection limit %s reached.', self.max_connections)
+            return False
+        ip_connections = self.per_ip.get(ip, 0)
+        if self.max_connections_per_ip and ip_connections >= self.max_connections_per_ip:
+            logger.warning('Connection limit per address reached for %s.', ip)
+            return False
+        self.active += 1
+        self.per_ip[ip] = ip_connections + 1
+        if protocol:
+            self.protocols.add(protocol)
+        return True
+
+    def release(self, ip: Optional[str], protocol: Optional[asyncio.Protocol] = None) -> None:
+        self.active -= 1
+        if self.per_ip[ip] > 1:
+            self.per_ip[ip] -= 1
+        else:
+            del self.per_ip[ip]
+        self.protocols.discard(protocol)
+        if self._drained and not self.protocols:
+            self._drained.set()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Close idle connections and let busy ones finish their current request,
+        connections still open after the timeout are aborted.
+        Returns number of aborted connections.
+        """
+        self.draining = True
+        self._drained = asyncio.Event()
+        for protocol in list(self.protocols):
+            protocol.drain()
+        if self.protocols:
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        aborted = len(self.protocols)
+        for protocol in list(self.protocols):
+            protocol.abort()
+        if aborted:
+            logger.warning('%s connections aborted after the drain timeout.', aborted)
+        return aborted
+
+
+def raise_open_files_limit(connections: int) -> None:
+    """
+    Raise the soft open files limit towards the hard one to fit the connections.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 1024
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if new_soft > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        logger.info('Open files limit raised to %s.', new_soft)
+
+
+LISTEN_FDS_START = 3
+INHERITED_SOCKET_ENV = 'MESSENGER_LISTEN_FD'
+
+
+def inherited_socket() -> Optional[socket.socket]:
+    """
+    Listening socket passed by the previous server process on hot restart
+    or by systemd socket activation, None if the server has to bind its own.
+    """
+    if fd := os.environ.pop(INHERITED_SOCKET_ENV, None):
+        return socket.socket(fileno=int(fd))
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and int(os.environ.get('LISTEN_FDS', 0)):
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+        return socket.socket(fileno=LISTEN_FDS_START)
+    return None
@@ -0,0 +1,130 @@
+import os
+from typing import Callable, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+DEFAULT_DATABASE_URL = 'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+DEFAULT_ARCHIVE_URL = 'sqlite:///' + os.path.join(basedir, 'archive.sqlite')
+
+
+def _from_env(name: str, default, cast: Callable = str):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return cast(value)
+
+
+def _to_bool(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _setting(value, env_name: str, default, cast: Callable = str):
+    if value is not None:
+        return value
+    return _from_env(env_name, default, cast)
+
+
+class DatabaseSettings:
+    """
+    SQLite storage settings.
+    Every setting omitted in the constructor is read from
+    the MESSENGER_DB_* environment variable, or takes the default.
+    """
+
+    def __init__(
+            self,
+            url: Optional[str] = None,
+            journal_mode: Optional[str] = None,
+            synchronous: Optional[str] = None,
+            mmap_size: Optional[int] = None,
+            cache_size: Optional[int] = None,
+            busy_timeout: Optional[int] = None,
+            pool_size: Optional[int] = None,
+            max_overflow: Optional[int] = None,
+            echo: Optional[bool] = None
+    ) -> None:
+        """
+        :param url: database url (MESSENGER_DB_URL);
+        :param journal_mode: PRAGMA journal_mode (MESSENGER_DB_JOURNAL_MODE);
+        :param synchronous: PRAGMA synchronous (MESSENGER_DB_SYNCHRONOUS);
+        :param mmap_size: PRAGMA mmap_size in bytes (MESSENGER_DB_MMAP_SIZE);
+        :param cache_size: PRAGMA cache_size, negative value is size in KiB (MESSENGER_DB_CACHE_SIZE);
+        :param busy_timeout: PRAGMA busy_timeout in milliseconds (MESSENGER_DB_BUSY_TIMEOUT);
+        :param pool_size: number of kept open connections (MESSENGER_DB_POOL_SIZE);
+        :param max_overflow: connections allowed above pool_size (MESSENGER_DB_MAX_OVERFLOW);
+        :param echo: log every SQL statement (MESSENGER_DB_ECHO).
+        """
+        self.url = _setting(url, 'MESSENGER_DB_URL', DEFAULT_DATABASE_URL)
+        self.journal_mode = _setting(journal_mode, 'MESSENGER_DB_JOURNAL_MODE', 'WAL')
+        self.synchronous = _setting(synchronous, 'MESSENGER_DB_SYNCHRONOUS', 'NORMAL')
+        self.mmap_size = _setting(mmap_size, 'MESSENGER_DB_MMAP_SIZE', 256 * 1024 * 1024, int)
+        self.cache_size = _setting(cache_size, 'MESSENGER_DB_CACHE_SIZE', -64 * 1024, int)
+        self.busy_timeout = _setting(busy_timeout, 'MESSENGER_DB_BUSY_TIMEOUT', 5000, int)
+        self.pool_size = _setting(pool_size, 'MESSENGER_DB_POOL_SIZE', 5, int)
+        self.max_overflow = _setting(max_overflow, 'MESSENGER_DB_MAX_OVERFLOW', 10, int)
+        self.echo = _setting(echo, 'MESSENGER_DB_ECHO', False, _to_bool)
+
+    @property
+    def pragmas(self) -> dict:
+        return {
+            'auto_vacuum': 'INCREMENTAL',
+            'journal_mode': self.journal_mode,
+            'synchronous': self.synchronous,
+            'mmap_size': self.mmap_size,
+            'cache_size': self.cache_size,
+            'busy_timeout': self.busy_timeout,
+        }
+
+
+def memory_database_url(name: str) -> str:
+    """
+    Url of a named in-memory database shared by all connections of the process,
+    it lives while the engine keeps a connection open.
+    """
+    return f'sqlite:///file:{name}?mode=memory&cache=shared&uri=true'
+
+
+def _is_private_memory_url(url: str) -> bool:
+    return make_url(url).database in (None, '', ':memory:')
+
+
+def create_db_engine(settings: Optional[DatabaseSettings] = None) -> Engine:
+    """
+    Create engine, that applies settings pragmas to every new connection.
+    A private in-memory database ('sqlite://') is served by one shared connection.
+    """
+    settings = settings or DatabaseSettings()
+    pool_options = {
+        'poolclass': QueuePool,
+        'pool_size': settings.pool_size,
+        'max_overflow': settings.max_overflow
+    }
+    if _is_private_memory_url(settings.url):
+        pool_options = {'poolclass': StaticPool}
+    db_engine = create_engine(
+        settings.url,
+        echo=settings.echo,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': settings.busy_timeout / 1000
+        },
+        **pool_options
+    )
+    pragmas = settings.pragmas
+
+    @event.listens_for(db_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return db_engine
+
+
+engine = create_db_engine()
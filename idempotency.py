@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+IDEMPOTENCY_KEY_HEADER = b'idempotency-key'
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class CachedResponse:
+    """
+    Status, extra headers and data of a response, the data is encoded
+    by the codec of the connection the response is replayed to.
+    """
+    __slots__ = ('status_code', 'headers', 'data')
+
+    def __init__(self) -> None:
+        self.status_code = None
+        self.headers = []
+        self.data = None
+
+
+class IdempotencyCache:
+    """
+    Responses of writes made with an idempotency key, by user and key.
+    Least recently used responses are evicted above the size limit,
+    responses older than the ttl are not replayed.
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 86400.0) -> None:
+        """
+        :param max_entries: number of kept responses;
+        :param ttl: seconds a response is replayed for.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._responses = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    def get(self, user_id: int, key: str) -> Optional[CachedResponse]:
+        entry = self._responses.get((user_id, key))
+        if not entry:
+            return None
+        expires, response = entry
+        if expires <= time.monotonic():
+            del self._responses[(user_id, key)]
+            return None
+        self._responses.move_to_end((user_id, key))
+        return response
+
+    def put(self, user_id: int, key: str, response: CachedResponse) -> None:
+        self._responses[(user_id, key)] = (time.monotonic() + self.ttl, response)
+        self._responses.move_to_end((user_id, key))
+        while len(self._responses) > self.max_entries:
+            self._responses.popitem(last=False)
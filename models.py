@@ -1,17 +1,15 @@
-import os
-
-from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Integer,
-                        SmallInteger, String, Text, create_engine)
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Index, Integer,
+                        SmallInteger, String, Text)
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session, declarative_base, relationship
 from sqlalchemy.sql import func
 from sqlalchemy_utils.types.choice import ChoiceType
 
+from database import engine
 from enums import ChatType
+from search import create_search_index
 
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-engine = create_engine('sqlite:///' + os.path.join(basedir, 'data.sqlite'), echo=True)
-
 Base = declarative_base()
 
 
@@ -22,8 +20,11 @@ class Message(Base):
     pub_date = Column(DateTime(timezone=True), server_default=func.now())
     author_id = Column(Integer, ForeignKey('users.id'))
     chat_id = Column(Integer, ForeignKey('chats.id'))
+    idempotency_key = Column(String, nullable=True)
     comments = relationship('Comment', backref='message', cascade="all, delete")
 
+    __table_args__ = (Index('ix_messages_author_idempotency_key', 'author_id', 'idempotency_key'),)
+
     def __str__(self):
         return self.text[:15]
 
@@ -35,6 +36,9 @@ class Comment(Base):
     author_id = Column(Integer, ForeignKey('users.id'))
     text = Column(Text(length=255), nullable=False)
     created = Column(DateTime(timezone=True), server_default=func.now())
+    idempotency_key = Column(String, nullable=True)
+
+    __table_args__ = (Index('ix_comments_author_idempotency_key', 'author_id', 'idempotency_key'),)
 
     def __str__(self):
         return self.text[:15]
@@ -48,6 +52,15 @@ class ChatUser(Base):
     cautions = Column(SmallInteger, default=0)
     banned = Column(Boolean, default=False)
     banned_till = Column(DateTime(timezone=True), nullable=True)
+    unread_count = Column(Integer, default=0, nullable=False)
+    last_read_message_id = Column(Integer, nullable=True)
+
+
+class ChatArchive(Base):
+    __tablename__ = 'chat_archives'
+    chat_id = Column(Integer, ForeignKey('chats.id'), primary_key=True)
+    archived_till = Column(DateTime(timezone=True))
+    messages_number = Column(Integer, default=0)
 
 
 class User(Base):
@@ -78,13 +91,17 @@ class Chat(Base):
         return self.name
 
 
+def create_schema(db_engine: Engine) -> None:
+    """
+    Create missing tables, the search index and the public chat.
+    """
+    Base.metadata.create_all(db_engine)
+    create_search_index(db_engine)
+    with Session(db_engine) as session:
+        if not session.query(Chat).filter_by(name='public_chat', type=ChatType.PUBLIC).first():
+            session.add(Chat(name='public_chat', type=ChatType.PUBLIC))
+            session.commit()
+
+
 if __name__ == '__main__':
-    Base.metadata.create_all(engine)
-
-    with Session(engine) as session:
-        public_chat = Chat(
-            name='public_chat',
-            type=ChatType.PUBLIC
-        )
-        session.add(public_chat)
-        session.commit()
+    create_schema(engine)
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+from typing import Callable, Iterable, Optional
+
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+
+class Presence:
+    __slots__ = ('user_id', 'user_name', 'connections', 'last_seen', 'public_member')
+
+    def __init__(self, user_id: int, user_name: str) -> None:
+        self.user_id = user_id
+        self.user_name = user_name
+        self.connections = 0
+        self.last_seen = None
+        self.public_member = None
+
+    @property
+    def online(self) -> bool:
+        return self.connections > 0
+
+
+class PresenceRegistry:
+    """
+    Online state of users by their authorized connections, kept in memory only.
+    Changes are collected and published once per interval, a user who went
+    offline and back online within the interval produces no event.
+    """
+
+    def __init__(self, publish_interval: float = 1.0) -> None:
+        """
+        :param publish_interval: seconds between publications of online/offline changes.
+        """
+        self.publish_interval = publish_interval
+        self.open_connections = 0
+        self._users = {}
+        self._users_by_name = {}
+        self._published = {}
+        self._changed = set()
+        self._subscribers = []
+
+    def subscribe(self, callback: Callable[[list[Presence]], None]) -> None:
+        """
+        :param callback: called with the users whose online state has changed.
+        """
+        self._subscribers.append(callback)
+
+    def connection_made(self) -> None:
+        self.open_connections += 1
+
+    def connection_lost(self, user_id: Optional[int]) -> None:
+        self.open_connections -= 1
+        if user_id is not None:
+            self.leave(user_id)
+
+    def join(self, user_id: int, user_name: str) -> Presence:
+        """
+        Count a connection authorized as the user.
+        Membership in the public chat of a new user is unknown (None)
+        until the caller sets it.
+        """
+        presence = self._users.get(user_id)
+        if not presence:
+            presence = self._users[user_id] = Presence(user_id, user_name)
+            self._users_by_name[user_name] = presence
+        presence.connections += 1
+        presence.last_seen = datetime.datetime.utcnow()
+        self._changed.add(user_id)
+        return presence
+
+    def joined_public_chat(self, user_id: int) -> None:
+        if presence := self._users.get(user_id):
+            presence.public_member = True
+
+    def leave(self, user_id: int) -> None:
+        presence = self._users[user_id]
+        presence.connections -= 1
+        presence.last_seen = datetime.datetime.utcnow()
+        self._changed.add(user_id)
+
+    def seen(self, user_id: int) -> None:
+        self._users[user_id].last_seen = datetime.datetime.utcnow()
+
+    def get(self, user_name: str) -> Optional[Presence]:
+        return self._users_by_name.get(user_name)
+
+    def users(self, user_names: Optional[Iterable[str]] = None) -> list[Presence]:
+        """
+        Presence of the named users or of the public chat members
+        seen since the start, unknown names are skipped.
+        """
+        if user_names is None:
+            return [presence for presence in self._users.values() if presence.public_member]
+        return [
+            presence
+            for user_name in dict.fromkeys(user_names)
+            if (presence := self._users_by_name.get(user_name))
+        ]
+
+    def online_number(self) -> int:
+        return sum(presence.online for presence in self._users.values())
+
+    def publish(self) -> list[Presence]:
+        """
+        Publish users whose online state differs from the last published one.
+        """
+        changes = []
+        for user_id in self._changed:
+            presence = self._users[user_id]
+            if self._published.get(user_id, False) != presence.online:
+                self._published[user_id] = presence.online
+                changes.append(presence)
+        self._changed.clear()
+        if changes:
+            logger.debug('Presence changed for %s users.', len(changes))
+            for callback in self._subscribers:
+                try:
+                    callback(changes)
+                except Exception:
+                    logger.exception('Presence subscriber failed.')
+        return changes
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            self.publish()
@@ -1,26 +1,39 @@
 import asyncio
 import datetime
 import json
-import os
+import math
 import secrets
 import time
 from http import HTTPStatus
 from typing import Optional
+from urllib.parse import parse_qs
 
 import h11
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import Session
 
+import database
+from admission import AdmissionController
+from capture import TrafficRecorder
+from coalescing import ReadCoalescer
+from connections import ConnectionManager
 from enums import ChatType
-from models import Chat, ChatUser, Comment, Message, User
+from idempotency import (IDEMPOTENCY_KEY_HEADER, MAX_IDEMPOTENCY_KEY_LENGTH,
+                         CachedResponse, IdempotencyCache)
+from presence import Presence, PresenceRegistry
+from provisioning import is_valid_user_name, provision_users
+from rooms import MAX_ROOM_NAME_LENGTH, Room, RoomDirectory
+from router import RateLimiter, RequestContext, Router
+from scheduler import BAN_EXPIRY, RATE_WINDOW, ModerationScheduler
+from search import encode_cursor, search_terms
+from serialization import JSONCodec, UnsupportedMediaType, negotiate
+from storage import (PUBLIC_CHAT_NAME, ChatRecord, CommentRecord,
+                     MemberRecord, MessageRecord, SQLStorage, Storage,
+                     UserRecord)
+from tracing import RequestTracer, record_stage
 from utils import get_logger_for_module
 
 
 logger = get_logger_for_module(__name__)
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-engine = create_engine('sqlite:///' + os.path.join(basedir, 'data.sqlite'), echo=True)
-
 ERROR_CODE_TO_MESSAGES = {
     HTTPStatus.UNAUTHORIZED: 'Unauthorized. Please name yourself, add "user_name" '
                              'to request body (not empty)'
@@ -29,7 +42,24 @@ ERROR_CODE_TO_MESSAGES = {
                              'get it by POST request to endpoint "get_token"',
     HTTPStatus.BAD_REQUEST: 'BAD REQUEST',
     HTTPStatus.NOT_FOUND: 'Not found message/user_name/chat',
-    HTTPStatus.METHOD_NOT_ALLOWED: 'Not allowed http method'
+    HTTPStatus.METHOD_NOT_ALLOWED: 'Not allowed http method',
+    HTTPStatus.TOO_MANY_REQUESTS: 'Too many requests, retry later',
+    HTTPStatus.UNSUPPORTED_MEDIA_TYPE: 'Unsupported media type, '
+                                       'use application/json or application/msgpack',
+    HTTPStatus.CONFLICT: 'Room with this name already exists',
+    HTTPStatus.UNPROCESSABLE_ENTITY: 'Message with this idempotency key have already sent',
+    HTTPStatus.SERVICE_UNAVAILABLE: 'Server is overloaded, retry later',
+    HTTPStatus.INTERNAL_SERVER_ERROR: 'Internal server error'
+}
+
+MAX_PROVISIONED_USERS = 10000
+MAX_MULTICAST_RECIPIENTS = 10000
+EXPORT_BATCH_SIZE = 500
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+PERSISTED_WRITES = {
+    b'/send': 'Message have sent!',
+    b'/comment': 'Comment have created!'
 }
 
 MESSAGES_FOR_USER = {
@@ -45,18 +75,178 @@ MESSAGES_FOR_USER = {
 }
 
 
+def _is_int_at_least(value, minimum: int) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+
 class HTTPProtocol(asyncio.Protocol):
     """
     Custom HTTP protocol.
     For more info see README.md
     """
 
-    def __init__(self):
+    def __init__(
+            self,
+            storage: Optional[Storage] = None,
+            tracer: Optional[RequestTracer] = None,
+            connections: Optional[ConnectionManager] = None,
+            rate_limiter: Optional[RateLimiter] = None,
+            scheduler: Optional[ModerationScheduler] = None,
+            admin_token: Optional[str] = None,
+            presence: Optional[PresenceRegistry] = None,
+            idempotency: Optional[IdempotencyCache] = None,
+            coalescer: Optional[ReadCoalescer] = None,
+            rooms: Optional[RoomDirectory] = None,
+            recorder: Optional[TrafficRecorder] = None,
+            admission: Optional[AdmissionController] = None
+    ):
+        """
+        :param storage: storage of users, chats and messages,
+            SQL storage on the engine from database.py if omitted;
+        :param tracer: per-request SQL tracer, requests are not traced if omitted;
+        :param connections: connection limits and timeouts of the server,
+            connections are not limited if omitted;
+        :param rate_limiter: requests rate limit per user (per address before auth),
+            requests are not limited if omitted;
+        :param scheduler: scheduler of ban expiry and rate window deadlines,
+            expired state is only ignored by checks if omitted;
+        :param admin_token: bearer token of admin endpoints, they are disabled if omitted;
+        :param presence: registry of online users shared by all connections,
+            presence is not tracked if omitted;
+        :param idempotency: responses of writes with the Idempotency-Key header,
+            the header is ignored if omitted;
+        :param coalescer: history reads shared between connections,
+            every request reads the history itself if omitted;
+        :param rooms: public rooms shared by all connections,
+            rooms of this connection only if omitted;
+        :param recorder: capture file of served requests, nothing is captured if omitted;
+        :param admission: queues of requests shared by all connections,
+            requests are served as soon as they are received if omitted.
+        """
         self.connection = h11.Connection(h11.SERVER)
+        self._storage = storage or SQLStorage(database.engine)
+        self._tracer = tracer
+        self._connections = connections
+        self._rate_limiter = rate_limiter
+        self._scheduler = scheduler
+        self._admin_token = admin_token
+        self._presence = presence
+        self._idempotency = idempotency
+        self._coalescer = coalescer
+        self._rooms = rooms or RoomDirectory(self._storage)
+        self._recorder = recorder
+        self._admission = admission
+        self._request_user = None
+        self._response_status = None
+        self._idempotency_key = None
+        self._captured = None
+        self._request_codec = None
+        self._response_codec = JSONCodec
+        self._middleware = (
+            ('body', self._decode_body),
+            ('auth', self._authenticate),
+            ('idempotency', self._replay_idempotent),
+            ('rate_limit', self._limit_rate)
+        )
+        self._registered = False
+        self._present = False
+        self._presence_user_id = None
+        self._timer = None
+        self._peer_ip = None
+        self._last_activity = 0.0
+        self._request_started = None
+        self._request = None
+        self._body = bytearray()
+        self._export = None
+        self._export_scheduled = False
+        self._writing_paused = False
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         self._transport = transport
-        logger.info('Start serving %s', transport.get_extra_info('peername'))
+        peername = transport.get_extra_info('peername')
+        self._peer_ip = peername[0] if peername else None
+        if self._connections:
+            if not self._connections.acquire(self._peer_ip, self):
+                transport.abort()
+                return
+            self._registered = True
+            self._last_activity = self._connections.time()
+            self._timer = self._connections.timers.call_later(
+                self._connections.keep_alive_timeout,
+                self._check_timeouts
+            )
+        if self._presence:
+            self._present = True
+            self._presence.connection_made()
+        logger.info('Start serving %s', peername)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._export = None
+        if self._present:
+            self._present = False
+            self._presence.connection_lost(self._presence_user_id)
+        if self._registered:
+            self._registered = False
+            self._timer.cancel()
+            self._connections.release(self._peer_ip, self)
+
+    def drain(self) -> None:
+        """
+        Close the connection now if it is idle, otherwise after the response
+        to the request in progress.
+        """
+        if self._request_started is None:
+            self._transport.close()
+
+    def abort(self) -> None:
+        self._transport.abort()
+
+    def _check_timeouts(self) -> None:
+        """
+        Close the connection idle longer than the keep-alive timeout
+        or receiving a request longer than the request timeout.
+        """
+        if not self._registered:
+            return
+        now = self._connections.time()
+        if self._export is not None:
+            deadline = self._last_activity + self._connections.keep_alive_timeout
+            reason = 'Export write timeout'
+        elif self._request_started is not None:
+            deadline = self._request_started + self._connections.request_timeout
+            reason = 'Request read timeout'
+        else:
+            deadline = self._last_activity + self._connections.keep_alive_timeout
+            reason = 'Keep-alive timeout'
+        if now >= deadline:
+            logger.info(
+                '%s, close connection %s',
+                reason,
+                self._transport.get_extra_info('peername')
+            )
+            self._transport.close()
+            return
+        self._timer = self._connections.timers.call_later(deadline - now, self._check_timeouts)
+
+    def _schedule_request_timeout(self) -> None:
+        """
+        Check the started request at its read deadline if the pending check is later.
+        """
+        deadline = self._request_started + self._connections.request_timeout
+        if deadline < self._timer.deadline:
+            self._timer.cancel()
+            self._timer = self._connections.timers.call_later(
+                deadline - self._connections.time(),
+                self._check_timeouts
+            )
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        if self._export is not None:
+            self._schedule_export()
 
     def eof_received(self) -> bool:
         self.connection.receive_data(b"")
@@ -66,182 +256,535 @@ class HTTPProtocol(asyncio.Protocol):
     def _deliver_events(self) -> None:
         while True:
             event = self.connection.next_event()
-            try:
-                if isinstance(event, h11.Request):
-                    self._request_processing(self.connection, event)
-                elif (
-                        event is h11.NEED_DATA or event is h11.PAUSED
-                ):
-                    break
-            except RuntimeError:
-                self._send_error(HTTPStatus.METHOD_NOT_ALLOWED)
+            if isinstance(event, h11.Request):
+                self._start_request(event)
+            elif isinstance(event, h11.Data):
+                self._body += event.data
+            elif isinstance(event, h11.EndOfMessage):
+                self._finish_request()
+            elif isinstance(event, h11.ConnectionClosed):
+                # the client will not read a pending response, nor send more requests
+                logger.info('Connection closed by %s', self._transport.get_extra_info('peername'))
+                self._export = None
+                self._transport.close()
+                break
+            elif (
+                    event is h11.NEED_DATA or event is h11.PAUSED
+            ):
+                break
             if self.connection.our_state is h11.MUST_CLOSE:
                 logger.info('Close connection %s', self._transport.get_extra_info('peername'))
                 self._transport.close()
                 break
 
     def data_received(self, data: bytes) -> None:
+        if self._registered:
+            self._last_activity = self._connections.time()
+            if self._request_started is None:
+                self._request_started = self._last_activity
+                self._schedule_request_timeout()
         self.connection.receive_data(data)
         self._deliver_events()
+        self._next_cycle()
 
-        if self.connection.our_state is h11.DONE:
+    def _next_cycle(self) -> None:
+        while (
+                self.connection.our_state is h11.DONE
+                and self.connection.their_state is h11.DONE
+        ):
             self.connection.start_next_cycle()
             self._deliver_events()
+        if self.connection.their_state is h11.IDLE and not self.connection.trailing_data[0]:
+            self._request_started = None
+            if self._registered and self._connections.draining:
+                self._transport.close()
 
-    def _token_endpoint_processing(self, data: dict) -> None:
-        user_name = data.get('user_name', None)
+    def _token_endpoint_processing(self, request: RequestContext) -> None:
+        user_name = request.data.get('user_name', None)
         if not user_name:
             self._send_error(HTTPStatus.UNAUTHORIZED)
+        elif not isinstance(user_name, str) or not is_valid_user_name(user_name):
+            self._send_error(HTTPStatus.BAD_REQUEST)
         else:
             self._send_token(user_name)
 
-    def _connect_endpoint_processing(
-            self,
-            data: dict,
-            request_event: h11.Request
-    ) -> None:
-        if user_obj := self._check_auth(request_event):
-            chat_with = data.get('chat_with', 'public_chat')
-            messages_number = data.get('messages_number', 20)
-            self._send_response_for_connect_endpoint(
-                user_obj,
-                chat_with,
-                messages_number
+    def _connect_endpoint_processing(self, request: RequestContext) -> None:
+        data = request.data
+        messages_number = data.get('messages_number', 20)
+        before_id = data.get('before_id')
+        after_id = data.get('after_id')
+        if (
+                not _is_int_at_least(messages_number, 1)
+                or before_id is not None and not _is_int_at_least(before_id, 0)
+                or after_id is not None and not _is_int_at_least(after_id, 0)
+        ):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        self._send_response_for_connect_endpoint(
+            request.user,
+            data.get('chat_with', PUBLIC_CHAT_NAME),
+            messages_number,
+            archive=bool(data.get('archive')),
+            before_id=before_id,
+            after_id=after_id,
+            room_name=data.get('room')
+        )
 
+    def _send_endpoint_processing(self, request: RequestContext) -> None:
+        message = request.data.get('message')
+        if not message:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        if room_name := request.data.get('room'):
+            self._send_response_for_room_message(request.user, message, room_name)
+            return
+        send_to = request.data.get('send_to', PUBLIC_CHAT_NAME)
+        if not isinstance(send_to, list):
+            self._send_response_for_send_message(request.user, message, send_to)
+        elif (
+                not 0 < len(send_to) <= MAX_MULTICAST_RECIPIENTS
+                or not all(isinstance(name, str) and name for name in send_to)
+        ):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_multicast(request.user, message, send_to)
+
+    def _comment_endpoint_processing(self, request: RequestContext) -> None:
+        message_id = request.data.get('message_id')
+        comment = request.data.get('comment')
+        if not message_id or not comment:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_comment(message_id, comment, request.user)
+
+    def _report_endpoint_processing(self, request: RequestContext) -> None:
+        report_on = request.data.get('report_on')
+        chat_type = request.data.get('chat_type')
+        if not report_on or not chat_type or chat_type not in [
+            item.value
+            for item in ChatType
+        ]:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            if chat_type == ChatType.PUBLIC.value:
+                chat_type = ChatType.PUBLIC
+            elif chat_type == ChatType.PRIVATE.value:
+                chat_type = ChatType.PRIVATE
+            self._send_response_for_report(
+                request.user,
+                chat_type,
+                report_on,
+                room_name=request.data.get('room', PUBLIC_CHAT_NAME)
             )
+
+    def _comments_endpoint_processing(self, request: RequestContext) -> None:
+        message_id = request.data.get('message_id')
+        if not message_id:
+            self._send_error(HTTPStatus.BAD_REQUEST)
         else:
+            self._send_response_for_comments(
+                request.user,
+                message_id,
+                request.data.get('limit', 20),
+                request.data.get('after')
+            )
+
+    def _search_endpoint_processing(self, request: RequestContext) -> None:
+        query = request.data.get('query')
+        if not isinstance(query, str) or not search_terms(query):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_search(
+                request.user,
+                query,
+                request.data.get('limit', 20),
+                request.data.get('after')
+            )
+
+    def _users_endpoint_processing(self, request: RequestContext) -> None:
+        token = self._get_bearer_token(request.event) or ''
+        if not self._admin_token or not secrets.compare_digest(token, self._admin_token):
             self._send_error(HTTPStatus.UNAUTHORIZED)
+            return
+        user_names = request.data.get('user_names')
+        if (
+                not isinstance(user_names, list)
+                or not 0 < len(user_names) <= MAX_PROVISIONED_USERS
+                or not all(
+                    isinstance(name, str) and is_valid_user_name(name.strip())
+                    for name in user_names
+                )
+        ):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        self._send_response_for_users(user_names)
 
-    def _send_endpoint_processing(
-            self,
-            data: dict,
-            request_event: h11.Request
-    ) -> None:
-        if user_obj := self._check_auth(request_event):
-            message = data.get('message')
-            if not message:
-                self._send_error(HTTPStatus.BAD_REQUEST)
-            else:
-                chat_name = data.get('send_to', 'public_chat')
-                self._send_response_for_send_message(user_obj, message, chat_name)
-
-    def _comment_endpoint_processing(
-            self,
-            data: dict,
-            request_event: h11.Request
-    ) -> None:
-        if user_obj := self._check_auth(request_event):
-            message_id = data.get('message_id')
-            comment = data.get('comment')
-            if not message_id or not comment:
-                self._send_error(HTTPStatus.BAD_REQUEST)
-            else:
-                self._send_response_for_comment(message_id, comment, user_obj)
-
-    def _report_endpoint_processing(
+    def _status_endpoint_processing(self, request: RequestContext) -> None:
+        self._send_response_status_endpoint(request.user)
+
+    def _unread_endpoint_processing(self, request: RequestContext) -> None:
+        self._send_response_unread_endpoint(request.user)
+
+    def _presence_endpoint_processing(self, request: RequestContext) -> None:
+        if not self._presence:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+        user_names = None
+        if users := parse_qs(request.query.decode('utf-8', 'replace')).get('users'):
+            user_names = [name for value in users for name in value.split(',') if name]
+        self._send_response_for_presence(user_names)
+
+    def _export_endpoint_processing(self, request: RequestContext) -> None:
+        query = parse_qs(request.query.decode('utf-8', 'replace'))
+        room_name, user_name = query.get('room', [''])[0], query.get('user', [''])[0]
+        if bool(room_name) == bool(user_name):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_export(request.user, room_name, user_name)
+
+    def _rooms_endpoint_processing(self, request: RequestContext) -> None:
+        self._send_response_for_rooms()
+
+    def _create_room_endpoint_processing(self, request: RequestContext) -> None:
+        name = request.data.get('name')
+        if not isinstance(name, str) or not 0 < len(name) <= MAX_ROOM_NAME_LENGTH:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_create_room(request.user, name)
+
+    def _join_room_endpoint_processing(self, request: RequestContext) -> None:
+        name = request.data.get('name')
+        if not name:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+        else:
+            self._send_response_for_join_room(request.user, name)
+
+    def _start_request(self, request_event: h11.Request) -> None:
+        self._request = request_event
+        self._body = bytearray()
+
+    def _finish_request(self) -> None:
+        request_event, body = self._request, bytes(self._body)
+        self._request = None
+        self._body = bytearray()
+        if request_event is None:
+            return
+        started = time.monotonic()
+        if not self._admission:
+            self._serve_request(request_event, body, started)
+            return
+        path, _ = router.split_target(request_event.target)
+        route, _ = router.resolve(request_event.method, path)
+        if retry_after := self._admission.submit(
+                bool(route and route.expensive),
+                lambda: self._serve_queued_request(request_event, body, started),
+                lambda expired_retry_after: self._serve_queued_request(
+                    request_event, body, started, expired_retry_after
+                ),
+                self._fail_queued_request
+        ):
+            self._serve_request(request_event, body, started, retry_after)
+
+    def _serve_queued_request(
             self,
-            data: dict,
-            request_event: h11.Request
+            request_event: h11.Request,
+            body: bytes,
+            started: float,
+            retry_after: Optional[int] = None
     ) -> None:
-        if user_obj := self._check_auth(request_event):
-            report_on = data.get('report_on')
-            chat_type = data.get('chat_type')
-            if not report_on or not chat_type or chat_type not in [
-                item.value
-                for item in ChatType
-            ]:
-                self._send_error(HTTPStatus.BAD_REQUEST)
-            else:
-                if chat_type == ChatType.PUBLIC.value:
-                    chat_type = ChatType.PUBLIC
-                elif chat_type == ChatType.PRIVATE.value:
-                    chat_type = ChatType.PRIVATE
-                self._send_response_for_report(user_obj, chat_type, report_on)
-
-    def _status_endpoint_processing(
+        """
+        Serve the request taken from the admission queue, or reject it with 503,
+        then go on with the next request of the connection.
+        """
+        if self._transport.is_closing():
+            return
+        self._serve_request(request_event, body, started, retry_after)
+        self._continue_connection()
+
+    def _fail_queued_request(self) -> None:
+        if self._transport.is_closing():
+            return
+        self._fail_request()
+        self._continue_connection()
+
+    def _continue_connection(self) -> None:
+        """
+        Go on with the next request after a response finished outside data_received.
+        """
+        if self.connection.our_state is h11.MUST_CLOSE:
+            self._transport.close()
+        else:
+            self._next_cycle()
+
+    def _serve_request(
             self,
-            request_event: h11.Request
+            request_event: h11.Request,
+            body: bytes,
+            started: float,
+            retry_after: Optional[int] = None
     ) -> None:
-        if user_obj := self._check_auth(request_event):
-            self._send_response_status_endpoint(user_obj)
-
-    def _process_post_request(self, data: dict, request_event: h11.Request) -> None:
-        if request_event.target == b'/get-token':
-            self._token_endpoint_processing(data)
-        elif request_event.target == b'/connect':
-            self._connect_endpoint_processing(data, request_event)
-        elif request_event.target == b'/send':
-            self._send_endpoint_processing(data, request_event)
-        elif request_event.target == b'/comment':
-            self._comment_endpoint_processing(data, request_event)
-        elif request_event.target == b'/report':
-            self._report_endpoint_processing(data, request_event)
-
-    def _process_get_request(self, request_event: h11.Request) -> None:
-        if request_event.target == b'/status':
-            self._status_endpoint_processing(request_event)
-
-    def _request_processing(self, connection: h11.Connection, request_event: h11.Request) -> None:
-        if request_event.method not in [b'GET', b'POST']:
-            logger.error('unsupported HTTP method')
-            raise RuntimeError('unsupported method')
-        while True:
-            event = connection.next_event()
-            if isinstance(event, h11.EndOfMessage):
-                break
-            elif isinstance(event, h11.Data):
-                if request_event.method == b'POST':
-                    data = json.loads(event.data.decode('utf-8'))
-                    self._process_post_request(data, request_event)
-                else:
-                    self._process_get_request(request_event)
+        self._request_user = None
+        self._response_status = None
+        if retry_after is not None:
+            self._send_error(HTTPStatus.SERVICE_UNAVAILABLE, [('Retry-After', str(retry_after))])
+        elif not self._tracer:
+            self._request_processing(request_event, body)
+        else:
+            with self._tracer.trace(
+                    request_event.method.decode('ascii'),
+                    request_event.target.decode('ascii', 'replace')
+            ):
+                self._request_processing(request_event, body)
+        if self._recorder:
+            self._recorder.record(
+                request_event,
+                body,
+                self._request_user.user_name if self._request_user else None,
+                self._response_status,
+                started,
+                time.monotonic() - started
+            )
+
+    def _request_processing(self, request_event: h11.Request, body: bytes) -> None:
+        if self._request_codec is None:
+            try:
+                self._request_codec, self._response_codec = negotiate(request_event.headers)
+            except UnsupportedMediaType:
+                self._send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+                return
+        path, query = router.split_target(request_event.target)
+        route, error_code = router.resolve(request_event.method, path)
+        if error_code == HTTPStatus.METHOD_NOT_ALLOWED:
+            allowed = b', '.join(router.allowed_methods(path))
+            self._send_error(error_code, [('Allow', allowed)])
+            return
+        if error_code:
+            self._send_error(error_code)
+            return
+        request = RequestContext(request_event, route, path, query, body)
+        self._idempotency_key = None
+        self._captured = None
+        try:
+            self._run_route(request)
+        except Exception:
+            logger.exception(
+                'Request %s %s failed.',
+                request_event.method.decode('ascii'),
+                path.decode('ascii', 'replace')
+            )
+            self._fail_request()
+
+    def _run_route(self, request: RequestContext) -> None:
+        for name, stage in self._middleware:
+            started = time.perf_counter()
+            proceed = stage(request)
+            record_stage(name, time.perf_counter() - started)
+            if not proceed:
+                return
+        started = time.perf_counter()
+        request.route.handler(self, request)
+        record_stage('handler', time.perf_counter() - started)
+        if self._idempotency_key is not None:
+            self._remember_response(request.user)
+
+    def _fail_request(self) -> None:
+        """
+        Answer the failed request with 500 if its response has not started,
+        a started response can not be finished, so the connection is closed.
+        """
+        self._idempotency_key = None
+        self._captured = None
+        if self.connection.our_state is h11.SEND_RESPONSE:
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+        else:
+            self._transport.close()
+
+    def _decode_body(self, request: RequestContext) -> bool:
+        if not request.body:
+            return True
+        try:
+            request.data = self._request_codec.decode(request.body)
+        except ValueError:
+            request.data = None
+        if not isinstance(request.data, dict):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return False
+        return True
+
+    def _authenticate(self, request: RequestContext) -> bool:
+        if not request.route.auth:
+            return True
+        request.user = self._request_user = self._check_auth(request.event)
+        if request.user is None:
+            return False
+        if self._present:
+            self._track_presence(request.user)
+        return True
+
+    def _track_presence(self, user: UserRecord) -> None:
+        if self._presence_user_id == user.id:
+            self._presence.seen(user.id)
+            return
+        if self._presence_user_id is not None:
+            self._presence.leave(self._presence_user_id)
+        presence = self._presence.join(user.id, user.user_name)
+        if presence.public_member is None:
+            public_chat = self._storage.get_public_chat()
+            presence.public_member = bool(
+                public_chat and self._storage.get_member(public_chat.id, user.id)
+            )
+        self._presence_user_id = user.id
+
+    def _join_chat(self, chat: ChatRecord, user_id: int) -> MemberRecord:
+        member = self._storage.join_chat(chat.id, user_id)
+        if self._presence and chat.type == ChatType.PUBLIC and chat.name == PUBLIC_CHAT_NAME:
+            self._presence.joined_public_chat(user_id)
+        return member
+
+    def _replay_idempotent(self, request: RequestContext) -> bool:
+        """
+        Replay the response to the write made with the same idempotency key,
+        a key saved with a message or comment lost by the cache is answered
+        by the created response.
+        """
+        if self._idempotency is None or not request.route.idempotent:
+            return True
+        key = next((
+            value.decode('utf-8', 'replace')
+            for name, value in request.event.headers
+            if name == IDEMPOTENCY_KEY_HEADER
+        ), None)
+        if key is None:
+            return True
+        if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return False
+        if response := self._idempotency.get(request.user.id, key):
+            self._send_cached_response(response)
+            logger.info('Response replayed for idempotency key.')
+            return False
+        self._idempotency_key = key
+        self._captured = CachedResponse()
+        created = PERSISTED_WRITES.get(request.path)
+        if created and self._storage.idempotency_key_used(request.user.id, key):
+            if isinstance(request.data.get('send_to'), list):
+                # delivery statuses of a multicast are not saved, its response can not be rebuilt
+                self._send_error(HTTPStatus.UNPROCESSABLE_ENTITY)
+                return False
+            self._send_created_code(created)
+            self._remember_response(request.user)
+            return False
+        return True
+
+    def _remember_response(self, user: UserRecord) -> None:
+        response, self._captured = self._captured, None
+        if (
+                response.data is not None
+                and response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR
+        ):
+            self._idempotency.put(user.id, self._idempotency_key, response)
+
+    def _send_cached_response(self, response: CachedResponse) -> None:
+        body = self._get_encode_body_from_data(response.data)
+        headers = self._get_headers_for_json_body(body) + response.headers
+        self.send(h11.Response(status_code=response.status_code, headers=headers))
+        self.send(h11.Data(data=body))
+        self.send(h11.EndOfMessage())
+
+    def _limit_rate(self, request: RequestContext) -> bool:
+        if not self._rate_limiter:
+            return True
+        client = request.user.id if request.user else self._peer_ip
+        if retry_after := self._rate_limiter.acquire(client):
+            self._send_error(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                [('Retry-After', str(math.ceil(retry_after)))]
+            )
+            return False
+        return True
+
+    def _send_response_status_endpoint(self, user: UserRecord) -> None:
+        result = {
+            'connected_as': user.user_name,
+            'chats': []
+        }
+        for summary in self._storage.chat_summaries(user.id):
+            result['chats'].append(
+                {
+                    'name': summary.title,
+                    'chat_type': str(summary.chat.type.value),
+                    'created': summary.chat.created.strftime('%d.%m.%Y, %H:%M:%S'),
+                    'messages_number': summary.messages_number,
+                    'users_number': summary.users_number
+                }
+            )
+        body = self._get_encode_body_from_data(result)
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
+
+    def _send_response_unread_endpoint(self, user: UserRecord) -> None:
+        result = {
+            'chats': [
+                {
+                    'name': counter.title,
+                    'chat_type': str(counter.chat.type.value),
+                    'unread_count': counter.unread_count,
+                    'last_read_message_id': counter.last_read_message_id
+                }
+                for counter in self._storage.unread_counters(user.id)
+            ]
+        }
+        body = self._get_encode_body_from_data(result)
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
 
     @staticmethod
-    def _get_chat_name(chat: Chat, user_obj: User) -> str:
-        if chat.type == ChatType.PUBLIC:
-            return chat.name
-        if chat.users[0].user_name != user_obj.user_name:
-            return chat.users[0].user_name
-        return chat.users[1].user_name
-
-    def _send_response_status_endpoint(self, user: User) -> None:
-        with Session(engine) as session:
-            user_obj = session.query(User).filter_by(user_name=user.user_name).first()
-            result = {
-                'connected_as': user_obj.user_name,
-                'chats': []
-            }
-            chats = user_obj.chats
-            for chat in chats:
-                result['chats'].append(
-                    {
-                        'name': self._get_chat_name(chat=chat, user_obj=user_obj),
-                        'chat_type': str(chat.type.value),
-                        'created': chat.created.strftime('%d.%m.%Y, %H:%M:%S'),
-                        'messages_number': chat.messages.count(),
-                        'users_number': chat.users.count()
-                    }
-                )
-            body = self._get_encode_body_from_data(result)
-            headers = self._get_headers_for_json_body(body)
-            self._send_response_with_ok_code(body, headers)
+    def _get_presence_info(presence: Presence) -> dict:
+        return {
+            'user_name': presence.user_name,
+            'online': presence.online,
+            'last_seen': presence.last_seen.strftime('%d.%m.%Y, %H:%M:%S')
+        }
+
+    def _send_response_for_presence(self, user_names: Optional[list[str]]) -> None:
+        users = self._presence.users(user_names)
+        result = {
+            'online': sum(presence.online for presence in users),
+            'users': [self._get_presence_info(presence) for presence in users]
+        }
+        if user_names is not None:
+            found = {presence.user_name for presence in users}
+            result['unknown'] = [name for name in dict.fromkeys(user_names) if name not in found]
+        body = self._get_encode_body_from_data(result)
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
 
-    def _check_auth(self, request_event: h11.Request) -> Optional[User]:
-        token = None
+    def _send_response_for_users(self, user_names: list[str]) -> None:
+        users = list(provision_users(self._storage, user_names))
+        body = self._get_encode_body_from_data({
+            'users': [{'user_name': user.user_name, 'token': user.token} for user in users],
+            'skipped': len(user_names) - len(users)
+        })
+        headers = self._get_headers_for_json_body(body)
+        self.send(h11.Response(status_code=HTTPStatus.CREATED, headers=headers))
+        self.send(h11.Data(data=body))
+        self.send(h11.EndOfMessage())
+        logger.info('Provisioned %s users.', len(users))
+
+    @staticmethod
+    def _get_bearer_token(request_event: h11.Request) -> Optional[str]:
         for name, value in request_event.headers:
             if name.lower() == b'authorization':
-                decode_token = value.decode('utf-8')
                 try:
-                    _, token = decode_token.split()
-                except IndexError:
-                    self._send_error(HTTPStatus.UNAUTHORIZED)
+                    _, token = value.decode('utf-8').split()
+                except ValueError:
                     return
-        if not token:
-            self._send_error(HTTPStatus.UNAUTHORIZED)
-            return
-        with Session(engine) as session:
-            if user_obj := session.query(User).filter_by(token=token).first():
-                return user_obj
+                return token
+
+    def _check_auth(self, request_event: h11.Request) -> Optional[UserRecord]:
+        token = self._get_bearer_token(request_event)
+        if token and (user_obj := self._storage.get_user_by_token(token)):
+            return user_obj
         self._send_error(HTTPStatus.UNAUTHORIZED)
 
     def _send_response_with_ok_code(self, body: bytes, headers: list) -> None:
@@ -251,175 +794,361 @@ class HTTPProtocol(asyncio.Protocol):
         self.send(h11.EndOfMessage())
 
     def send(self, event: h11.Event) -> None:
+        if isinstance(event, h11.Response):
+            self._response_status = event.status_code
+            if self._captured is not None:
+                self._captured.status_code = event.status_code
+                self._captured.headers = [
+                    (name, value)
+                    for name, value in event.headers
+                    if name not in (b'content-type', b'content-length')
+                ]
+        if (
+                isinstance(event, h11.Response)
+                and self._registered
+                and self._connections.draining
+        ):
+            event = h11.Response(
+                status_code=event.status_code,
+                headers=[*event.headers, ('Connection', 'close')],
+                reason=event.reason
+            )
         data = self.connection.send(event)
         self._transport.write(data)
 
     @staticmethod
-    def _get_message_info(message: Message) -> dict:
+    def _get_comment_info(comment: CommentRecord) -> dict:
+        return {
+            'id': comment.id,
+            'created': comment.created.strftime('%d.%m.%Y, %H:%M:%S'),
+            'author': comment.author_name,
+            'comment_text': comment.text
+        }
+
+    def _get_message_info(self, message: MessageRecord) -> dict:
         return {
             'id': message.id,
             'pub_date': message.pub_date.strftime('%d.%m.%Y, %H:%M:%S'),
-            'author': message.author.user_name,
+            'author': message.author_name,
             'message_text': message.text,
-            'message_comments': str(message.comments)
+            'message_comments': [self._get_comment_info(comment) for comment in message.comments],
+            'comments_number': message.comments_number
         }
 
+    def _archived_messages_to_body(
+            self,
+            chat: ChatRecord,
+            messages_number: int,
+            before_id: Optional[int]
+    ) -> bytes:
+        """
+        Encoded page of the archived history, the archive is read only for chats
+        with the archive marker, which is returned with the page.
+        """
+        marker = self._storage.archive_marker(chat.id)
+        messages = (
+            self._storage.archived_messages(chat.id, before_id, messages_number) if marker else []
+        )
+        return self._get_encode_body_from_data({
+            'messages': [self._get_message_info(message) for message in messages],
+            'unread_messages': [],
+            'archive': {
+                'archived_till': marker.archived_till.strftime('%d.%m.%Y, %H:%M:%S'),
+                'messages_number': marker.messages_number
+            } if marker else None,
+            'next': messages[-1].id if messages and len(messages) == messages_number else None
+        })
+
     def _messages_from_chat_to_body(
             self,
-            session: Session,
-            user_caller: User,
-            chat: Chat,
-            messages_number: int
+            user_caller: UserRecord,
+            chat: ChatRecord,
+            messages_number: int,
+            archive: bool = False,
+            before_id: Optional[int] = None,
+            after_id: Optional[int] = None
     ) -> bytes:
-        chat_user_obj = session.query(ChatUser).filter_by(
-            chat_id=chat.id
-        ).filter_by(
-            user_id=user_caller.id
-        ).first()
-        last_connect = chat_user_obj.last_connect
-
-        if not last_connect:
-            last_connect = chat.created
-        temp_dict = {
+        if archive:
+            return self._archived_messages_to_body(chat, messages_number, before_id)
+        member = (
+            self._storage.get_member(chat.id, user_caller.id)
+            or self._join_chat(chat, user_caller.id)
+        )
+        if after_id is not None:
+            body, newest_message_id = self._messages_after_to_body(chat, messages_number, after_id)
+            if newest_message_id is not None and (
+                    newest_message_id <= (member.last_read_message_id or 0)
+            ):
+                newest_message_id = None
+        else:
+            last_connect = member.last_connect or datetime.datetime.min
+            body, newest_message_id = self._history_body(chat, last_connect, messages_number)
+        self._storage.mark_read(
+            chat.id,
+            user_caller.id,
+            newest_message_id,
+            datetime.datetime.utcnow()
+        )
+        return body
+
+    def _messages_after_to_body(
+            self,
+            chat: ChatRecord,
+            messages_number: int,
+            after_id: int
+    ) -> tuple[bytes, Optional[int]]:
+        """
+        Encoded page of the messages a reconnecting client missed after the message id,
+        "next" is the id to resume from when the page is full.
+        """
+        messages = self._storage.messages_after(chat.id, after_id, messages_number)
+        body = self._get_encode_body_from_data({
             'messages': [],
-            'unread_messages': []
-        }
-        last_messages = session.query(Message).filter(
-            Message.chat == chat,
-            Message.pub_date < last_connect
-        ).order_by(
-            desc(Message.pub_date)
-        ).limit(
-            messages_number
-        ).all()
-        unread_messages = session.query(
-            Message
-        ).filter(Message.chat == chat,
-                 Message.pub_date > last_connect).all()
-        for message in last_messages:
-            temp_dict['messages'].append(
-                self._get_message_info(message)
-            )
-        for message in unread_messages:
-            temp_dict['unread_messages'].append(
-                self._get_message_info(message)
-            )
-        chat_user_obj.last_connect = datetime.datetime.utcnow()
-        session.commit()
-        return self._get_encode_body_from_data(temp_dict)
+            'unread_messages': [self._get_message_info(message) for message in messages],
+            'next': messages[-1].id if messages and len(messages) == messages_number else None
+        })
+        return body, messages[-1].id if messages else None
 
-    def _get_public_messages(
+    def _history_body(
             self,
-            session: Session,
-            user_caller: User,
+            chat: ChatRecord,
+            last_connect: datetime.datetime,
             messages_number: int
-    ) -> bytes:
-        public_chat = session.query(Chat).filter(
-            Chat.type == ChatType.PUBLIC
-        ).filter_by(
-            name='public_chat'
-        ).first()
-        return self._messages_from_chat_to_body(session, user_caller, public_chat, messages_number)
+    ) -> tuple[bytes, Optional[int]]:
+        """
+        Encoded history for the member connected last at the moment
+        and id of the newest message in it, built from the shared window
+        of the newest messages when it holds the whole answer.
+        """
+        if coalescer := self._chat_coalescer(chat.id):
+            window = coalescer.window(
+                chat.id,
+                messages_number,
+                lambda limit: self._storage.last_messages(chat.id, datetime.datetime.max, limit)
+            )
+            if page := window.page(last_connect, messages_number):
+                key = (*page, self._response_codec)
+                if key not in window.bodies:
+                    if window.infos is None:
+                        window.infos = [
+                            self._get_message_info(message) for message in window.messages
+                        ]
+                    split, start = page
+                    window.bodies[key] = self._history_to_body(
+                        window.infos[start:start + messages_number],
+                        window.infos[split - 1::-1] if split else []
+                    )
+                return window.bodies[key]
+        last_messages = self._storage.last_messages(chat.id, last_connect, messages_number)
+        unread_messages = self._storage.unread_messages(chat.id, last_connect)
+        return self._history_to_body(
+            [self._get_message_info(message) for message in last_messages],
+            [self._get_message_info(message) for message in unread_messages]
+        )
+
+    def _history_to_body(
+            self,
+            messages: list[dict],
+            unread_messages: list[dict]
+    ) -> tuple[bytes, Optional[int]]:
+        newest_message = unread_messages[-1:] or messages[:1]
+        body = self._get_encode_body_from_data({
+            'messages': messages,
+            'unread_messages': unread_messages
+        })
+        return body, newest_message[0]['id'] if newest_message else None
+
+    def _chat_coalescer(self, chat_id: int) -> Optional[ReadCoalescer]:
+        room = self._rooms.by_chat_id(chat_id)
+        return room.coalescer if room and room.coalescer else self._coalescer
+
+    def _invalidate_history(self, chat_id: int) -> None:
+        if coalescer := self._chat_coalescer(chat_id):
+            coalescer.invalidate(chat_id)
 
     def _get_private_messages(
             self,
-            session: Session,
-            user_caller: User,
-            with_user: User,
-            messages_number: int
+            user_caller: UserRecord,
+            with_user: UserRecord,
+            messages_number: int,
+            **history_options
     ) -> bytes:
-        chat_obj = session.query(Chat).filter(
-            Chat.type == ChatType.PRIVATE
-        ).filter(
-            Chat.users.any(user_name=user_caller.user_name)
-        ).filter(
-            Chat.users.any(user_name=with_user.user_name)
-        ).first()
+        chat_obj = self._storage.get_private_chat(user_caller.id, with_user.id)
         if not chat_obj:
             temp_dict = {'messages': []}
             return self._get_encode_body_from_data(temp_dict)
         else:
-            return self._messages_from_chat_to_body(session, user_caller, chat_obj, messages_number)
+            return self._messages_from_chat_to_body(
+                user_caller,
+                chat_obj,
+                messages_number,
+                **history_options
+            )
 
     def _send_response_for_connect_endpoint(
             self,
-            user_caller: User,
+            user_caller: UserRecord,
             chat_with: str,
-            message_number: int
+            message_number: int,
+            archive: bool = False,
+            before_id: Optional[int] = None,
+            after_id: Optional[int] = None,
+            room_name: Optional[str] = None
     ) -> None:
-        with Session(engine) as session:
-            user_obj = session.query(User).filter_by(user_name=user_caller.user_name).first()
-            if chat_with == 'public_chat':
-                body = self._get_public_messages(session, user_obj, message_number)
-            else:
-                user_with = session.query(User).filter_by(user_name=chat_with).first()
-                if not user_with:
-                    self._send_error(HTTPStatus.NOT_FOUND)
-                    return
-                body = self._get_private_messages(session, user_obj, user_with, message_number)
+        history_options = {'archive': archive, 'before_id': before_id, 'after_id': after_id}
+        if room_name or chat_with == PUBLIC_CHAT_NAME:
+            room = self._rooms.get(room_name or PUBLIC_CHAT_NAME)
+            if not room:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+            body = self._messages_from_chat_to_body(
+                user_caller,
+                room.chat,
+                message_number,
+                **history_options
+            )
+        else:
+            user_with = self._storage.get_user_by_name(chat_with)
+            if not user_with:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+            body = self._get_private_messages(
+                user_caller,
+                user_with,
+                message_number,
+                **history_options
+            )
         headers = self._get_headers_for_json_body(body)
         self._send_response_with_ok_code(body=body, headers=headers)
         logger.info('Sent chat info.')
 
+    def _send_response_for_comments(
+            self,
+            user: UserRecord,
+            message_id: int,
+            limit: int,
+            after: Optional[int]
+    ) -> None:
+        try:
+            limit = min(max(int(limit), 1), 100)
+            after = int(after) if after else None
+        except (TypeError, ValueError):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        message = self._storage.get_message(message_id)
+        if not message or not self._storage.get_member(message.chat_id, user.id):
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+        comments = self._storage.comments(message.id, after, limit)
+        body = self._get_encode_body_from_data({
+            'comments': [self._get_comment_info(comment) for comment in comments],
+            'comments_number': message.comments_number,
+            'next': comments[-1].id if len(comments) == limit else None
+        })
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
+
+    def _send_response_for_search(
+            self,
+            user: UserRecord,
+            query: str,
+            limit: int,
+            after: Optional[str]
+    ) -> None:
+        try:
+            limit = min(max(int(limit), 1), 100)
+            hits = self._storage.search(user.id, query, limit, after)
+        except (TypeError, ValueError):
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        results = [
+            {
+                'type': hit.kind,
+                'id': hit.id,
+                'message_id': hit.message_id,
+                'chat_id': hit.chat_id,
+                'author': hit.author_name,
+                'text': hit.text,
+                'date': hit.created.strftime('%d.%m.%Y, %H:%M:%S')
+            }
+            for hit in hits
+        ]
+        body = self._get_encode_body_from_data({
+            'results': results,
+            'next': encode_cursor(hits[-1]) if len(hits) == limit else None
+        })
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
+
     def _send_response_for_comment(
             self,
             message_id: int,
             comment: str,
-            user: User
+            user: UserRecord
     ) -> None:
-        with Session(engine) as session:
-            user_obj = session.query(User).filter_by(user_name=user.user_name).first()
-            message = session.query(Message).filter_by(id=message_id).first()
-            if message:
-                Comment(author=user_obj, message=message, text=comment)
-                session.commit()
-                self._send_created_code('Comment have created!')
-                logger.info('Comment have created')
-            else:
-                self._send_error(HTTPStatus.BAD_REQUEST)
+        if message := self._storage.get_message(message_id):
+            self._storage.add_comment(message_id, user.id, comment, self._idempotency_key)
+            self._invalidate_history(message.chat_id)
+            self._send_created_code('Comment have created!')
+            logger.info('Comment have created')
+        else:
+            self._send_error(HTTPStatus.BAD_REQUEST)
 
     def _add_message_to_db_and_sent_response(
             self,
-            session: Session,
             message_text: str,
-            chat: Chat,
-            user: User
+            chat: ChatRecord,
+            user: UserRecord
     ) -> None:
-        self._add_message_to_db(session, message_text, chat, user)
+        self._storage.add_message(chat.id, user.id, message_text, self._idempotency_key)
+        self._invalidate_history(chat.id)
         self._send_created_code('Message have sent!')
         logger.info('Message have sent.')
 
     def _send_message_to_public_chat(
             self,
-            session: Session,
-            user_obj: User,
+            user_obj: UserRecord,
             message: str,
             public_mes_limit: int,
-            send_to: str,
+            room: Room,
             minutes_limit: int
     ) -> None:
-        public_chat = session.query(Chat).filter_by(name=send_to).first()
-        if self._is_banned(session, user_obj, public_chat):
+        public_chat = room.chat
+        if room.rate_limiter and (retry_after := room.rate_limiter.acquire(user_obj.id)):
+            self._send_error(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                [('Retry-After', str(math.ceil(retry_after)))]
+            )
             return
-        start_chatting_time = user_obj.start_chatting_in_public_chat
+        member = (
+            self._storage.get_member(public_chat.id, user_obj.id)
+            or self._join_chat(public_chat, user_obj.id)
+        )
+        if self._is_banned(member):
+            return
+        now = datetime.datetime.utcnow()
         messages_in_hour = user_obj.messages_in_hour_in_public_chat
-        finish_time = start_chatting_time + datetime.timedelta(minutes=minutes_limit)
-        if messages_in_hour >= public_mes_limit:
-            if finish_time > datetime.datetime.utcnow():
-                self._send_warning(
-                    'message limit has been reached, '
-                    f'please wait until {finish_time.strftime("%d.%m.%Y, %H:%M:%S")}'
+        finish_time = user_obj.start_chatting_in_public_chat + datetime.timedelta(
+            minutes=minutes_limit
+        )
+        if messages_in_hour >= public_mes_limit and finish_time > now:
+            self._send_warning(
+                'message limit has been reached, '
+                f'please wait until {finish_time.strftime("%d.%m.%Y, %H:%M:%S")}'
+            )
+            return
+        if not messages_in_hour or finish_time <= now:
+            user_obj.messages_in_hour_in_public_chat = 1
+            user_obj.start_chatting_in_public_chat = now
+            if self._scheduler:
+                self._scheduler.schedule(
+                    now + datetime.timedelta(minutes=minutes_limit),
+                    RATE_WINDOW
                 )
-                return
-            else:
-                user_obj.messages_in_hour_in_public_chat = 1
-                user_obj.start_chatting_in_public_chat = datetime.datetime.utcnow()
-                session.commit()
         else:
             user_obj.messages_in_hour_in_public_chat += 1
-            session.commit()
+        self._storage.save_user(user_obj)
         self._add_message_to_db_and_sent_response(
-            session=session,
             message_text=message,
             chat=public_chat,
             user=user_obj
@@ -427,107 +1156,111 @@ class HTTPProtocol(asyncio.Protocol):
 
     def _send_message_to_private_chat(
             self,
-            session: Session,
-            user_obj: User,
+            user_obj: UserRecord,
             send_to: str,
             message: str
     ) -> None:
-        send_to_user_obj = session.query(User).filter_by(user_name=send_to).first()
+        send_to_user_obj = self._storage.get_user_by_name(send_to)
         if not send_to_user_obj:
             self._send_error(HTTPStatus.NOT_FOUND)
             return
-        chat_obj = session.query(Chat).filter(
-            Chat.type == ChatType.PRIVATE,
-            Chat.users.any(user_name=user_obj.user_name),
-            Chat.users.any(user_name=send_to)
-        ).first()
+        chat_obj = self._storage.get_private_chat(user_obj.id, send_to_user_obj.id)
         if not chat_obj:
-            new_chat = Chat(name=f'private-{int(time.time())}', type=ChatType.PRIVATE)
-            new_chat.users = [user_obj, send_to_user_obj]
-            session.add(new_chat)
-            session.commit()
-            self._add_message_to_db(session, message, new_chat, user_obj)
+            new_chat = self._storage.create_private_chat(user_obj.id, send_to_user_obj.id)
+            self._add_message_to_db_and_sent_response(
+                message_text=message,
+                chat=new_chat,
+                user=user_obj
+            )
         else:
-            if self._is_banned(session, user_obj, chat_obj):
+            if self._is_banned(self._storage.get_member(chat_obj.id, user_obj.id)):
                 return
             self._add_message_to_db_and_sent_response(
-                session=session,
                 message_text=message,
                 chat=chat_obj,
                 user=user_obj
             )
 
+    def _send_response_for_multicast(
+            self,
+            user: UserRecord,
+            message: str,
+            send_to: list[str]
+    ) -> None:
+        statuses = self._storage.add_private_messages(
+            user.id,
+            send_to,
+            message,
+            self._idempotency_key
+        )
+        if self._coalescer:
+            self._coalescer.invalidate()
+        body = self._get_encode_body_from_data({
+            'info': 'Message have sent!',
+            'recipients': statuses
+        })
+        headers = self._get_headers_for_json_body(body)
+        self.send(h11.Response(status_code=HTTPStatus.CREATED, headers=headers))
+        self.send(h11.Data(data=body))
+        self.send(h11.EndOfMessage())
+        logger.info('Message have sent to %s recipients.', len(statuses))
+
     def _send_response_for_send_message(
             self,
-            user_caller: User,
+            user_caller: UserRecord,
             message: str,
             send_to: str,
             public_mes_limit: int = 20,
             minutes_limit: int = 60
     ) -> None:
-        with Session(engine) as session:
-            user_obj = session.query(User).filter_by(user_name=user_caller.user_name).first()
-            if send_to == 'public_chat':
-                self._send_message_to_public_chat(
-                    session=session,
-                    user_obj=user_obj,
-                    message=message,
-                    public_mes_limit=public_mes_limit,
-                    send_to=send_to,
-                    minutes_limit=minutes_limit
-                )
-            else:
-                self._send_message_to_private_chat(
-                    session=session,
-                    user_obj=user_obj,
-                    send_to=send_to,
-                    message=message
-                )
+        if send_to == PUBLIC_CHAT_NAME:
+            self._send_response_for_room_message(
+                user_caller,
+                message,
+                send_to,
+                public_mes_limit=public_mes_limit,
+                minutes_limit=minutes_limit
+            )
+        else:
+            self._send_message_to_private_chat(
+                user_obj=user_caller,
+                send_to=send_to,
+                message=message
+            )
 
-    def _is_banned(
+    def _send_response_for_room_message(
             self,
-            session: Session,
-            user_obj: User,
-            chat_obj: Chat
-    ) -> Optional[bool]:
-        chat_user_obj = session.query(ChatUser).filter_by(
-            chat_id=chat_obj.id
-        ).filter_by(
-            user_id=user_obj.id
-        ).first()
-        if chat_user_obj.banned:
-            if chat_user_obj.banned_till > datetime.datetime.utcnow():
-                self._send_warning('You are banned!')
-                return chat_user_obj.banned
-            chat_user_obj.banned = False
-            chat_user_obj.cautions = 0
-            session.commit()
-
-    @staticmethod
-    def _add_message_to_db(
-            session: Session,
-            message_text: str,
-            chat: Chat,
-            user: User
+            user_caller: UserRecord,
+            message: str,
+            room_name: str,
+            public_mes_limit: int = 20,
+            minutes_limit: int = 60
     ) -> None:
-        message = Message(text=message_text, author=user, chat=chat)
-        session.add(message)
-        session.commit()
-        chat_user_obj = session.query(ChatUser).filter_by(
-            chat_id=chat.id
-        ).filter_by(
-            user_id=user.id
-        ).first()
-        chat_user_obj.last_connect = datetime.datetime.utcnow()
-        session.commit()
-        logger.info('Message add to database.')
+        room = self._rooms.get(room_name)
+        if not room:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+        self._send_message_to_public_chat(
+            user_obj=user_caller,
+            message=message,
+            public_mes_limit=public_mes_limit,
+            room=room,
+            minutes_limit=minutes_limit
+        )
+
+    def _is_banned(self, member: MemberRecord) -> bool:
+        if member.banned and member.banned_till > datetime.datetime.utcnow():
+            self._send_warning('You are banned!')
+            return True
+        return False
 
     def _send_error(
             self,
-            error_code: int
+            error_code: int,
+            extra_headers: Optional[list] = None
     ) -> None:
         body = self._get_encode_body_from_data({'error': ERROR_CODE_TO_MESSAGES[error_code]})
-        headers = self._get_headers_for_json_body(body)
+        headers = self._get_headers_for_json_body(body) + (extra_headers or [])
         response = h11.Response(status_code=error_code, headers=headers)
         self.send(response)
         self.send(h11.Data(data=body))
@@ -556,49 +1289,29 @@ class HTTPProtocol(asyncio.Protocol):
             self,
             user_name: str
     ) -> None:
-        with Session(engine) as session:
-            user = session.query(User).filter_by(user_name=user_name).first()
-            if user:
-                self._send_info(MESSAGES_FOR_USER['type']['warning']['had_token'])
-            else:
-                token = [secrets.token_hex(16)]
-                while session.query(User).filter_by(token=token[0]).first():
-                    token[0] = secrets.token_hex(16)
-                new_user = User(
-                    user_name=user_name,
-                    token=token[0]
-                )
-                public_chat = session.query(Chat).filter(
-                    Chat.type == ChatType.PUBLIC
-                ).filter_by(
-                    name='public_chat'
-                ).first()
-                public_chat.users.append(new_user)
-                session.add(new_user)
-                session.commit()
-                body = self._get_encode_body_from_data({'token': token[0]})
-                headers = self._get_headers_for_json_body(body)
-                self._send_response_with_ok_code(body, headers)
-                logger.info('Token send.')
+        if self._storage.get_user_by_name(user_name):
+            self._send_info(MESSAGES_FOR_USER['type']['warning']['had_token'])
+        else:
+            new_user = self._storage.create_user(user_name)
+            body = self._get_encode_body_from_data({'token': new_user.token})
+            headers = self._get_headers_for_json_body(body)
+            self._send_response_with_ok_code(body, headers)
+            logger.info('Token send.')
 
     def _get_chat_obj(
             self,
-            session: Session,
-            user: User,
+            user: UserRecord,
             chat_type: ChatType,
-            report_on: str,
-    ) -> Optional[Chat]:
+            report_on: UserRecord,
+            room_name: str = PUBLIC_CHAT_NAME
+    ) -> Optional[ChatRecord]:
         if chat_type == ChatType.PUBLIC:
-            return session.query(Chat).filter(
-                Chat.type == ChatType.PUBLIC,
-                Chat.name == 'public_chat'
-            ).first()
+            if room := self._rooms.get(room_name):
+                return room.chat
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
         elif chat_type == ChatType.PRIVATE:
-            chat_obj = session.query(Chat).filter(
-                Chat.type == ChatType.PRIVATE,
-                Chat.users.any(user_name=report_on),
-                Chat.users.any(user_name=user.user_name)
-            ).first()
+            chat_obj = self._storage.get_private_chat(user.id, report_on.id)
             if not chat_obj:
                 self._send_warning('You can not report a user you have not chat to.')
                 return
@@ -609,62 +1322,160 @@ class HTTPProtocol(asyncio.Protocol):
 
     def _set_caution(
             self,
-            session: Session,
-            report_on_obj: User,
-            chat_obj: Chat,
+            report_on_obj: UserRecord,
+            chat_obj: ChatRecord,
             ban_hours: int
     ) -> None:
-        chat_user_obj = session.query(ChatUser).filter_by(
-            chat_id=chat_obj.id
-        ).filter_by(
-            user_id=report_on_obj.id
-        ).first()
-        if chat_user_obj.banned:
+        member = self._storage.get_member(chat_obj.id, report_on_obj.id)
+        if not member:
+            self._send_warning('User has not joined this chat.')
+            return
+        now = datetime.datetime.utcnow()
+        if member.banned and member.banned_till > now:
             self._send_created_code('User is currently banned.')
             return
-        if chat_user_obj.cautions == 2:
-            chat_user_obj.banned = True
-            chat_user_obj.banned_till = (
-                    datetime.datetime.utcnow() + datetime.timedelta(hours=ban_hours)
-            )
-            session.commit()
+        if member.banned:
+            member.banned = False
+            member.cautions = 0
+        if member.cautions == 2:
+            member.banned = True
+            member.banned_till = now + datetime.timedelta(hours=ban_hours)
+            if self._scheduler:
+                self._scheduler.schedule(member.banned_till, BAN_EXPIRY)
         else:
-            chat_user_obj.cautions += 1
-            session.commit()
+            member.cautions += 1
+        self._storage.save_member(member)
         self._send_created_code('Report sent success.')
         logger.info('Add caution/report.')
 
     def _send_response_for_report(
             self,
-            user: User,
+            user: UserRecord,
             chat_type: ChatType,
             report_on: str,
-            ban_hours: int = 4
+            ban_hours: int = 4,
+            room_name: str = PUBLIC_CHAT_NAME
     ) -> None:
-        with Session(engine) as session:
-            report_on_obj = session.query(User).filter_by(user_name=report_on).first()
-            if not report_on_obj:
-                self._send_error(HTTPStatus.BAD_REQUEST)
-                return
-            chat_obj = self._get_chat_obj(
-                session=session,
-                user=user,
-                chat_type=chat_type,
-                report_on=report_on
-            )
-            if not chat_obj:
-                return
-            self._set_caution(
-                session=session,
-                report_on_obj=report_on_obj,
-                chat_obj=chat_obj,
-                ban_hours=ban_hours
-            )
+        report_on_obj = self._storage.get_user_by_name(report_on)
+        if not report_on_obj:
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+        chat_obj = self._get_chat_obj(
+            user=user,
+            chat_type=chat_type,
+            report_on=report_on_obj,
+            room_name=room_name
+        )
+        if not chat_obj:
+            return
+        self._set_caution(
+            report_on_obj=report_on_obj,
+            chat_obj=chat_obj,
+            ban_hours=ban_hours
+        )
 
     @staticmethod
-    def _get_headers_for_json_body(body: bytes) -> list[tuple]:
+    def _get_room_info(room: Room) -> dict:
+        return {
+            'name': room.chat.name,
+            'created': room.chat.created.strftime('%d.%m.%Y, %H:%M:%S')
+        }
+
+    def _send_response_for_rooms(self) -> None:
+        body = self._get_encode_body_from_data({
+            'rooms': [self._get_room_info(room) for room in self._rooms.rooms()]
+        })
+        headers = self._get_headers_for_json_body(body)
+        self._send_response_with_ok_code(body, headers)
+
+    def _send_response_for_create_room(self, user: UserRecord, name: str) -> None:
+        room = self._rooms.create(name)
+        if not room:
+            self._send_error(HTTPStatus.CONFLICT)
+            return
+        self._storage.join_chat(room.chat.id, user.id)
+        body = self._get_encode_body_from_data({
+            'info': 'Room have created!',
+            'room': self._get_room_info(room)
+        })
+        headers = self._get_headers_for_json_body(body)
+        self.send(h11.Response(status_code=HTTPStatus.CREATED, headers=headers))
+        self.send(h11.Data(data=body))
+        self.send(h11.EndOfMessage())
+        logger.info('Room have created.')
+
+    def _send_response_for_join_room(self, user: UserRecord, name: str) -> None:
+        room = self._rooms.get(name)
+        if not room:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+        if not self._storage.get_member(room.chat.id, user.id):
+            self._join_chat(room.chat, user.id)
+        self._send_info('You have joined the room.')
+
+    def _send_response_for_export(self, user: UserRecord, room_name: str, user_name: str) -> None:
+        """
+        Start streaming the chat, a public room or the private chat with the user,
+        as NDJSON: one message with all its comments per line.
+        """
+        chat = None
+        if room_name:
+            if room := self._rooms.get(room_name):
+                chat = room.chat
+        elif user_with := self._storage.get_user_by_name(user_name):
+            chat = self._storage.get_private_chat(user.id, user_with.id)
+        if not chat:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send(h11.Response(status_code=HTTPStatus.OK, headers=[
+            ('Content-Type', NDJSON_CONTENT_TYPE),
+            ('Transfer-Encoding', 'chunked')
+        ]))
+        self._export = (chat.id, 0)
+        self._schedule_export()
+        logger.info('Started export of chat %s.', chat.id)
+
+    def _schedule_export(self) -> None:
+        if not self._export_scheduled and not self._writing_paused:
+            self._export_scheduled = True
+            asyncio.get_running_loop().call_soon(self._export_batch)
+
+    def _export_batch(self) -> None:
+        """
+        Write the next batch of the export as one chunk. The next batch is read
+        only when the transport takes more data, so a slow reader holds at most
+        the write buffer and one batch in memory.
+        """
+        self._export_scheduled = False
+        if self._export is None:
+            return
+        if self._transport.is_closing():
+            self._export = None
+            return
+        chat_id, after_id = self._export
+        messages = self._storage.export_messages(chat_id, after_id, EXPORT_BATCH_SIZE)
+        if messages:
+            self._export = (chat_id, messages[-1].id)
+            self.send(h11.Data(data=b''.join(
+                json.dumps(
+                    self._get_message_info(message),
+                    ensure_ascii=False,
+                    separators=(',', ':')
+                ).encode('utf-8') + b'\n'
+                for message in messages
+            )))
+            if self._registered:
+                self._last_activity = self._connections.time()
+        if len(messages) < EXPORT_BATCH_SIZE:
+            self._export = None
+            self.send(h11.EndOfMessage())
+            self._continue_connection()
+        else:
+            self._schedule_export()
+
+    def _get_headers_for_json_body(self, body: bytes) -> list[tuple]:
         return [
-            ('Content-Type', 'application/json'),
+            ('Content-Type', self._response_codec.content_type),
             ('Content-Length', str(len(body))),
         ]
 
@@ -680,8 +1491,36 @@ class HTTPProtocol(asyncio.Protocol):
         self.send(h11.EndOfMessage())
         logger.info(f'Send {HTTPStatus.CREATED} code')
 
-    @staticmethod
-    def _get_encode_body_from_data(data: dict) -> bytes:
-        return json.dumps(
-            data, indent=4, separators=(',', ': ')
-        ).encode('utf-8')
+    def _get_encode_body_from_data(self, data: dict) -> bytes:
+        if self._captured is not None:
+            self._captured.data = data
+        return self._response_codec.encode(data)
+
+
+router = Router()
+router.add(b'POST', b'/get-token', HTTPProtocol._token_endpoint_processing, auth=False)
+router.add(b'POST', b'/connect', HTTPProtocol._connect_endpoint_processing, expensive=True)
+router.add(b'POST', b'/send', HTTPProtocol._send_endpoint_processing, idempotent=True)
+router.add(b'POST', b'/comment', HTTPProtocol._comment_endpoint_processing, idempotent=True)
+router.add(b'POST', b'/report', HTTPProtocol._report_endpoint_processing, idempotent=True)
+router.add(b'POST', b'/comments', HTTPProtocol._comments_endpoint_processing, expensive=True)
+router.add(b'POST', b'/search', HTTPProtocol._search_endpoint_processing, expensive=True)
+router.add(
+    b'POST',
+    b'/admin/users',
+    HTTPProtocol._users_endpoint_processing,
+    auth=False,
+    expensive=True
+)
+router.add(b'GET', b'/status', HTTPProtocol._status_endpoint_processing)
+router.add(b'GET', b'/presence', HTTPProtocol._presence_endpoint_processing)
+router.add(b'GET', b'/unread', HTTPProtocol._unread_endpoint_processing)
+router.add(b'GET', b'/rooms', HTTPProtocol._rooms_endpoint_processing)
+router.add(b'GET', b'/export', HTTPProtocol._export_endpoint_processing, expensive=True)
+router.add(b'POST', b'/rooms', HTTPProtocol._create_room_endpoint_processing, idempotent=True)
+router.add(
+    b'POST',
+    b'/rooms/join',
+    HTTPProtocol._join_room_endpoint_processing,
+    idempotent=True
+)
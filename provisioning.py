@@ -0,0 +1,102 @@
+import argparse
+import csv
+import json
+import os
+from typing import Iterable, Iterator
+
+from database import DatabaseSettings, create_db_engine
+from storage import SQLStorage, Storage, UserRecord
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+TOKENS_FILE = 'client.txt'
+
+
+def is_valid_user_name(user_name: str) -> bool:
+    """
+    Names are separated from tokens by whitespace in the tokens file,
+    so a name can not be empty or contain whitespace.
+    """
+    return bool(user_name) and not any(char.isspace() for char in user_name)
+
+
+def read_user_names(path: str) -> Iterator[str]:
+    """
+    User names from a CSV file with the "user_name" column (the first column without header)
+    or from a JSONL file with {"user_name": ...} objects.
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)['user_name']
+            return
+        rows = csv.reader(file)
+        header = next(rows, [])
+        column = header.index('user_name') if 'user_name' in header else 0
+        if 'user_name' not in header and header:
+            yield header[column]
+        for row in rows:
+            if row and row[column]:
+                yield row[column]
+
+
+def _chunks(items: Iterable[str], size: int) -> Iterator[list[str]]:
+    chunk = []
+    for item in items:
+        user_name = item.strip()
+        if not is_valid_user_name(user_name):
+            logger.warning('Skip invalid user name %r.', user_name)
+            continue
+        chunk.append(user_name)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def provision_users(
+        storage: Storage,
+        user_names: Iterable[str],
+        chunk_size: int = 1000
+) -> Iterator[UserRecord]:
+    """
+    Create users chunk by chunk, every chunk is one transaction.
+    Names containing whitespace are skipped.
+    """
+    created = 0
+    for chunk in _chunks(user_names, chunk_size):
+        users = storage.create_users(chunk)
+        created += len(users)
+        logger.info('Provisioned %s users.', created)
+        yield from users
+
+
+def write_tokens(users: Iterable[UserRecord], path: str = TOKENS_FILE) -> int:
+    """
+    Append issued tokens to the file in the client.txt format.
+    """
+    written = 0
+    with open(path, 'a', encoding='utf-8') as file:
+        for user in users:
+            print(f'{user.user_name} {user.token}', file=file)
+            written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create users in bulk from a CSV or JSONL file.')
+    parser.add_argument('users_file')
+    parser.add_argument('--tokens-file', default=TOKENS_FILE)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--db-url')
+    args = parser.parse_args()
+    engine = create_db_engine(DatabaseSettings(url=args.db_url))
+    issued = write_tokens(
+        provision_users(SQLStorage(engine), read_user_names(args.users_file), args.chunk_size),
+        args.tokens_file
+    )
+    logger.info('%s tokens written to %s.', issued, args.tokens_file)
@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from http import HTTPStatus
+from typing import Iterable, Optional
+
+import h11
+
+from capture import REDACTED, read_capture
+from provisioning import TOKENS_FILE
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+
+def read_tokens(path: str = TOKENS_FILE) -> dict[str, str]:
+    """
+    Tokens by user name from a file in the client.txt format.
+    """
+    tokens = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    user_name, token = line.split()
+                    tokens[user_name] = token
+    return tokens
+
+
+class ReplayConnection:
+    """
+    Keep-alive connection to the replayed server, reopened when the server closes it.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._connection = None
+        self._reader = None
+        self._writer = None
+
+    async def _open(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._connection = h11.Connection(h11.CLIENT)
+
+    def close(self) -> None:
+        if self._writer:
+            self._writer.close()
+        self._writer = None
+
+    async def request(
+            self,
+            method: str,
+            target: str,
+            headers: list,
+            body: bytes
+    ) -> tuple[Optional[int], float, bytes]:
+        """
+        Response status, None if the connection failed, latency in seconds and response body.
+        A request failed on a reused connection, closed by the server while idle,
+        is sent once more on a new connection.
+        """
+        reused = self._writer is not None
+        result = await self._request(method, target, headers, body)
+        if result[0] is None and reused:
+            result = await self._request(method, target, headers, body)
+        return result
+
+    async def _request(
+            self,
+            method: str,
+            target: str,
+            headers: list,
+            body: bytes
+    ) -> tuple[Optional[int], float, bytes]:
+        if self._writer is None:
+            await self._open()
+        connection = self._connection
+        started = time.perf_counter()
+        try:
+            self._send(method, target, headers, body)
+            status, response_body = await self._read_response()
+        except (ConnectionError, h11.ProtocolError) as error:
+            logger.debug('Replayed %s %s failed: %s', method, target, error)
+            status, response_body = None, b''
+        latency = time.perf_counter() - started
+        if connection.our_state is h11.DONE and connection.their_state is h11.DONE:
+            connection.start_next_cycle()
+        else:
+            self.close()
+        return status, latency, response_body
+
+    def _send(self, method: str, target: str, headers: list, body: bytes) -> None:
+        connection = self._connection
+        data = connection.send(h11.Request(method=method, target=target, headers=headers))
+        if body:
+            data += connection.send(h11.Data(data=body))
+        data += connection.send(h11.EndOfMessage())
+        self._writer.write(data)
+
+    async def _read_response(self) -> tuple[Optional[int], bytes]:
+        connection = self._connection
+        status = None
+        response_body = bytearray()
+        while True:
+            event = connection.next_event()
+            if event is h11.NEED_DATA:
+                connection.receive_data(await self._reader.read(65536))
+            elif isinstance(event, h11.Response):
+                status = event.status_code
+            elif isinstance(event, h11.Data):
+                response_body += event.data
+            elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                return status, bytes(response_body)
+
+
+class Replayer:
+    """
+    Sends captured requests to a server keeping their original spacing,
+    scaled by the speed, or as fast as the connections allow.
+    Redacted tokens are replaced by tokens of the same users from the tokens file,
+    users without a token get one from /get-token before the replay.
+    """
+
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 8000,
+            speed: Optional[float] = 1.0,
+            connections: int = 8,
+            tokens: Optional[dict[str, str]] = None,
+            admin_token: Optional[str] = None
+    ) -> None:
+        """
+        :param host: replayed server host;
+        :param port: replayed server port;
+        :param speed: time scale, 2.0 replays twice as fast, as fast as possible if None;
+        :param connections: concurrent connections to the server;
+        :param tokens: tokens by user name;
+        :param admin_token: token of the admin endpoints.
+        """
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.connections = connections
+        self.tokens = dict(tokens or {})
+        self.admin_token = admin_token
+
+    def _headers(self, entry: dict) -> list[tuple[str, str]]:
+        headers = []
+        for name, value in entry['h']:
+            if name.lower() == 'connection':
+                continue
+            if value == REDACTED:
+                token = self.tokens.get(entry['u']) if 'u' in entry else self.admin_token
+                if not token:
+                    continue
+                value = f'Bearer {token}'
+            headers.append((name, value))
+        return headers
+
+    async def _issue_tokens(self, user_names: Iterable[str]) -> None:
+        connection = ReplayConnection(self.host, self.port)
+        for user_name in user_names:
+            body = json.dumps({'user_name': user_name}).encode('utf-8')
+            status, _, response_body = await connection.request('POST', '/get-token', [
+                ('Host', self.host),
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body)))
+            ], body)
+            if status == HTTPStatus.OK and (token := json.loads(response_body).get('token')):
+                self.tokens[user_name] = token
+            else:
+                logger.warning('No token for %s, requests are replayed unauthorized.', user_name)
+        connection.close()
+
+    async def _worker(self, queue: asyncio.Queue, results: list) -> None:
+        connection = ReplayConnection(self.host, self.port)
+        while (entry := await queue.get()) is not None:
+            status, latency, _ = await connection.request(
+                entry['m'],
+                entry['p'],
+                self._headers(entry),
+                entry['b']
+            )
+            results.append((entry, status, latency))
+        connection.close()
+
+    async def replay(self, entries: list[dict]) -> list[tuple[dict, Optional[int], float]]:
+        """
+        Replay the captured requests, returns them with the replayed status and latency.
+        """
+        await self._issue_tokens(dict.fromkeys(
+            entry['u'] for entry in entries
+            if 'u' in entry and entry['u'] not in self.tokens
+        ))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.connections * 2)
+        results = []
+        workers = [
+            asyncio.create_task(self._worker(queue, results))
+            for _ in range(self.connections)
+        ]
+        started = loop.time()
+        offset = previous = 0.0
+        for entry in entries:
+            if entry['t'] < previous:
+                offset += previous
+            previous = entry['t']
+            if self.speed:
+                delay = started + (offset + entry['t']) / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await queue.put(entry)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        return results
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def latency_report(results: Iterable[tuple[dict, Optional[int], float]]) -> dict[str, dict]:
+    """
+    Captured and replayed latency percentiles in ms by endpoint (method and path).
+    """
+    endpoints = {}
+    for entry, status, latency in results:
+        endpoint = f"{entry['m']} {entry['p'].partition('?')[0]}"
+        captured, replayed, mismatches = endpoints.setdefault(endpoint, ([], [], [0]))
+        captured.append(entry['d'])
+        replayed.append(latency * 1000)
+        mismatches[0] += status != entry['s']
+    report = {}
+    for endpoint, (captured, replayed, mismatches) in sorted(endpoints.items()):
+        report[endpoint] = {
+            'requests': len(captured),
+            'status_mismatches': mismatches[0],
+            **{
+                f'{name}_p{percent}': round(_percentile(values, percent), 3)
+                for percent in (50, 95)
+                for name, values in (('captured', captured), ('replayed', replayed))
+            }
+        }
+        report[endpoint]['p50_diff'] = round(
+            report[endpoint]['replayed_p50'] - report[endpoint]['captured_p50'], 3
+        )
+    return report
+
+
+def format_report(report: dict[str, dict]) -> str:
+    lines = [
+        f'{"endpoint":<24}{"requests":>9}{"captured p50":>14}{"replayed p50":>14}'
+        f'{"diff p50":>10}{"captured p95":>14}{"replayed p95":>14}{"status diff":>13}'
+    ]
+    for endpoint, row in report.items():
+        lines.append(
+            f'{endpoint:<24}{row["requests"]:>9}{row["captured_p50"]:>14.2f}'
+            f'{row["replayed_p50"]:>14.2f}{row["p50_diff"]:>+10.2f}{row["captured_p95"]:>14.2f}'
+            f'{row["replayed_p95"]:>14.2f}{row["status_mismatches"]:>13}'
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay requests captured by server.py --capture-file and compare latency.'
+    )
+    parser.add_argument('capture_file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--max-speed', action='store_true')
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--tokens-file', default=TOKENS_FILE)
+    parser.add_argument('--admin-token', default=os.environ.get('MESSENGER_ADMIN_TOKEN'))
+    args = parser.parse_args()
+    replayer = Replayer(
+        host=args.host,
+        port=args.port,
+        speed=None if args.max_speed else args.speed,
+        connections=args.connections,
+        tokens=read_tokens(args.tokens_file),
+        admin_token=args.admin_token
+    )
+    results = asyncio.run(replayer.replay(list(read_capture(args.capture_file))))
+    print(format_report(latency_report(results)))
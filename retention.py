@@ -0,0 +1,243 @@
+import asyncio
+import datetime
+from typing import Optional
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        Text, delete, func, select)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+
+from database import DatabaseSettings, create_db_engine
+from enums import ChatType
+from models import Chat, ChatArchive, Comment, Message, User
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+archive_metadata = MetaData()
+
+archived_messages = Table(
+    'messages',
+    archive_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('chat_id', Integer, index=True),
+    Column('author_id', Integer),
+    Column('author_name', String),
+    Column('text', Text),
+    Column('pub_date', DateTime(timezone=True)),
+)
+
+archived_comments = Table(
+    'comments',
+    archive_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('message_id', Integer, index=True),
+    Column('author_id', Integer),
+    Column('author_name', String),
+    Column('text', Text),
+    Column('created', DateTime(timezone=True)),
+)
+
+
+def create_archive_engine(url: str) -> Engine:
+    """
+    Engine of the archive database, missing tables and columns are created.
+    """
+    archive_engine = create_db_engine(DatabaseSettings(url=url))
+    archive_metadata.create_all(archive_engine)
+    with archive_engine.begin() as connection:
+        columns = {row[1] for row in connection.exec_driver_sql('PRAGMA table_info(comments)')}
+        if 'author_name' not in columns:
+            connection.exec_driver_sql('ALTER TABLE comments ADD COLUMN author_name VARCHAR')
+    return archive_engine
+
+
+class RetentionJob:
+    """
+    Moves messages older than the retention of their chat type,
+    together with their comments, into the archive database.
+    Batches run in the executor and never block the event loop.
+    """
+
+    def __init__(
+            self,
+            engine: Engine,
+            archive_engine: Engine,
+            retention: dict[ChatType, datetime.timedelta],
+            batch_size: int = 500,
+            interval: float = 3600.0,
+            batch_pause: float = 0.1,
+            vacuum_pages: int = 1000
+    ) -> None:
+        """
+        :param engine: main database engine;
+        :param archive_engine: archive database engine;
+        :param retention: how long messages are kept per chat type, types without retention are kept forever;
+        :param batch_size: messages moved per transaction;
+        :param interval: seconds between retention runs;
+        :param batch_pause: seconds between batches;
+        :param vacuum_pages: pages freed per incremental vacuum step.
+        """
+        self.engine = engine
+        self.archive_engine = archive_engine
+        self.retention = retention
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        ChatArchive.__table__.create(engine, checkfirst=True)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception('Retention run failed.')
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        loop = asyncio.get_running_loop()
+        moved = 0
+        for chat_type, keep_for in self.retention.items():
+            cutoff = datetime.datetime.utcnow() - keep_for
+            while True:
+                batch = await loop.run_in_executor(None, self.archive_batch, chat_type, cutoff)
+                moved += batch
+                if batch < self.batch_size:
+                    break
+                await asyncio.sleep(self.batch_pause)
+        if moved:
+            logger.info('Archived %s messages.', moved)
+            while await loop.run_in_executor(None, self.vacuum_step):
+                await asyncio.sleep(self.batch_pause)
+        return moved
+
+    def archive_batch(self, chat_type: ChatType, cutoff: datetime.datetime) -> int:
+        """
+        Move one batch of expired messages, returns number of moved messages.
+        Messages and comments are copied to the archive before they are deleted,
+        so a batch interrupted between the two steps is repeated safely.
+        Comments are copied in the transaction deleting the batch.
+        """
+        with self.engine.connect() as connection:
+            messages = connection.execute(
+                select(
+                    Message.id,
+                    Message.chat_id,
+                    Message.author_id,
+                    User.user_name.label('author_name'),
+                    Message.text,
+                    Message.pub_date
+                ).join(
+                    Chat, Chat.id == Message.chat_id
+                ).outerjoin(
+                    User, User.id == Message.author_id
+                ).where(
+                    Chat.type == chat_type,
+                    Message.pub_date < cutoff
+                ).order_by(
+                    Message.id
+                ).limit(
+                    self.batch_size
+                )
+            ).mappings().all()
+            if not messages:
+                return 0
+        message_ids = [message['id'] for message in messages]
+        with self.archive_engine.begin() as archive_connection:
+            archive_connection.execute(
+                insert(archived_messages).on_conflict_do_nothing(),
+                [dict(message) for message in messages]
+            )
+
+        archived_till = {}
+        for message in messages:
+            chat_stats = archived_till.setdefault(message['chat_id'], [message['pub_date'], 0])
+            chat_stats[0] = max(chat_stats[0], message['pub_date'])
+            chat_stats[1] += 1
+        with self.engine.begin() as connection:
+            # the delete takes the write lock first, no comment can be added
+            # to the batch between the copy of its comments and their delete
+            connection.execute(delete(Message).where(Message.id.in_(message_ids)))
+            self._archive_comments(connection, message_ids)
+            for chat_id, (till, number) in archived_till.items():
+                self._update_marker(connection, chat_id, till, number)
+        return len(messages)
+
+    def _archive_comments(self, connection, message_ids: list[int]) -> None:
+        comments = connection.execute(
+            select(
+                Comment.id,
+                Comment.message_id,
+                Comment.author_id,
+                User.user_name.label('author_name'),
+                Comment.text,
+                Comment.created
+            ).outerjoin(
+                User, User.id == Comment.author_id
+            ).where(Comment.message_id.in_(message_ids))
+        ).mappings().all()
+        if comments:
+            with self.archive_engine.begin() as archive_connection:
+                archive_connection.execute(
+                    insert(archived_comments).on_conflict_do_nothing(),
+                    [dict(comment) for comment in comments]
+                )
+        connection.execute(delete(Comment).where(Comment.message_id.in_(message_ids)))
+
+    @staticmethod
+    def _update_marker(connection, chat_id: int, till: datetime.datetime, number: int) -> None:
+        statement = insert(ChatArchive).values(
+            chat_id=chat_id,
+            archived_till=till,
+            messages_number=number
+        )
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[ChatArchive.chat_id],
+            set_={
+                'archived_till': func.max(
+                    ChatArchive.archived_till,
+                    statement.excluded.archived_till
+                ),
+                'messages_number': ChatArchive.messages_number + statement.excluded.messages_number
+            }
+        ))
+
+    def vacuum_step(self) -> bool:
+        """
+        Free a part of unused pages, returns True while pages are left.
+        """
+        with self.engine.connect() as connection:
+            if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+                logger.warning('auto_vacuum is not INCREMENTAL, run VACUUM once to enable it.')
+                return False
+            connection.exec_driver_sql(f'PRAGMA incremental_vacuum({self.vacuum_pages})')
+            return bool(connection.exec_driver_sql('PRAGMA freelist_count').scalar())
+
+
+def archived_history(
+        archive_engine: Engine,
+        chat_id: int,
+        before_id: Optional[int],
+        limit: int
+) -> tuple[list, dict]:
+    """
+    Archived messages of the chat, newest first, with their comments by message id.
+    """
+    query = select(archived_messages).where(archived_messages.c.chat_id == chat_id)
+    if before_id:
+        query = query.where(archived_messages.c.id < before_id)
+    with archive_engine.connect() as connection:
+        messages = connection.execute(
+            query.order_by(archived_messages.c.id.desc()).limit(limit)
+        ).mappings().all()
+        comments = {}
+        if messages:
+            for comment in connection.execute(
+                    select(archived_comments).where(
+                        archived_comments.c.message_id.in_([message['id'] for message in messages])
+                    ).order_by(archived_comments.c.id)
+            ).mappings():
+                comments.setdefault(comment['message_id'], []).append(comment)
+    return messages, comments
@@ -0,0 +1,95 @@
+from typing import Optional
+
+from coalescing import ReadCoalescer
+from router import RateLimiter
+from storage import ChatRecord, Storage
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+MAX_ROOM_NAME_LENGTH = 64
+
+
+class Room:
+    __slots__ = ('chat', 'rate_limiter', 'coalescer')
+
+    def __init__(
+            self,
+            chat: ChatRecord,
+            rate_limiter: Optional[RateLimiter],
+            coalescer: Optional[ReadCoalescer]
+    ) -> None:
+        self.chat = chat
+        self.rate_limiter = rate_limiter
+        self.coalescer = coalescer
+
+
+class RoomDirectory:
+    """
+    Public rooms by name and chat id, read from the storage once and kept in memory.
+    Every room has its own message rate limiter and history read cache,
+    so a busy room neither throttles nor evicts the others.
+    Rooms created by another process are found on the first lookup by name.
+    """
+
+    def __init__(
+            self,
+            storage: Storage,
+            message_rate: Optional[float] = None,
+            message_burst: int = 5,
+            coalesce_reads: bool = False
+    ) -> None:
+        """
+        :param storage: storage of the rooms;
+        :param message_rate: messages per second a user can send to one room,
+            unlimited if omitted;
+        :param message_burst: messages a user can send to one room at once;
+        :param coalesce_reads: share history reads of a room between connections.
+        """
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.coalesce_reads = coalesce_reads
+        self._storage = storage
+        self._rooms = None
+        self._rooms_by_id = {}
+
+    def _load(self) -> dict[str, Room]:
+        if self._rooms is None:
+            self._rooms = {}
+            for chat in self._storage.public_chats():
+                self._add(chat)
+            logger.info('Loaded %s rooms.', len(self._rooms))
+        return self._rooms
+
+    def _add(self, chat: ChatRecord) -> Room:
+        room = Room(
+            chat,
+            RateLimiter(self.message_rate, self.message_burst) if self.message_rate else None,
+            ReadCoalescer() if self.coalesce_reads else None
+        )
+        self._rooms[chat.name] = room
+        self._rooms_by_id[chat.id] = room
+        return room
+
+    def get(self, name: str) -> Optional[Room]:
+        rooms = self._load()
+        if room := rooms.get(name):
+            return room
+        if chat := self._storage.get_public_chat(name):
+            return self._add(chat)
+
+    def by_chat_id(self, chat_id: int) -> Optional[Room]:
+        self._load()
+        return self._rooms_by_id.get(chat_id)
+
+    def create(self, name: str) -> Optional[Room]:
+        """
+        Create the room, None if the name is taken.
+        """
+        if self.get(name):
+            return None
+        return self._add(self._storage.create_public_chat(name))
+
+    def rooms(self) -> list[Room]:
+        return sorted(self._load().values(), key=lambda room: room.chat.id)
@@ -0,0 +1,141 @@
+import time
+from http import HTTPStatus
+from typing import Callable, Optional
+
+import h11
+
+
+class Route:
+    __slots__ = ('method', 'path', 'handler', 'auth', 'idempotent', 'expensive')
+
+    def __init__(
+            self,
+            method: bytes,
+            path: bytes,
+            handler: Callable,
+            auth: bool,
+            idempotent: bool = False,
+            expensive: bool = False
+    ) -> None:
+        self.method = method
+        self.path = path
+        self.handler = handler
+        self.auth = auth
+        self.idempotent = idempotent
+        self.expensive = expensive
+
+
+class RequestContext:
+    """
+    Request passed through the middleware chain to the endpoint handler.
+    """
+    __slots__ = ('event', 'route', 'path', 'query', 'body', 'data', 'user')
+
+    def __init__(
+            self,
+            event: h11.Request,
+            route: Route,
+            path: bytes,
+            query: bytes,
+            body: bytes
+    ) -> None:
+        self.event = event
+        self.route = route
+        self.path = path
+        self.query = query
+        self.body = body
+        self.data = {}
+        self.user = None
+
+
+class Router:
+    """
+    Routes requests with one dict lookup on (method, path).
+    """
+
+    def __init__(self) -> None:
+        self._routes = {}
+        self._methods = {}
+
+    def add(
+            self,
+            method: bytes,
+            path: bytes,
+            handler: Callable,
+            auth: bool = True,
+            idempotent: bool = False,
+            expensive: bool = False
+    ) -> None:
+        """
+        :param method: http method;
+        :param path: request path without query string;
+        :param handler: endpoint handler called with the protocol and the request context;
+        :param auth: handler needs an authorized user;
+        :param idempotent: write repeated with the same Idempotency-Key header
+            gets the first response;
+        :param expensive: handler reads a lot, its requests are admitted
+            by the expensive endpoints queue.
+        """
+        self._routes[(method, path)] = Route(method, path, handler, auth, idempotent, expensive)
+        self._methods.setdefault(path, []).append(method)
+
+    @staticmethod
+    def split_target(target: bytes) -> tuple[bytes, bytes]:
+        path, _, query = target.partition(b'?')
+        return path, query
+
+    def allowed_methods(self, path: bytes) -> list[bytes]:
+        return self._methods.get(path, [])
+
+    def resolve(
+            self,
+            method: bytes,
+            path: bytes
+    ) -> tuple[Optional[Route], Optional[HTTPStatus]]:
+        """
+        Route of the request, or the error status if there is no route.
+        """
+        if route := self._routes.get((method, path)):
+            return route, None
+        if path in self._methods:
+            return None, HTTPStatus.METHOD_NOT_ALLOWED
+        return None, HTTPStatus.NOT_FOUND
+
+
+class RateLimiter:
+    """
+    Token bucket per client, refilled continuously at the given rate.
+    """
+
+    def __init__(self, rate: float, burst: int = 20, max_clients: int = 100000) -> None:
+        """
+        :param rate: requests per second allowed to each client;
+        :param burst: requests a client can make at once after being idle;
+        :param max_clients: tracked clients, idle buckets are dropped above it.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}
+
+    def acquire(self, client) -> float:
+        """
+        Take a token for the client, returns 0 or seconds until a token is available.
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+        if client not in self._buckets and len(self._buckets) >= self.max_clients:
+            self._drop_full_buckets(now)
+        self._buckets[client] = (tokens - 1, now)
+        return 0.0
+
+    def _drop_full_buckets(self, now: float) -> None:
+        self._buckets = {
+            client: (tokens, updated)
+            for client, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.rate < self.burst
+        }
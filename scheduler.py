@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+import heapq
+from typing import Optional
+
+from storage import Storage
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+BAN_EXPIRY = 'ban_expiry'
+RATE_WINDOW = 'rate_window'
+
+
+class ModerationScheduler:
+    """
+    Expires bans and rolls public chat rate windows at their deadlines.
+    Deadlines wait in a min-heap, every due kind of deadline is applied
+    to all members or users at once by one bulk update.
+    """
+
+    def __init__(
+            self,
+            storage: Storage,
+            rate_window: datetime.timedelta = datetime.timedelta(minutes=60),
+            resolution: float = 1.0,
+            max_sleep: float = 60.0
+    ) -> None:
+        """
+        :param storage: storage of members and users;
+        :param rate_window: length of the public chat rate window;
+        :param resolution: seconds deadlines are rounded up to, close deadlines share one update;
+        :param max_sleep: seconds between checks of the storage for deadlines set elsewhere.
+        """
+        self.storage = storage
+        self.rate_window = rate_window
+        self.resolution = resolution
+        self.max_sleep = max_sleep
+        self._heap = []
+        self._scheduled = set()
+        self._wakeup = None
+
+    def schedule(self, deadline: datetime.datetime, kind: str) -> None:
+        step = datetime.timedelta(seconds=self.resolution)
+        deadline = datetime.datetime.min + -(-(deadline - datetime.datetime.min) // step) * step
+        if (deadline, kind) in self._scheduled:
+            return
+        self._scheduled.add((deadline, kind))
+        heapq.heappush(self._heap, (deadline, kind))
+        if self._wakeup and self._heap[0] == (deadline, kind):
+            self._wakeup.set()
+
+    def _schedule_from_storage(self) -> None:
+        if ban_expiry := self.storage.next_ban_expiry():
+            self.schedule(ban_expiry, BAN_EXPIRY)
+        if window_start := self.storage.next_rate_window_start():
+            self.schedule(window_start + self.rate_window, RATE_WINDOW)
+
+    def run_due(self, now: Optional[datetime.datetime] = None) -> dict[str, int]:
+        """
+        Apply deadlines due at the moment, returns number of updated rows by kind.
+        """
+        now = now or datetime.datetime.utcnow()
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            deadline = heapq.heappop(self._heap)
+            self._scheduled.discard(deadline)
+            due.add(deadline[1])
+        updated = {}
+        if BAN_EXPIRY in due:
+            updated[BAN_EXPIRY] = self.storage.expire_bans(now)
+        if RATE_WINDOW in due:
+            updated[RATE_WINDOW] = self.storage.reset_rate_windows(now - self.rate_window)
+        if any(updated.values()):
+            logger.info('Moderation deadlines applied: %s', updated)
+        self._schedule_from_storage()
+        return updated
+
+    def _sleep_time(self) -> float:
+        if not self._heap:
+            return self.max_sleep
+        delay = (self._heap[0][0] - datetime.datetime.utcnow()).total_seconds()
+        return min(max(delay, 0.0), self.max_sleep)
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._schedule_from_storage()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._sleep_time())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception('Moderation scheduler run failed.')
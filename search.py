@@ -0,0 +1,208 @@
+import argparse
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import DateTime, text
+from sqlalchemy.engine import Engine
+
+from database import DatabaseSettings, create_db_engine
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+MESSAGE_KIND = 'message'
+COMMENT_KIND = 'comment'
+
+_TERM = re.compile(r'\w+')
+
+SEARCH_INDEX_DDL = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        text,
+        message_id UNINDEXED,
+        chat_id UNINDEXED
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO search_index(rowid, text, message_id, chat_id)
+        VALUES (new.id * 2, new.text, new.id, new.chat_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_search_update AFTER UPDATE OF text ON messages BEGIN
+        UPDATE search_index SET text = new.text WHERE rowid = new.id * 2;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS comments_search_insert AFTER INSERT ON comments BEGIN
+        INSERT INTO search_index(rowid, text, message_id, chat_id)
+        VALUES (
+            new.id * 2 + 1,
+            new.text,
+            new.message_id,
+            (SELECT chat_id FROM messages WHERE id = new.message_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS comments_search_update AFTER UPDATE OF text ON comments BEGIN
+        UPDATE search_index SET text = new.text WHERE rowid = new.id * 2 + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS comments_search_delete AFTER DELETE ON comments BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END
+    """,
+)
+
+SEARCH_QUERY = text(
+    """
+    SELECT
+        search_index.rowid AS rowid,
+        search_index.message_id AS message_id,
+        search_index.chat_id AS chat_id,
+        search_index.text AS text,
+        users.user_name AS author_name,
+        COALESCE(messages.pub_date, comments.created) AS created,
+        bm25(search_index) AS score
+    FROM search_index
+    LEFT JOIN messages ON search_index.rowid % 2 = 0 AND messages.id = search_index.rowid / 2
+    LEFT JOIN comments ON search_index.rowid % 2 = 1 AND comments.id = search_index.rowid / 2
+    LEFT JOIN users ON users.id = COALESCE(messages.author_id, comments.author_id)
+    WHERE search_index MATCH :query
+        AND search_index.chat_id IN (SELECT chat_id FROM chats_users WHERE user_id = :user_id)
+        AND (
+            bm25(search_index) > :after_score
+            OR (bm25(search_index) = :after_score AND search_index.rowid > :after_rowid)
+        )
+    ORDER BY score, search_index.rowid
+    LIMIT :limit
+    """
+).columns(created=DateTime())
+
+
+@dataclass
+class SearchHit:
+    rowid: int
+    kind: str
+    id: int
+    message_id: int
+    chat_id: int
+    text: str
+    author_name: Optional[str]
+    created: object
+    score: float
+
+
+def search_terms(query: str) -> list[str]:
+    return _TERM.findall(query.lower())
+
+
+def encode_cursor(hit: SearchHit) -> str:
+    return f'{hit.score!r}:{hit.rowid}'
+
+
+def decode_cursor(cursor: Optional[str]) -> tuple[float, int]:
+    """
+    Position after which the next page starts, raises ValueError for a broken cursor.
+    """
+    if not cursor:
+        return float('-inf'), 0
+    score, rowid = str(cursor).rsplit(':', 1)
+    return float(score), int(rowid)
+
+
+def make_hit(rowid: int, **fields) -> SearchHit:
+    return SearchHit(
+        rowid=rowid,
+        kind=COMMENT_KIND if rowid % 2 else MESSAGE_KIND,
+        id=rowid // 2,
+        **fields
+    )
+
+
+def create_search_index(engine: Engine) -> None:
+    """
+    Create the index with triggers that keep it in sync,
+    a newly created index is filled from existing rows.
+    """
+    with engine.begin() as connection:
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'"
+        ).first()
+        for statement in SEARCH_INDEX_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            _fill_search_index(connection)
+
+
+def _fill_search_index(connection) -> None:
+    connection.exec_driver_sql(
+        """
+        INSERT INTO search_index(rowid, text, message_id, chat_id)
+        SELECT id * 2, text, id, chat_id FROM messages
+        """
+    )
+    connection.exec_driver_sql(
+        """
+        INSERT INTO search_index(rowid, text, message_id, chat_id)
+        SELECT comments.id * 2 + 1, comments.text, comments.message_id, messages.chat_id
+        FROM comments JOIN messages ON messages.id = comments.message_id
+        """
+    )
+
+
+def rebuild_search_index(engine: Engine) -> None:
+    create_search_index(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DELETE FROM search_index')
+        _fill_search_index(connection)
+        connection.exec_driver_sql("INSERT INTO search_index(search_index) VALUES ('optimize')")
+    logger.info('Search index rebuilt.')
+
+
+def search_messages(
+        engine: Engine,
+        user_id: int,
+        query: str,
+        limit: int,
+        after: Optional[str] = None
+) -> list[SearchHit]:
+    """
+    Messages and comments of the user chats matching all query terms,
+    best ranked first.
+    """
+    after_score, after_rowid = decode_cursor(after)
+    terms = search_terms(query)
+    if not terms:
+        return []
+    match = ' '.join(f'"{term}"' for term in terms)
+    with engine.connect() as connection:
+        rows = connection.execute(SEARCH_QUERY, {
+            'query': match,
+            'user_id': user_id,
+            'after_score': after_score,
+            'after_rowid': after_rowid,
+            'limit': limit
+        }).mappings().all()
+    return [make_hit(**row) for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Full-text search index of messages.')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index from messages and comments')
+    parser.add_argument('--db-url')
+    args = parser.parse_args()
+    if args.rebuild:
+        rebuild_search_index(create_db_engine(DatabaseSettings(url=args.db_url)))
+    else:
+        parser.print_help()
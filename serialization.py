@@ -0,0 +1,89 @@
+import json
+from typing import Iterable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+MSGPACK_CONTENT_TYPES = (MSGPACK_CONTENT_TYPE, 'application/x-msgpack')
+
+
+class JSONCodec:
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    @staticmethod
+    def encode(data) -> bytes:
+        return json.dumps(
+            data, indent=4, separators=(',', ': ')
+        ).encode('utf-8')
+
+    @staticmethod
+    def decode(body: bytes):
+        return json.loads(body.decode('utf-8'))
+
+
+class MessagePackCodec:
+    name = 'msgpack'
+    content_type = MSGPACK_CONTENT_TYPE
+
+    @staticmethod
+    def encode(data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(body: bytes):
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {JSON_CONTENT_TYPE: JSONCodec}
+if msgpack:
+    CODECS.update((content_type, MessagePackCodec) for content_type in MSGPACK_CONTENT_TYPES)
+
+
+class UnsupportedMediaType(ValueError):
+    pass
+
+
+def get_codec(name: str):
+    """
+    Codec by name ('json' or 'msgpack').
+    """
+    for codec in (JSONCodec, MessagePackCodec):
+        if codec.name == name:
+            if codec is MessagePackCodec and not msgpack:
+                raise UnsupportedMediaType('msgpack package is not installed')
+            return codec
+    raise ValueError(f'Unknown codec {name}')
+
+
+def _media_type(value: bytes) -> str:
+    return value.split(b';', 1)[0].strip().lower().decode('latin-1')
+
+
+def negotiate(headers: Iterable[tuple[bytes, bytes]]) -> tuple:
+    """
+    Codecs of request and response bodies by Content-Type and Accept headers.
+    Bodies without a known Content-Type are JSON, responses are encoded
+    with the first supported Accept type or with the request codec.
+    """
+    content_type = None
+    accept = b''
+    for name, value in headers:
+        if name == b'content-type':
+            content_type = _media_type(value)
+        elif name == b'accept':
+            accept = value
+    if content_type in MSGPACK_CONTENT_TYPES and not msgpack:
+        raise UnsupportedMediaType(content_type)
+    request_codec = CODECS.get(content_type, JSONCodec)
+    response_codec = next((
+        CODECS[media_type]
+        for media_type in map(_media_type, accept.split(b','))
+        if media_type in CODECS
+    ), None)
+    return request_codec, response_codec or request_codec
@@ -1,11 +1,42 @@
+import argparse
 import asyncio
+import datetime
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
 
+from sqlalchemy.engine import Engine
+
+import database
+from admission import AdmissionController
+from capture import TrafficRecorder
+from coalescing import ReadCoalescer
+from connections import INHERITED_SOCKET_ENV, ConnectionManager, inherited_socket
+from database import (DEFAULT_ARCHIVE_URL, DatabaseSettings, create_db_engine,
+                      memory_database_url)
+from enums import ChatType
+from idempotency import IdempotencyCache
+from models import create_schema
+from presence import PresenceRegistry
 from protocol import HTTPProtocol
+from retention import RetentionJob, create_archive_engine
+from rooms import RoomDirectory
+from router import RateLimiter
+from scheduler import ModerationScheduler
+from storage import MemoryStorage, SQLStorage, Storage
+from tracing import RequestTracer
 from utils import get_logger_for_module
 
 
 logger = get_logger_for_module(__name__)
 
+RESTARTED_FROM_ENV = 'MESSENGER_RESTARTED_FROM'
+
 
 class Server:
     """
@@ -13,20 +44,403 @@ class Server:
     For more info see README.md
     """
 
-    def __init__(self, host: str = '127.0.0.1', port: int = 8000) -> None:
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 8000,
+            slow_request_ms: float = 200.0,
+            profile_sample_rate: float = 0.0,
+            profile_dir: str = 'profiles',
+            db_settings: Optional[DatabaseSettings] = None,
+            storage_backend: str = 'sql',
+            storage_dir: str = 'data',
+            fsync_interval: float = 0.05,
+            snapshot_interval: float = 300.0,
+            retention: Optional[dict[ChatType, datetime.timedelta]] = None,
+            archive_url: Optional[str] = None,
+            retention_interval: float = 3600.0,
+            retention_batch_size: int = 500,
+            keep_alive_timeout: float = 75.0,
+            request_timeout: float = 30.0,
+            max_connections: int = 50000,
+            max_connections_per_ip: Optional[int] = None,
+            rate_limit: Optional[float] = None,
+            rate_burst: int = 20,
+            room_rate_limit: Optional[float] = None,
+            room_rate_burst: int = 5,
+            admin_token: Optional[str] = None,
+            drain_timeout: float = 30.0,
+            capture_file: Optional[str] = None,
+            engine: Optional[Engine] = None,
+            max_queued: int = 1000,
+            max_queued_expensive: int = 100,
+            queue_timeout: float = 1.0,
+            queue_timeout_expensive: float = 2.0
+    ) -> None:
         """
-        :param host: server host.
-        :param port: server port.
+        :param host: server host;
+        :param port: server port;
+        :param slow_request_ms: requests slower than this are logged with their queries;
+        :param profile_sample_rate: share of requests dumped with cProfile (0..1);
+        :param profile_dir: directory for cProfile dumps;
+        :param db_settings: storage settings, engine from database.py if omitted;
+        :param storage_backend: 'sql' or 'memory';
+        :param storage_dir: log and snapshot directory of the memory storage;
+        :param fsync_interval: seconds between batched log fsyncs of the memory storage;
+        :param snapshot_interval: seconds between snapshots of the memory storage;
+        :param retention: how long messages are kept per chat type before archiving (sql storage);
+        :param archive_url: archive database url;
+        :param retention_interval: seconds between retention runs;
+        :param retention_batch_size: messages archived per transaction;
+        :param keep_alive_timeout: seconds an idle connection is kept open between requests;
+        :param request_timeout: seconds to receive a whole request after its first byte;
+        :param max_connections: open connections limit;
+        :param max_connections_per_ip: open connections limit per address, unlimited if omitted;
+        :param rate_limit: requests per second allowed to each user, unlimited if omitted;
+        :param rate_burst: requests a user can make at once;
+        :param room_rate_limit: messages per second a user can send to one room,
+            unlimited if omitted;
+        :param room_rate_burst: messages a user can send to one room at once;
+        :param admin_token: bearer token of admin endpoints, they are disabled if omitted;
+        :param drain_timeout: seconds open connections get to finish their requests on shutdown;
+        :param capture_file: file served requests are appended to for replay.py,
+            nothing is captured if omitted;
+        :param engine: storage engine used instead of the one made from db_settings;
+        :param max_queued: requests to cheap endpoints waiting to be served at once,
+            others get 503;
+        :param max_queued_expensive: requests to expensive endpoints (history, search)
+            waiting to be served at once, others get 503;
+        :param queue_timeout: seconds a request to a cheap endpoint waits before 503;
+        :param queue_timeout_expensive: seconds a request to an expensive endpoint
+            waits before 503.
         """
         self.host = host
         self.port = port
+        self.drain_timeout = drain_timeout
+        self._stopping = None
+        self._listening_socket = None
+        self._restart_process = None
+        self._loop = None
+        self.ready = threading.Event()
+        self.connections = ConnectionManager(
+            keep_alive_timeout=keep_alive_timeout,
+            request_timeout=request_timeout,
+            max_connections=max_connections,
+            max_connections_per_ip=max_connections_per_ip
+        )
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst) if rate_limit else None
+        self.admin_token = admin_token
+        self.presence = PresenceRegistry()
+        self.idempotency = IdempotencyCache()
+        self.coalescer = ReadCoalescer()
+        self.recorder = TrafficRecorder(capture_file) if capture_file else None
+        self.admission = AdmissionController(
+            max_queued=max_queued,
+            max_queued_expensive=max_queued_expensive,
+            queue_timeout=queue_timeout,
+            queue_timeout_expensive=queue_timeout_expensive
+        )
+        self.engine = engine or (create_db_engine(db_settings) if db_settings else database.engine)
+        self.archive_engine = None
+        if storage_backend == 'sql' and (retention or archive_url):
+            self.archive_engine = create_archive_engine(archive_url or DEFAULT_ARCHIVE_URL)
+        self.retention_job = None
+        if self.archive_engine and retention:
+            self.retention_job = RetentionJob(
+                engine=self.engine,
+                archive_engine=self.archive_engine,
+                retention=retention,
+                batch_size=retention_batch_size,
+                interval=retention_interval
+            )
+        self.tracer = RequestTracer(
+            slow_request_ms=slow_request_ms,
+            profile_sample_rate=profile_sample_rate,
+            profile_dir=profile_dir
+        )
+        self.tracer.instrument(self.engine)
+        self.storage = self._create_storage(
+            storage_backend,
+            storage_dir,
+            fsync_interval,
+            snapshot_interval
+        )
+        self.scheduler = ModerationScheduler(self.storage)
+        self.rooms = RoomDirectory(
+            self.storage,
+            message_rate=room_rate_limit,
+            message_burst=room_rate_burst,
+            coalesce_reads=True
+        )
+
+    def _create_storage(
+            self,
+            storage_backend: str,
+            storage_dir: str,
+            fsync_interval: float,
+            snapshot_interval: float
+    ) -> Storage:
+        if storage_backend == 'memory':
+            return MemoryStorage(
+                data_dir=storage_dir,
+                fsync_interval=fsync_interval,
+                snapshot_interval=snapshot_interval
+            )
+        if storage_backend == 'sql':
+            create_schema(self.engine)
+            return SQLStorage(self.engine, archive_engine=self.archive_engine)
+        raise ValueError(f'Unknown storage backend {storage_backend}')
+
+    def _create_protocol(self) -> HTTPProtocol:
+        return HTTPProtocol(
+            storage=self.storage,
+            tracer=self.tracer,
+            connections=self.connections,
+            rate_limiter=self.rate_limiter,
+            scheduler=self.scheduler,
+            admin_token=self.admin_token,
+            presence=self.presence,
+            idempotency=self.idempotency,
+            coalescer=self.coalescer,
+            rooms=self.rooms,
+            recorder=self.recorder,
+            admission=self.admission
+        )
+
+    def _background_jobs(self) -> list:
+        jobs = [self.storage.run_maintenance(), self.scheduler.run(), self.presence.run()]
+        if self.retention_job:
+            jobs.append(self.retention_job.run())
+        if self.recorder:
+            jobs.append(self.recorder.run())
+        return jobs
+
+    def stop(self) -> None:
+        """
+        Start graceful shutdown: stop accepting, drain connections, close the storage.
+        """
+        if self._stopping:
+            self._stopping.set()
+
+    def stop_threadsafe(self) -> None:
+        """
+        stop() called from a thread other than the one running the server.
+        """
+        if self._loop:
+            self._loop.call_soon_threadsafe(self.stop)
+
+    def restart(self) -> None:
+        """
+        Start a new server process on the same listening socket,
+        the new process stops this one when it is ready to accept.
+        """
+        if not self._listening_socket:
+            return
+        if self._restart_process and self._restart_process.poll() is None:
+            logger.warning('Hot restart is already in progress.')
+            return
+        if isinstance(self.storage, MemoryStorage):
+            logger.warning('Hot restart is not supported by the memory storage.')
+            return
+        fd = self._listening_socket.fileno()
+        env = {**os.environ, INHERITED_SOCKET_ENV: str(fd), RESTARTED_FROM_ENV: str(os.getpid())}
+        self._restart_process = subprocess.Popen(
+            [sys.executable, *sys.argv],
+            env=env,
+            pass_fds=(fd,)
+        )
+        logger.info('Hot restart, new server process %s.', self._restart_process.pid)
+
+    async def _listen(self, loop: asyncio.AbstractEventLoop) -> asyncio.AbstractServer:
+        if sock := inherited_socket():
+            logger.info('Listening on the inherited socket %s.', sock.getsockname())
+            return await loop.create_server(self._create_protocol, sock=sock)
+        return await loop.create_server(self._create_protocol, self.host, self.port)
 
     async def run(self):
-        loop = asyncio.get_event_loop()
-        server = await loop.create_server(HTTPProtocol, self.host, self.port)
-        await server.serve_forever()
+        loop = self._loop = asyncio.get_running_loop()
+        self.connections.start(loop)
+        self._stopping = asyncio.Event()
+        server = await self._listen(loop)
+        self._listening_socket = server.sockets[0]
+        self.port = self._listening_socket.getsockname()[1]
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, self.stop)
+            loop.add_signal_handler(signal.SIGHUP, self.restart)
+        tasks = [asyncio.create_task(job) for job in self._background_jobs()]
+        if previous_pid := os.environ.pop(RESTARTED_FROM_ENV, None):
+            os.kill(int(previous_pid), signal.SIGTERM)
+        self.ready.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            server.close()
+            logger.info('Stop accepting, draining %s connections.', self.connections.active)
+            await self.connections.drain(self.drain_timeout)
+            for task in tasks:
+                task.cancel()
+            self.connections.stop()
+            self.storage.close()
+            if self.recorder:
+                self.recorder.close()
+            logger.info('Server stopped, admission queues: %s.', self.admission.stats())
+
+
+class EmbeddedServer:
+    """
+    Server running in a background thread of the current process,
+    for tests and tools that need a live server without a separate process.
+    Listens on an ephemeral port and keeps its data in a private in-memory
+    database with the schema and the public chat, unless given other ones.
+    """
+
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 0,
+            db_url: Optional[str] = None,
+            engine: Optional[Engine] = None,
+            **server_options
+    ) -> None:
+        """
+        :param host: server host;
+        :param port: server port, any free port if 0;
+        :param db_url: storage database url, a new in-memory database if omitted;
+        :param engine: storage engine used instead of db_url;
+        :param server_options: other Server parameters.
+        """
+        self.engine = engine or create_db_engine(DatabaseSettings(
+            url=db_url or memory_database_url(f'messenger-{uuid.uuid4().hex}')
+        ))
+        self.server = Server(host, port, engine=self.engine, **server_options)
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.port
+
+    def start(self, timeout: float = 10.0) -> 'EmbeddedServer':
+        """
+        Start the server and wait until it accepts connections.
+        """
+        self._thread = threading.Thread(
+            target=asyncio.run,
+            args=(self.server.run(),),
+            name='embedded-server',
+            daemon=True
+        )
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.ready.wait(0.05):
+            if not self._thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError('Embedded server has not started.')
+        return self
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self.server.stop_threadsafe()
+        self._thread.join(timeout)
+
+    def __enter__(self) -> 'EmbeddedServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Custom http messenger server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--slow-request-ms', type=float, default=200.0)
+    parser.add_argument('--profile-sample-rate', type=float, default=0.0)
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--db-url')
+    parser.add_argument('--db-journal-mode')
+    parser.add_argument('--db-synchronous')
+    parser.add_argument('--db-mmap-size', type=int)
+    parser.add_argument('--db-cache-size', type=int)
+    parser.add_argument('--db-busy-timeout', type=int)
+    parser.add_argument('--db-pool-size', type=int)
+    parser.add_argument('--db-max-overflow', type=int)
+    parser.add_argument('--db-echo', action='store_true', default=None)
+    parser.add_argument('--storage', choices=['sql', 'memory'], default='sql')
+    parser.add_argument('--storage-dir', default='data')
+    parser.add_argument('--fsync-interval', type=float, default=0.05)
+    parser.add_argument('--snapshot-interval', type=float, default=300.0)
+    parser.add_argument('--public-retention-days', type=float)
+    parser.add_argument('--private-retention-days', type=float)
+    parser.add_argument('--archive-url')
+    parser.add_argument('--retention-interval', type=float, default=3600.0)
+    parser.add_argument('--retention-batch-size', type=int, default=500)
+    parser.add_argument('--keep-alive-timeout', type=float, default=75.0)
+    parser.add_argument('--request-timeout', type=float, default=30.0)
+    parser.add_argument('--max-connections', type=int, default=50000)
+    parser.add_argument('--max-connections-per-ip', type=int)
+    parser.add_argument('--rate-limit', type=float)
+    parser.add_argument('--rate-burst', type=int, default=20)
+    parser.add_argument('--room-rate-limit', type=float)
+    parser.add_argument('--room-rate-burst', type=int, default=5)
+    parser.add_argument('--admin-token', default=os.environ.get('MESSENGER_ADMIN_TOKEN'))
+    parser.add_argument('--drain-timeout', type=float, default=30.0)
+    parser.add_argument('--capture-file')
+    parser.add_argument('--max-queued', type=int, default=1000)
+    parser.add_argument('--max-queued-expensive', type=int, default=100)
+    parser.add_argument('--queue-timeout', type=float, default=1.0)
+    parser.add_argument('--queue-timeout-expensive', type=float, default=2.0)
+    return parser.parse_args()
+
+
+def retention_from_args(args: argparse.Namespace) -> dict[ChatType, datetime.timedelta]:
+    retention = {}
+    if args.public_retention_days is not None:
+        retention[ChatType.PUBLIC] = datetime.timedelta(days=args.public_retention_days)
+    if args.private_retention_days is not None:
+        retention[ChatType.PRIVATE] = datetime.timedelta(days=args.private_retention_days)
+    return retention
 
 
 if __name__ == '__main__':
-    server_obj = Server()
+    args = parse_args()
+    server_obj = Server(
+        host=args.host,
+        port=args.port,
+        slow_request_ms=args.slow_request_ms,
+        profile_sample_rate=args.profile_sample_rate,
+        profile_dir=args.profile_dir,
+        db_settings=DatabaseSettings(
+            url=args.db_url,
+            journal_mode=args.db_journal_mode,
+            synchronous=args.db_synchronous,
+            mmap_size=args.db_mmap_size,
+            cache_size=args.db_cache_size,
+            busy_timeout=args.db_busy_timeout,
+            pool_size=args.db_pool_size,
+            max_overflow=args.db_max_overflow,
+            echo=args.db_echo
+        ),
+        storage_backend=args.storage,
+        storage_dir=args.storage_dir,
+        fsync_interval=args.fsync_interval,
+        snapshot_interval=args.snapshot_interval,
+        retention=retention_from_args(args),
+        archive_url=args.archive_url,
+        retention_interval=args.retention_interval,
+        retention_batch_size=args.retention_batch_size,
+        keep_alive_timeout=args.keep_alive_timeout,
+        request_timeout=args.request_timeout,
+        max_connections=args.max_connections,
+        max_connections_per_ip=args.max_connections_per_ip,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst,
+        room_rate_limit=args.room_rate_limit,
+        room_rate_burst=args.room_rate_burst,
+        admin_token=args.admin_token,
+        drain_timeout=args.drain_timeout,
+        capture_file=args.capture_file,
+        max_queued=args.max_queued,
+        max_queued_expensive=args.max_queued_expensive,
+        queue_timeout=args.queue_timeout,
+        queue_timeout_expensive=args.queue_timeout_expensive
+    )
     asyncio.run(server_obj.run())
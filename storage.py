@@ -0,0 +1,1791 @@
+import asyncio
+import bisect
+import datetime
+import glob
+import json
+import os
+import secrets
+import time
+from dataclasses import asdict, dataclass, field, replace
+from operator import attrgetter
+from typing import Optional
+
+from sqlalchemy import Integer, desc, func, insert, literal, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session, aliased
+
+from enums import ChatType
+from models import Chat, ChatArchive, ChatUser, Comment, Message, User
+from retention import archived_history
+from search import (SearchHit, decode_cursor, make_hit, search_messages,
+                    search_terms)
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+PUBLIC_CHAT_NAME = 'public_chat'
+COMMENTS_PREVIEW_SIZE = 3
+
+DELIVERY_SENT = 'sent'
+DELIVERY_NOT_FOUND = 'not_found'
+DELIVERY_BANNED = 'banned'
+DELIVERY_SELF = 'self'
+
+
+@dataclass
+class UserRecord:
+    id: int
+    user_name: str
+    token: str
+    messages_in_hour_in_public_chat: int = 0
+    start_chatting_in_public_chat: Optional[datetime.datetime] = None
+
+
+@dataclass
+class ChatRecord:
+    id: int
+    name: str
+    type: ChatType
+    created: datetime.datetime
+
+
+@dataclass
+class MemberRecord:
+    chat_id: int
+    user_id: int
+    last_connect: Optional[datetime.datetime] = None
+    cautions: int = 0
+    banned: bool = False
+    banned_till: Optional[datetime.datetime] = None
+    unread_count: int = 0
+    last_read_message_id: Optional[int] = None
+
+
+@dataclass
+class CommentRecord:
+    id: int
+    message_id: int
+    author_id: int
+    text: str
+    created: datetime.datetime
+    author_name: Optional[str] = None
+
+
+@dataclass
+class MessageRecord:
+    id: int
+    chat_id: int
+    author_id: int
+    author_name: str
+    text: str
+    pub_date: datetime.datetime
+    comments: list[CommentRecord] = field(default_factory=list)
+    comments_number: int = 0
+
+
+@dataclass
+class ChatSummary:
+    chat: ChatRecord
+    title: str
+    messages_number: int
+    users_number: int
+
+
+@dataclass
+class ArchiveMarker:
+    archived_till: datetime.datetime
+    messages_number: int
+
+
+@dataclass
+class UnreadCounter:
+    chat: ChatRecord
+    title: str
+    unread_count: int
+    last_read_message_id: Optional[int]
+
+
+class Storage:
+    """
+    Storage interface used by protocol handlers.
+    Every method is a complete unit of work.
+    Returned messages carry the first COMMENTS_PREVIEW_SIZE comments
+    and the number of all comments, the rest is read by comments().
+    """
+
+    def get_user_by_token(self, token: str) -> Optional[UserRecord]:
+        raise NotImplementedError
+
+    def get_user_by_name(self, user_name: str) -> Optional[UserRecord]:
+        raise NotImplementedError
+
+    def create_user(self, user_name: str) -> UserRecord:
+        """
+        Create user with unique token, rooms are joined later by join_chat().
+        """
+        raise NotImplementedError
+
+    def create_users(self, user_names: list[str]) -> list[UserRecord]:
+        """
+        Create users with unique tokens at once, names already taken are skipped.
+        """
+        raise NotImplementedError
+
+    def save_user(self, user: UserRecord) -> None:
+        raise NotImplementedError
+
+    def get_public_chat(self, name: str = PUBLIC_CHAT_NAME) -> Optional[ChatRecord]:
+        raise NotImplementedError
+
+    def public_chats(self) -> list[ChatRecord]:
+        """
+        All public rooms in creation order.
+        """
+        raise NotImplementedError
+
+    def create_public_chat(self, name: str) -> ChatRecord:
+        raise NotImplementedError
+
+    def join_chat(self, chat_id: int, user_id: int) -> MemberRecord:
+        """
+        Add user to the chat members if he is not there yet.
+        """
+        raise NotImplementedError
+
+    def get_private_chat(self, user_id: int, other_user_id: int) -> Optional[ChatRecord]:
+        raise NotImplementedError
+
+    def create_private_chat(self, user_id: int, other_user_id: int) -> ChatRecord:
+        raise NotImplementedError
+
+    def get_member(self, chat_id: int, user_id: int) -> Optional[MemberRecord]:
+        raise NotImplementedError
+
+    def save_member(self, member: MemberRecord) -> None:
+        """
+        Save moderation state and last connect, unread counters are kept as is.
+        """
+        raise NotImplementedError
+
+    def mark_read(
+            self,
+            chat_id: int,
+            user_id: int,
+            message_id: Optional[int],
+            read_at: datetime.datetime
+    ) -> None:
+        """
+        Mark chat as read by the member up to the message,
+        messages added after it are left in the unread counter.
+        """
+        raise NotImplementedError
+
+    def expire_bans(self, now: datetime.datetime) -> int:
+        """
+        Lift all bans ended by the moment, returns number of unbanned members.
+        """
+        raise NotImplementedError
+
+    def reset_rate_windows(self, started_before: datetime.datetime) -> int:
+        """
+        Reset public chat message counters of windows started before the moment,
+        returns number of reset users.
+        """
+        raise NotImplementedError
+
+    def next_ban_expiry(self) -> Optional[datetime.datetime]:
+        raise NotImplementedError
+
+    def next_rate_window_start(self) -> Optional[datetime.datetime]:
+        """
+        Start of the oldest public chat rate window with sent messages.
+        """
+        raise NotImplementedError
+
+    def add_message(
+            self,
+            chat_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> MessageRecord:
+        """
+        Add message, mark chat as read by the author
+        and increment unread counters of other members.
+        The idempotency key is saved with the message.
+        """
+        raise NotImplementedError
+
+    def add_private_messages(
+            self,
+            author_id: int,
+            recipient_names: list[str],
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> dict[str, str]:
+        """
+        Add the message to private chats of the author with every recipient at once,
+        missing chats are created. Returns delivery status by recipient name.
+        """
+        raise NotImplementedError
+
+    def get_message(self, message_id: int) -> Optional[MessageRecord]:
+        raise NotImplementedError
+
+    def add_comment(
+            self,
+            message_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> CommentRecord:
+        raise NotImplementedError
+
+    def idempotency_key_used(self, author_id: int, idempotency_key: str) -> bool:
+        """
+        Whether a message or comment of the author was saved with the key.
+        """
+        raise NotImplementedError
+
+    def comments(
+            self,
+            message_id: int,
+            after_id: Optional[int],
+            limit: int
+    ) -> list[CommentRecord]:
+        """
+        Comments of the message in creation order, starting after the comment id.
+        """
+        raise NotImplementedError
+
+    def last_messages(
+            self,
+            chat_id: int,
+            before: datetime.datetime,
+            limit: int
+    ) -> list[MessageRecord]:
+        """
+        Newest first messages published before the date.
+        """
+        raise NotImplementedError
+
+    def unread_messages(
+            self,
+            chat_id: int,
+            after: datetime.datetime
+    ) -> list[MessageRecord]:
+        """
+        Messages published after the date, in publication order.
+        """
+        raise NotImplementedError
+
+    def messages_after(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        """
+        Oldest first messages with id above after_id.
+        """
+        raise NotImplementedError
+
+    def export_messages(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        """
+        Oldest first messages with id above after_id with all their comments.
+        """
+        raise NotImplementedError
+
+    def archived_messages(
+            self,
+            chat_id: int,
+            before_id: Optional[int],
+            limit: int
+    ) -> list[MessageRecord]:
+        """
+        Newest first archived messages with id below before_id.
+        """
+        raise NotImplementedError
+
+    def archive_marker(self, chat_id: int) -> Optional[ArchiveMarker]:
+        """
+        Date of the newest archived message of the chat and number of archived
+        messages, None if nothing of the chat was archived.
+        """
+        raise NotImplementedError
+
+    def chat_summaries(self, user_id: int) -> list[ChatSummary]:
+        raise NotImplementedError
+
+    def unread_counters(self, user_id: int) -> list[UnreadCounter]:
+        raise NotImplementedError
+
+    def search(
+            self,
+            user_id: int,
+            query: str,
+            limit: int,
+            after: Optional[str] = None
+    ) -> list[SearchHit]:
+        """
+        Messages and comments of the user chats containing all query terms,
+        best ranked first, starting after the cursor.
+        """
+        raise NotImplementedError
+
+    async def run_maintenance(self) -> None:
+        """
+        Background work of the storage, runs on the server loop.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class SQLStorage(Storage):
+    """
+    Storage in the SQL database via SQLAlchemy ORM.
+    """
+
+    def __init__(self, engine: Engine, archive_engine: Optional[Engine] = None) -> None:
+        """
+        :param engine: database engine;
+        :param archive_engine: engine of the archive made by the retention job.
+        """
+        self._engine = engine
+        self._archive_engine = archive_engine
+
+    @staticmethod
+    def _user_record(user: User) -> UserRecord:
+        return UserRecord(
+            id=user.id,
+            user_name=user.user_name,
+            token=user.token,
+            messages_in_hour_in_public_chat=user.messages_in_hour_in_public_chat,
+            start_chatting_in_public_chat=user.start_chatting_in_public_chat
+        )
+
+    @staticmethod
+    def _chat_record(chat: Chat) -> ChatRecord:
+        return ChatRecord(id=chat.id, name=chat.name, type=chat.type, created=chat.created)
+
+    @staticmethod
+    def _member_record(chat_user: ChatUser) -> MemberRecord:
+        return MemberRecord(
+            chat_id=chat_user.chat_id,
+            user_id=chat_user.user_id,
+            last_connect=chat_user.last_connect,
+            cautions=chat_user.cautions,
+            banned=chat_user.banned,
+            banned_till=chat_user.banned_till,
+            unread_count=chat_user.unread_count,
+            last_read_message_id=chat_user.last_read_message_id
+        )
+
+    @staticmethod
+    def _comment_record(comment: Comment) -> CommentRecord:
+        return CommentRecord(
+            id=comment.id,
+            message_id=comment.message_id,
+            author_id=comment.author_id,
+            text=comment.text,
+            created=comment.created
+        )
+
+    @staticmethod
+    def _comments_query(message_ids: list[int]):
+        return select(
+            Comment.id,
+            Comment.message_id,
+            Comment.author_id,
+            Comment.text,
+            Comment.created,
+            User.user_name.label('author_name')
+        ).outerjoin(
+            User, User.id == Comment.author_id
+        ).where(
+            Comment.message_id.in_(message_ids)
+        )
+
+    @staticmethod
+    def _messages_query():
+        """
+        Message columns in the MessageRecord field order with the author name joined.
+        """
+        return select(
+            Message.id,
+            Message.chat_id,
+            Message.author_id,
+            User.user_name.label('author_name'),
+            Message.text,
+            Message.pub_date
+        ).outerjoin(
+            User, User.id == Message.author_id
+        )
+
+    def _message_records(self, connection: Connection, query) -> list[MessageRecord]:
+        """
+        Records of messages selected by the query,
+        comment previews and numbers are read by one query for all messages.
+        """
+        records = [MessageRecord(*row) for row in connection.execute(query)]
+        if not records:
+            return records
+        comments = self._comments_query([record.id for record in records]).add_columns(
+            func.row_number().over(
+                partition_by=Comment.message_id,
+                order_by=Comment.id
+            ).label('position'),
+            func.count().over(partition_by=Comment.message_id).label('comments_number')
+        ).subquery()
+        by_id = {record.id: record for record in records}
+        for row in connection.execute(
+                select(comments).where(
+                    comments.c.position <= COMMENTS_PREVIEW_SIZE
+                ).order_by(comments.c.message_id, comments.c.id)
+        ):
+            record = by_id[row.message_id]
+            record.comments_number = row.comments_number
+            record.comments.append(CommentRecord(
+                row.id,
+                row.message_id,
+                row.author_id,
+                row.text,
+                row.created,
+                row.author_name
+            ))
+        return records
+
+    def get_user_by_token(self, token: str) -> Optional[UserRecord]:
+        with Session(self._engine) as session:
+            if user := session.query(User).filter_by(token=token).first():
+                return self._user_record(user)
+
+    def get_user_by_name(self, user_name: str) -> Optional[UserRecord]:
+        with Session(self._engine) as session:
+            if user := session.query(User).filter_by(user_name=user_name).first():
+                return self._user_record(user)
+
+    def create_user(self, user_name: str) -> UserRecord:
+        with Session(self._engine) as session:
+            token = secrets.token_hex(16)
+            while session.query(User).filter_by(token=token).first():
+                token = secrets.token_hex(16)
+            new_user = User(user_name=user_name, token=token)
+            session.add(new_user)
+            session.commit()
+            return self._user_record(new_user)
+
+    @staticmethod
+    def _new_tokens(session: Session, number: int) -> list[str]:
+        tokens = set()
+        while len(tokens) < number:
+            tokens.update(secrets.token_hex(16) for _ in range(number - len(tokens)))
+            tokens.difference_update(session.scalars(
+                select(User.token).where(User.token.in_(tokens))
+            ))
+        return list(tokens)
+
+    def create_users(self, user_names: list[str]) -> list[UserRecord]:
+        with Session(self._engine) as session:
+            taken = set(session.scalars(
+                select(User.user_name).where(User.user_name.in_(user_names))
+            ))
+            names = [name for name in dict.fromkeys(user_names) if name not in taken]
+            if not names:
+                return []
+            now = datetime.datetime.utcnow()
+            users = [
+                {
+                    'user_name': name,
+                    'token': token,
+                    'messages_in_hour_in_public_chat': 0,
+                    'start_chatting_in_public_chat': now
+                }
+                for name, token in zip(names, self._new_tokens(session, len(names)))
+            ]
+            session.execute(insert(User), users)
+            ids = dict(session.execute(
+                select(User.user_name, User.id).where(User.user_name.in_(names))
+            ).all())
+            session.commit()
+            return [UserRecord(id=ids[user['user_name']], **user) for user in users]
+
+    def save_user(self, user: UserRecord) -> None:
+        with Session(self._engine) as session:
+            session.query(User).filter_by(id=user.id).update({
+                User.messages_in_hour_in_public_chat: user.messages_in_hour_in_public_chat,
+                User.start_chatting_in_public_chat: user.start_chatting_in_public_chat
+            })
+            session.commit()
+
+    def get_public_chat(self, name: str = PUBLIC_CHAT_NAME) -> Optional[ChatRecord]:
+        with Session(self._engine) as session:
+            if chat := session.query(Chat).filter(
+                    Chat.type == ChatType.PUBLIC
+            ).filter_by(
+                name=name
+            ).first():
+                return self._chat_record(chat)
+
+    def public_chats(self) -> list[ChatRecord]:
+        with self._engine.connect() as connection:
+            return [
+                ChatRecord(*row)
+                for row in connection.execute(
+                    select(Chat.id, Chat.name, Chat.type, Chat.created).where(
+                        Chat.type == ChatType.PUBLIC
+                    ).order_by(Chat.id)
+                )
+            ]
+
+    def create_public_chat(self, name: str) -> ChatRecord:
+        with Session(self._engine) as session:
+            new_chat = Chat(name=name, type=ChatType.PUBLIC)
+            session.add(new_chat)
+            session.commit()
+            return self._chat_record(new_chat)
+
+    def join_chat(self, chat_id: int, user_id: int) -> MemberRecord:
+        with Session(self._engine) as session:
+            session.execute(insert(ChatUser).prefix_with('OR IGNORE').values(
+                chat_id=chat_id,
+                user_id=user_id
+            ))
+            session.commit()
+            return self._member_record(session.get(ChatUser, (chat_id, user_id)))
+
+    def get_private_chat(self, user_id: int, other_user_id: int) -> Optional[ChatRecord]:
+        with Session(self._engine) as session:
+            if chat := session.query(Chat).filter(
+                    Chat.type == ChatType.PRIVATE,
+                    Chat.users.any(id=user_id),
+                    Chat.users.any(id=other_user_id)
+            ).first():
+                return self._chat_record(chat)
+
+    def create_private_chat(self, user_id: int, other_user_id: int) -> ChatRecord:
+        with Session(self._engine) as session:
+            new_chat = Chat(name=f'private-{int(time.time())}', type=ChatType.PRIVATE)
+            new_chat.users = session.query(User).filter(
+                User.id.in_([user_id, other_user_id])
+            ).all()
+            session.add(new_chat)
+            session.commit()
+            return self._chat_record(new_chat)
+
+    def get_member(self, chat_id: int, user_id: int) -> Optional[MemberRecord]:
+        with Session(self._engine) as session:
+            if chat_user := session.get(ChatUser, (chat_id, user_id)):
+                return self._member_record(chat_user)
+
+    def save_member(self, member: MemberRecord) -> None:
+        with Session(self._engine) as session:
+            session.query(ChatUser).filter_by(
+                chat_id=member.chat_id
+            ).filter_by(
+                user_id=member.user_id
+            ).update({
+                ChatUser.last_connect: member.last_connect,
+                ChatUser.cautions: member.cautions,
+                ChatUser.banned: member.banned,
+                ChatUser.banned_till: member.banned_till
+            })
+            session.commit()
+
+    def mark_read(
+            self,
+            chat_id: int,
+            user_id: int,
+            message_id: Optional[int],
+            read_at: datetime.datetime
+    ) -> None:
+        last_read_message_id = func.coalesce(
+            literal(message_id, Integer),
+            ChatUser.last_read_message_id,
+            0
+        )
+        with Session(self._engine) as session:
+            session.query(ChatUser).filter_by(
+                chat_id=chat_id
+            ).filter_by(
+                user_id=user_id
+            ).update({
+                ChatUser.last_connect: read_at,
+                ChatUser.last_read_message_id: last_read_message_id,
+                ChatUser.unread_count: select(
+                    func.count(Message.id)
+                ).where(
+                    Message.chat_id == chat_id,
+                    Message.author_id != user_id,
+                    Message.id > last_read_message_id
+                ).scalar_subquery()
+            }, synchronize_session=False)
+            session.commit()
+
+    def expire_bans(self, now: datetime.datetime) -> int:
+        with Session(self._engine) as session:
+            expired = session.query(ChatUser).filter(
+                ChatUser.banned.is_(True),
+                ChatUser.banned_till <= now
+            ).update({
+                ChatUser.banned: False,
+                ChatUser.cautions: 0,
+                ChatUser.banned_till: None
+            }, synchronize_session=False)
+            session.commit()
+            return expired
+
+    def reset_rate_windows(self, started_before: datetime.datetime) -> int:
+        with Session(self._engine) as session:
+            reset = session.query(User).filter(
+                User.messages_in_hour_in_public_chat > 0,
+                User.start_chatting_in_public_chat <= started_before
+            ).update(
+                {User.messages_in_hour_in_public_chat: 0},
+                synchronize_session=False
+            )
+            session.commit()
+            return reset
+
+    def next_ban_expiry(self) -> Optional[datetime.datetime]:
+        with Session(self._engine) as session:
+            return session.query(func.min(ChatUser.banned_till)).filter(
+                ChatUser.banned.is_(True)
+            ).scalar()
+
+    def next_rate_window_start(self) -> Optional[datetime.datetime]:
+        with Session(self._engine) as session:
+            return session.query(func.min(User.start_chatting_in_public_chat)).filter(
+                User.messages_in_hour_in_public_chat > 0
+            ).scalar()
+
+    def add_message(
+            self,
+            chat_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> MessageRecord:
+        with Session(self._engine) as session:
+            message = Message(
+                text=text,
+                author_id=author_id,
+                chat_id=chat_id,
+                idempotency_key=idempotency_key
+            )
+            session.add(message)
+            session.query(ChatUser).filter_by(
+                chat_id=chat_id
+            ).filter_by(
+                user_id=author_id
+            ).update({ChatUser.last_connect: datetime.datetime.utcnow()})
+            session.query(ChatUser).filter(
+                ChatUser.chat_id == chat_id,
+                ChatUser.user_id != author_id
+            ).update(
+                {ChatUser.unread_count: ChatUser.unread_count + 1},
+                synchronize_session=False
+            )
+            session.commit()
+            logger.info('Message add to database.')
+            return MessageRecord(
+                id=message.id,
+                chat_id=message.chat_id,
+                author_id=message.author_id,
+                author_name=message.author.user_name,
+                text=message.text,
+                pub_date=message.pub_date
+            )
+
+    @staticmethod
+    def _private_chats_with(
+            session: Session,
+            author_id: int,
+            user_ids: set[int]
+    ) -> dict[int, ChatUser]:
+        """
+        Author membership in the first private chat with every user,
+        all private chats of the author are read by one join, an IN list
+        of thousands of users would be probed for every row of the join.
+        """
+        author_member = aliased(ChatUser)
+        other_member = aliased(ChatUser)
+        rows = session.execute(
+            select(other_member.user_id, author_member).select_from(author_member).join(
+                Chat, Chat.id == author_member.chat_id
+            ).join(
+                other_member, other_member.chat_id == Chat.id
+            ).where(
+                Chat.type == ChatType.PRIVATE,
+                author_member.user_id == author_id,
+                other_member.user_id != author_id
+            ).order_by(Chat.id)
+        ).all()
+        chats = {}
+        for user_id, member in rows:
+            if user_id in user_ids:
+                chats.setdefault(user_id, member)
+        return chats
+
+    def add_private_messages(
+            self,
+            author_id: int,
+            recipient_names: list[str],
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> dict[str, str]:
+        names = list(dict.fromkeys(recipient_names))
+        now = datetime.datetime.utcnow()
+        with Session(self._engine) as session:
+            user_ids = dict(session.execute(
+                select(User.user_name, User.id).where(User.user_name.in_(names))
+            ).all())
+            statuses = {name: DELIVERY_NOT_FOUND for name in names}
+            recipients = {}
+            for name, user_id in user_ids.items():
+                if user_id == author_id:
+                    statuses[name] = DELIVERY_SELF
+                else:
+                    recipients[user_id] = name
+            chats = self._private_chats_with(session, author_id, set(recipients))
+            chat_ids = []
+            for user_id, member in chats.items():
+                if member.banned and member.banned_till > now:
+                    statuses[recipients[user_id]] = DELIVERY_BANNED
+                else:
+                    chat_ids.append(member.chat_id)
+                    statuses[recipients[user_id]] = DELIVERY_SENT
+            new_chat_users = [user_id for user_id in recipients if user_id not in chats]
+            if new_chat_users:
+                session.execute(insert(Chat), [
+                    {'name': f'private-{int(time.time())}', 'type': ChatType.PRIVATE, 'created': now}
+                    for _ in new_chat_users
+                ])
+                # the write lock is held since the insert, so the new rows are the last ids
+                last_id = session.scalar(select(func.max(Chat.id)))
+                first_id = last_id - len(new_chat_users) + 1
+                session.execute(insert(ChatUser), [
+                    member
+                    for chat_id, user_id in zip(range(first_id, last_id + 1), new_chat_users)
+                    for member in (
+                        {'chat_id': chat_id, 'user_id': author_id, 'unread_count': 0},
+                        {'chat_id': chat_id, 'user_id': user_id, 'unread_count': 0}
+                    )
+                ])
+                chat_ids.extend(range(first_id, last_id + 1))
+                for user_id in new_chat_users:
+                    statuses[recipients[user_id]] = DELIVERY_SENT
+            if chat_ids:
+                session.execute(insert(Message), [
+                    {
+                        'text': text,
+                        'author_id': author_id,
+                        'chat_id': chat_id,
+                        'pub_date': now,
+                        'idempotency_key': idempotency_key
+                    }
+                    for chat_id in chat_ids
+                ])
+                session.query(ChatUser).filter(
+                    ChatUser.chat_id.in_(chat_ids),
+                    ChatUser.user_id == author_id
+                ).update({ChatUser.last_connect: now}, synchronize_session=False)
+                session.query(ChatUser).filter(
+                    ChatUser.chat_id.in_(chat_ids),
+                    ChatUser.user_id != author_id
+                ).update(
+                    {ChatUser.unread_count: ChatUser.unread_count + 1},
+                    synchronize_session=False
+                )
+            session.commit()
+            logger.info('Message add to %s private chats.', len(chat_ids))
+            return statuses
+
+    def get_message(self, message_id: int) -> Optional[MessageRecord]:
+        with self._engine.connect() as connection:
+            if records := self._message_records(
+                    connection,
+                    self._messages_query().where(Message.id == message_id)
+            ):
+                return records[0]
+
+    def add_comment(
+            self,
+            message_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> CommentRecord:
+        with Session(self._engine) as session:
+            comment = Comment(
+                message_id=message_id,
+                author_id=author_id,
+                text=text,
+                idempotency_key=idempotency_key
+            )
+            session.add(comment)
+            session.commit()
+            return self._comment_record(comment)
+
+    def idempotency_key_used(self, author_id: int, idempotency_key: str) -> bool:
+        with Session(self._engine) as session:
+            return session.scalar(select(
+                select(Message.id).where(
+                    Message.author_id == author_id,
+                    Message.idempotency_key == idempotency_key
+                ).exists() | select(Comment.id).where(
+                    Comment.author_id == author_id,
+                    Comment.idempotency_key == idempotency_key
+                ).exists()
+            ))
+
+    def comments(
+            self,
+            message_id: int,
+            after_id: Optional[int],
+            limit: int
+    ) -> list[CommentRecord]:
+        query = self._comments_query([message_id])
+        if after_id:
+            query = query.where(Comment.id > after_id)
+        with Session(self._engine) as session:
+            return [
+                CommentRecord(**row)
+                for row in session.execute(query.order_by(Comment.id).limit(limit)).mappings()
+            ]
+
+    def last_messages(
+            self,
+            chat_id: int,
+            before: datetime.datetime,
+            limit: int
+    ) -> list[MessageRecord]:
+        with self._engine.connect() as connection:
+            return self._message_records(connection, self._messages_query().where(
+                Message.chat_id == chat_id,
+                Message.pub_date < before
+            ).order_by(
+                desc(Message.pub_date)
+            ).limit(
+                limit
+            ))
+
+    def unread_messages(
+            self,
+            chat_id: int,
+            after: datetime.datetime
+    ) -> list[MessageRecord]:
+        with self._engine.connect() as connection:
+            return self._message_records(connection, self._messages_query().where(
+                Message.chat_id == chat_id,
+                Message.pub_date > after
+            ).order_by(
+                Message.id
+            ))
+
+    def messages_after(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        with self._engine.connect() as connection:
+            return self._message_records(connection, self._messages_query().where(
+                Message.chat_id == chat_id,
+                Message.id > after_id
+            ).order_by(
+                Message.id
+            ).limit(
+                limit
+            ))
+
+    def export_messages(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        with self._engine.connect() as connection:
+            records = [
+                MessageRecord(*row)
+                for row in connection.execute(self._messages_query().where(
+                    Message.chat_id == chat_id,
+                    Message.id > after_id
+                ).order_by(
+                    Message.id
+                ).limit(
+                    limit
+                ))
+            ]
+            if not records:
+                return records
+            by_id = {record.id: record for record in records}
+            for row in connection.execute(
+                    self._comments_query(list(by_id)).order_by(Comment.message_id, Comment.id)
+            ).mappings():
+                record = by_id[row['message_id']]
+                record.comments.append(CommentRecord(**row))
+                record.comments_number += 1
+            return records
+
+    def archived_messages(
+            self,
+            chat_id: int,
+            before_id: Optional[int],
+            limit: int
+    ) -> list[MessageRecord]:
+        if not self._archive_engine:
+            return []
+        messages, comments = archived_history(self._archive_engine, chat_id, before_id, limit)
+        return [
+            MessageRecord(
+                id=message['id'],
+                chat_id=message['chat_id'],
+                author_id=message['author_id'],
+                author_name=message['author_name'],
+                text=message['text'],
+                pub_date=message['pub_date'],
+                comments=[
+                    CommentRecord(**comment)
+                    for comment in comments.get(message['id'], [])[:COMMENTS_PREVIEW_SIZE]
+                ],
+                comments_number=len(comments.get(message['id'], []))
+            )
+            for message in messages
+        ]
+
+    def archive_marker(self, chat_id: int) -> Optional[ArchiveMarker]:
+        if not self._archive_engine:
+            return None
+        with self._engine.connect() as connection:
+            marker = connection.execute(
+                select(
+                    ChatArchive.archived_till,
+                    ChatArchive.messages_number
+                ).where(ChatArchive.chat_id == chat_id)
+            ).first()
+        return ArchiveMarker(*marker) if marker else None
+
+    @staticmethod
+    def _user_chats_query(user_id: int, *columns):
+        """
+        Chats of the user with the name of the other member of private chats
+        (the user name in the chat with himself) and the given columns.
+        """
+        other_member = aliased(ChatUser)
+        other_user_name = select(
+            User.user_name
+        ).join(
+            other_member, other_member.user_id == User.id
+        ).where(
+            other_member.chat_id == ChatUser.chat_id,
+            other_member.user_id != user_id
+        ).limit(1).scalar_subquery()
+        own_name = select(User.user_name).where(User.id == user_id).scalar_subquery()
+        return select(
+            Chat.id,
+            Chat.name,
+            Chat.type,
+            Chat.created,
+            func.coalesce(other_user_name, own_name).label('other_user_name'),
+            *columns
+        ).join(
+            ChatUser, ChatUser.chat_id == Chat.id
+        ).where(
+            ChatUser.user_id == user_id
+        ).order_by(Chat.id)
+
+    @staticmethod
+    def _chat_title(row) -> str:
+        return row.other_user_name if row.type == ChatType.PRIVATE else row.name
+
+    def chat_summaries(self, user_id: int) -> list[ChatSummary]:
+        messages_number = select(
+            func.count(Message.id)
+        ).where(
+            Message.chat_id == Chat.id
+        ).scalar_subquery()
+        members = aliased(ChatUser)
+        users_number = select(
+            func.count()
+        ).select_from(members).where(
+            members.chat_id == Chat.id
+        ).scalar_subquery()
+        with self._engine.connect() as connection:
+            return [
+                ChatSummary(
+                    chat=ChatRecord(row.id, row.name, row.type, row.created),
+                    title=self._chat_title(row),
+                    messages_number=row.messages_number,
+                    users_number=row.users_number
+                )
+                for row in connection.execute(self._user_chats_query(
+                    user_id,
+                    messages_number.label('messages_number'),
+                    users_number.label('users_number')
+                ))
+            ]
+
+    def unread_counters(self, user_id: int) -> list[UnreadCounter]:
+        with self._engine.connect() as connection:
+            return [
+                UnreadCounter(
+                    chat=ChatRecord(row.id, row.name, row.type, row.created),
+                    title=self._chat_title(row),
+                    unread_count=row.unread_count,
+                    last_read_message_id=row.last_read_message_id
+                )
+                for row in connection.execute(self._user_chats_query(
+                    user_id,
+                    ChatUser.unread_count,
+                    ChatUser.last_read_message_id
+                ))
+            ]
+
+    def search(
+            self,
+            user_id: int,
+            query: str,
+            limit: int,
+            after: Optional[str] = None
+    ) -> list[SearchHit]:
+        return search_messages(self._engine, user_id, query, limit, after)
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in indexed in-memory structures.
+    Every change is appended to the write-ahead log, which is fsynced
+    in batches, and the whole state is periodically written to a compact
+    snapshot. State is restored from the snapshot and the log at start.
+    Messages are never archived.
+    """
+
+    SNAPSHOT_FILE = 'snapshot.json'
+    LOG_FILE_PATTERN = 'wal-*.log'
+
+    def __init__(
+            self,
+            data_dir: str = 'data',
+            fsync_interval: float = 0.05,
+            snapshot_interval: float = 300.0
+    ) -> None:
+        """
+        :param data_dir: directory for the log and snapshot files;
+        :param fsync_interval: seconds between batched log fsyncs;
+        :param snapshot_interval: seconds between snapshots.
+        """
+        self.data_dir = data_dir
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self._lsn = 0
+        self._ids = {'users': 0, 'chats': 0, 'messages': 0, 'comments': 0}
+        self._users = {}
+        self._users_by_name = {}
+        self._users_by_token = {}
+        self._chats = {}
+        self._public_chats = {}
+        self._private_chats = {}
+        self._members = {}
+        self._chat_members = {}
+        self._user_chats = {}
+        self._messages = {}
+        self._chat_messages = {}
+        self._chat_dates = {}
+        self._chat_message_ids = {}
+        self._comments = {}
+        self._comment_ids = {}
+        self._search_index = {}
+        self._idempotency_keys = set()
+        self._log = None
+        self._log_lsn = 0
+        self._log_dirty = False
+        os.makedirs(self.data_dir, exist_ok=True)
+        replayed = self._restore()
+        self._open_log()
+        if PUBLIC_CHAT_NAME not in self._public_chats:
+            self._write({
+                'op': 'create_chat',
+                'id': self._next_id('chats'),
+                'name': PUBLIC_CHAT_NAME,
+                'type': ChatType.PUBLIC.value,
+                'created': datetime.datetime.utcnow().isoformat(),
+                'user_ids': []
+            })
+        if replayed:
+            self.snapshot()
+
+    @staticmethod
+    def _date(value: Optional[str]) -> Optional[datetime.datetime]:
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    @staticmethod
+    def _iso(value: Optional[datetime.datetime]) -> Optional[str]:
+        return value.isoformat() if value else None
+
+    def _next_id(self, table: str) -> int:
+        self._ids[table] += 1
+        return self._ids[table]
+
+    def _log_path(self, lsn: int) -> str:
+        return os.path.join(self.data_dir, f'wal-{lsn:012d}.log')
+
+    def _open_log(self) -> None:
+        self._log_lsn = self._lsn + 1
+        self._log = open(self._log_path(self._log_lsn), 'a', encoding='utf-8')
+
+    def _write(self, entry: dict):
+        self._lsn += 1
+        entry['lsn'] = self._lsn
+        self._log.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._log_dirty = True
+        return self._apply(entry)
+
+    def _apply(self, entry: dict):
+        return getattr(self, f'_apply_{entry["op"]}')(entry)
+
+    def _apply_create_user(self, entry: dict) -> UserRecord:
+        user = UserRecord(
+            id=entry['id'],
+            user_name=entry['user_name'],
+            token=entry['token'],
+            messages_in_hour_in_public_chat=entry['messages_in_hour_in_public_chat'],
+            start_chatting_in_public_chat=self._date(entry['start_chatting_in_public_chat'])
+        )
+        self._ids['users'] = max(self._ids['users'], user.id)
+        self._users[user.id] = user
+        self._users_by_name[user.user_name] = user
+        self._users_by_token[user.token] = user
+        self._user_chats.setdefault(user.id, [])
+        return user
+
+    def _apply_save_user(self, entry: dict) -> None:
+        user = self._users[entry['id']]
+        user.messages_in_hour_in_public_chat = entry['messages_in_hour_in_public_chat']
+        user.start_chatting_in_public_chat = self._date(entry['start_chatting_in_public_chat'])
+
+    def _apply_create_chat(self, entry: dict) -> ChatRecord:
+        chat = ChatRecord(
+            id=entry['id'],
+            name=entry['name'],
+            type=ChatType(entry['type']),
+            created=self._date(entry['created'])
+        )
+        self._ids['chats'] = max(self._ids['chats'], chat.id)
+        self._chats[chat.id] = chat
+        self._chat_members[chat.id] = []
+        self._chat_messages[chat.id] = []
+        self._chat_dates[chat.id] = []
+        self._chat_message_ids[chat.id] = []
+        if chat.type == ChatType.PUBLIC:
+            self._public_chats[chat.name] = chat
+        else:
+            self._private_chats[frozenset(entry['user_ids'])] = chat
+        for user_id in entry['user_ids']:
+            self._apply_add_member({'chat_id': chat.id, 'user_id': user_id})
+        return chat
+
+    def _apply_add_member(self, entry: dict) -> MemberRecord:
+        member = MemberRecord(chat_id=entry['chat_id'], user_id=entry['user_id'])
+        self._members[(member.chat_id, member.user_id)] = member
+        self._chat_members[member.chat_id].append(member.user_id)
+        self._user_chats[member.user_id].append(member.chat_id)
+        return member
+
+    def _apply_save_member(self, entry: dict) -> None:
+        member = self._members[(entry['chat_id'], entry['user_id'])]
+        member.last_connect = self._date(entry['last_connect'])
+        member.cautions = entry['cautions']
+        member.banned = entry['banned']
+        member.banned_till = self._date(entry['banned_till'])
+        if 'unread_count' in entry:
+            member.unread_count = entry['unread_count']
+            member.last_read_message_id = entry['last_read_message_id']
+
+    def _apply_mark_read(self, entry: dict) -> None:
+        member = self._members[(entry['chat_id'], entry['user_id'])]
+        member.last_connect = self._date(entry['read_at'])
+        member.last_read_message_id = entry['message_id'] or member.last_read_message_id
+        last_read_message_id = member.last_read_message_id or 0
+        unread_count = 0
+        for message in reversed(self._chat_messages[member.chat_id]):
+            if message.id <= last_read_message_id:
+                break
+            if message.author_id != member.user_id:
+                unread_count += 1
+        member.unread_count = unread_count
+
+    def _apply_add_message(self, entry: dict) -> MessageRecord:
+        message = MessageRecord(
+            id=entry['id'],
+            chat_id=entry['chat_id'],
+            author_id=entry['author_id'],
+            author_name=self._users[entry['author_id']].user_name,
+            text=entry['text'],
+            pub_date=self._date(entry['pub_date'])
+        )
+        self._ids['messages'] = max(self._ids['messages'], message.id)
+        self._messages[message.id] = message
+        self._comment_ids[message.id] = []
+        position = bisect.bisect_right(self._chat_dates[message.chat_id], message.pub_date)
+        self._chat_dates[message.chat_id].insert(position, message.pub_date)
+        self._chat_messages[message.chat_id].insert(position, message)
+        self._chat_message_ids[message.chat_id].insert(position, message.id)
+        for user_id in self._chat_members[message.chat_id]:
+            member = self._members[(message.chat_id, user_id)]
+            if user_id == message.author_id:
+                member.last_connect = message.pub_date
+            else:
+                member.unread_count += 1
+        self._index_text(message.id * 2, message.text)
+        if entry.get('idempotency_key'):
+            self._idempotency_keys.add((message.author_id, entry['idempotency_key']))
+        return message
+
+    def _apply_add_comment(self, entry: dict) -> CommentRecord:
+        comment = CommentRecord(
+            id=entry['id'],
+            message_id=entry['message_id'],
+            author_id=entry['author_id'],
+            text=entry['text'],
+            created=self._date(entry['created']),
+            author_name=self._users[entry['author_id']].user_name
+        )
+        self._ids['comments'] = max(self._ids['comments'], comment.id)
+        self._comments[comment.id] = comment
+        message = self._messages[comment.message_id]
+        message.comments.append(comment)
+        message.comments_number += 1
+        self._comment_ids[message.id].append(comment.id)
+        self._index_text(comment.id * 2 + 1, comment.text)
+        if entry.get('idempotency_key'):
+            self._idempotency_keys.add((comment.author_id, entry['idempotency_key']))
+        return comment
+
+    def _index_text(self, rowid: int, text: str) -> None:
+        for term in search_terms(text):
+            postings = self._search_index.setdefault(term, {})
+            postings[rowid] = postings.get(rowid, 0) + 1
+
+    def get_user_by_token(self, token: str) -> Optional[UserRecord]:
+        if user := self._users_by_token.get(token):
+            return replace(user)
+
+    def get_user_by_name(self, user_name: str) -> Optional[UserRecord]:
+        if user := self._users_by_name.get(user_name):
+            return replace(user)
+
+    def create_user(self, user_name: str) -> UserRecord:
+        token = secrets.token_hex(16)
+        while token in self._users_by_token:
+            token = secrets.token_hex(16)
+        return self._write({
+            'op': 'create_user',
+            'id': self._next_id('users'),
+            'user_name': user_name,
+            'token': token,
+            'messages_in_hour_in_public_chat': 0,
+            'start_chatting_in_public_chat': datetime.datetime.utcnow().isoformat()
+        })
+
+    def create_users(self, user_names: list[str]) -> list[UserRecord]:
+        return [
+            self.create_user(user_name)
+            for user_name in dict.fromkeys(user_names)
+            if user_name not in self._users_by_name
+        ]
+
+    def save_user(self, user: UserRecord) -> None:
+        self._write({
+            'op': 'save_user',
+            'id': user.id,
+            'messages_in_hour_in_public_chat': user.messages_in_hour_in_public_chat,
+            'start_chatting_in_public_chat': self._iso(user.start_chatting_in_public_chat)
+        })
+
+    def get_public_chat(self, name: str = PUBLIC_CHAT_NAME) -> Optional[ChatRecord]:
+        return self._public_chats.get(name)
+
+    def public_chats(self) -> list[ChatRecord]:
+        return sorted(self._public_chats.values(), key=attrgetter('id'))
+
+    def create_public_chat(self, name: str) -> ChatRecord:
+        return self._write({
+            'op': 'create_chat',
+            'id': self._next_id('chats'),
+            'name': name,
+            'type': ChatType.PUBLIC.value,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'user_ids': []
+        })
+
+    def join_chat(self, chat_id: int, user_id: int) -> MemberRecord:
+        if (chat_id, user_id) not in self._members:
+            self._write({'op': 'add_member', 'chat_id': chat_id, 'user_id': user_id})
+        return replace(self._members[(chat_id, user_id)])
+
+    def get_private_chat(self, user_id: int, other_user_id: int) -> Optional[ChatRecord]:
+        return self._private_chats.get(frozenset((user_id, other_user_id)))
+
+    def create_private_chat(self, user_id: int, other_user_id: int) -> ChatRecord:
+        return self._write({
+            'op': 'create_chat',
+            'id': self._next_id('chats'),
+            'name': f'private-{int(time.time())}',
+            'type': ChatType.PRIVATE.value,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'user_ids': [user_id, other_user_id]
+        })
+
+    def get_member(self, chat_id: int, user_id: int) -> Optional[MemberRecord]:
+        if member := self._members.get((chat_id, user_id)):
+            return replace(member)
+
+    def save_member(self, member: MemberRecord) -> None:
+        self._write({
+            'op': 'save_member',
+            'chat_id': member.chat_id,
+            'user_id': member.user_id,
+            'last_connect': self._iso(member.last_connect),
+            'cautions': member.cautions,
+            'banned': member.banned,
+            'banned_till': self._iso(member.banned_till)
+        })
+
+    def mark_read(
+            self,
+            chat_id: int,
+            user_id: int,
+            message_id: Optional[int],
+            read_at: datetime.datetime
+    ) -> None:
+        self._write({
+            'op': 'mark_read',
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'message_id': message_id,
+            'read_at': self._iso(read_at)
+        })
+
+    def expire_bans(self, now: datetime.datetime) -> int:
+        expired = [
+            member
+            for member in self._members.values()
+            if member.banned and member.banned_till <= now
+        ]
+        for member in expired:
+            self.save_member(replace(member, banned=False, cautions=0, banned_till=None))
+        return len(expired)
+
+    def reset_rate_windows(self, started_before: datetime.datetime) -> int:
+        reset = [
+            user
+            for user in self._users.values()
+            if user.messages_in_hour_in_public_chat
+            and user.start_chatting_in_public_chat <= started_before
+        ]
+        for user in reset:
+            self.save_user(replace(user, messages_in_hour_in_public_chat=0))
+        return len(reset)
+
+    def next_ban_expiry(self) -> Optional[datetime.datetime]:
+        return min(
+            (member.banned_till for member in self._members.values() if member.banned),
+            default=None
+        )
+
+    def next_rate_window_start(self) -> Optional[datetime.datetime]:
+        return min(
+            (
+                user.start_chatting_in_public_chat
+                for user in self._users.values()
+                if user.messages_in_hour_in_public_chat
+            ),
+            default=None
+        )
+
+    def add_message(
+            self,
+            chat_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> MessageRecord:
+        message = self._write({
+            'op': 'add_message',
+            'id': self._next_id('messages'),
+            'chat_id': chat_id,
+            'author_id': author_id,
+            'text': text,
+            'pub_date': datetime.datetime.utcnow().isoformat(),
+            'idempotency_key': idempotency_key
+        })
+        logger.info('Message add to database.')
+        return message
+
+    def add_private_messages(
+            self,
+            author_id: int,
+            recipient_names: list[str],
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> dict[str, str]:
+        statuses = {}
+        now = datetime.datetime.utcnow()
+        for name in dict.fromkeys(recipient_names):
+            recipient = self._users_by_name.get(name)
+            if not recipient:
+                statuses[name] = DELIVERY_NOT_FOUND
+                continue
+            if recipient.id == author_id:
+                statuses[name] = DELIVERY_SELF
+                continue
+            chat = self.get_private_chat(author_id, recipient.id)
+            if not chat:
+                chat = self.create_private_chat(author_id, recipient.id)
+            member = self._members[(chat.id, author_id)]
+            if member.banned and member.banned_till > now:
+                statuses[name] = DELIVERY_BANNED
+                continue
+            self.add_message(chat.id, author_id, text, idempotency_key)
+            statuses[name] = DELIVERY_SENT
+        return statuses
+
+    @staticmethod
+    def _preview(message: MessageRecord) -> MessageRecord:
+        return replace(message, comments=message.comments[:COMMENTS_PREVIEW_SIZE])
+
+    def get_message(self, message_id: int) -> Optional[MessageRecord]:
+        if message := self._messages.get(message_id):
+            return self._preview(message)
+
+    def add_comment(
+            self,
+            message_id: int,
+            author_id: int,
+            text: str,
+            idempotency_key: Optional[str] = None
+    ) -> CommentRecord:
+        return self._write({
+            'op': 'add_comment',
+            'id': self._next_id('comments'),
+            'message_id': message_id,
+            'author_id': author_id,
+            'text': text,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'idempotency_key': idempotency_key
+        })
+
+    def idempotency_key_used(self, author_id: int, idempotency_key: str) -> bool:
+        return (author_id, idempotency_key) in self._idempotency_keys
+
+    def comments(
+            self,
+            message_id: int,
+            after_id: Optional[int],
+            limit: int
+    ) -> list[CommentRecord]:
+        if not (message := self._messages.get(message_id)):
+            return []
+        start = bisect.bisect_right(self._comment_ids[message_id], after_id or 0)
+        return message.comments[start:start + limit]
+
+    def last_messages(
+            self,
+            chat_id: int,
+            before: datetime.datetime,
+            limit: int
+    ) -> list[MessageRecord]:
+        end = bisect.bisect_left(self._chat_dates[chat_id], before)
+        return [
+            self._preview(message)
+            for message in self._chat_messages[chat_id][max(end - limit, 0):end][::-1]
+        ]
+
+    def unread_messages(
+            self,
+            chat_id: int,
+            after: datetime.datetime
+    ) -> list[MessageRecord]:
+        start = bisect.bisect_right(self._chat_dates[chat_id], after)
+        return [self._preview(message) for message in self._chat_messages[chat_id][start:]]
+
+    def messages_after(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        start = bisect.bisect_right(self._chat_message_ids[chat_id], after_id)
+        return [
+            self._preview(message)
+            for message in self._chat_messages[chat_id][start:start + limit]
+        ]
+
+    def export_messages(
+            self,
+            chat_id: int,
+            after_id: int,
+            limit: int
+    ) -> list[MessageRecord]:
+        start = bisect.bisect_right(self._chat_message_ids[chat_id], after_id)
+        return [
+            replace(message, comments=list(message.comments))
+            for message in self._chat_messages[chat_id][start:start + limit]
+        ]
+
+    def archived_messages(
+            self,
+            chat_id: int,
+            before_id: Optional[int],
+            limit: int
+    ) -> list[MessageRecord]:
+        return []
+
+    def archive_marker(self, chat_id: int) -> Optional[ArchiveMarker]:
+        return None
+
+    def chat_summaries(self, user_id: int) -> list[ChatSummary]:
+        summaries = []
+        for chat_id in self._user_chats.get(user_id, []):
+            chat = self._chats[chat_id]
+            members = self._chat_members[chat_id]
+            title = chat.name
+            if chat.type == ChatType.PRIVATE:
+                other_ids = [member_id for member_id in members if member_id != user_id]
+                title = self._users[other_ids[0] if other_ids else user_id].user_name
+            summaries.append(ChatSummary(
+                chat=chat,
+                title=title,
+                messages_number=len(self._chat_messages[chat_id]),
+                users_number=len(members)
+            ))
+        return summaries
+
+    def unread_counters(self, user_id: int) -> list[UnreadCounter]:
+        counters = []
+        for chat_id in self._user_chats.get(user_id, []):
+            chat = self._chats[chat_id]
+            member = self._members[(chat_id, user_id)]
+            title = chat.name
+            if chat.type == ChatType.PRIVATE:
+                other_ids = [
+                    member_id
+                    for member_id in self._chat_members[chat_id]
+                    if member_id != user_id
+                ]
+                title = self._users[other_ids[0]].user_name if other_ids else chat.name
+            counters.append(UnreadCounter(
+                chat=chat,
+                title=title,
+                unread_count=member.unread_count,
+                last_read_message_id=member.last_read_message_id
+            ))
+        return counters
+
+    def search(
+            self,
+            user_id: int,
+            query: str,
+            limit: int,
+            after: Optional[str] = None
+    ) -> list[SearchHit]:
+        after_position = decode_cursor(after)
+        terms = search_terms(query)
+        postings = sorted(
+            (self._search_index.get(term, {}) for term in terms),
+            key=len
+        )
+        if not postings:
+            return []
+        chat_ids = set(self._user_chats.get(user_id, []))
+        ranked = []
+        for rowid in postings[0]:
+            if not all(rowid in term_postings for term_postings in postings[1:]):
+                continue
+            if rowid % 2:
+                item = self._comments[rowid // 2]
+                message = self._messages[item.message_id]
+                created = item.created
+            else:
+                item = message = self._messages[rowid // 2]
+                created = message.pub_date
+            if message.chat_id not in chat_ids:
+                continue
+            score = -float(sum(term_postings[rowid] for term_postings in postings))
+            if (score, rowid) > after_position:
+                ranked.append((score, rowid, item, message, created))
+        ranked.sort(key=lambda hit: hit[:2])
+        return [
+            make_hit(
+                rowid=rowid,
+                message_id=message.id,
+                chat_id=message.chat_id,
+                text=item.text,
+                author_name=self._users[item.author_id].user_name,
+                created=created,
+                score=score
+            )
+            for score, rowid, item, message, created in ranked[:limit]
+        ]
+
+    def sync(self) -> None:
+        """
+        Flush and fsync log entries written since the last call.
+        """
+        if not self._log_dirty:
+            return
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_dirty = False
+
+    def _dump_state(self) -> dict:
+        return {
+            'lsn': self._lsn,
+            'ids': dict(self._ids),
+            'users': [
+                {**asdict(user), 'start_chatting_in_public_chat': self._iso(
+                    user.start_chatting_in_public_chat
+                )}
+                for user in self._users.values()
+            ],
+            'chats': [
+                {
+                    'id': chat.id,
+                    'name': chat.name,
+                    'type': chat.type.value,
+                    'created': self._iso(chat.created),
+                    'user_ids': list(self._chat_members[chat.id])
+                }
+                for chat in self._chats.values()
+            ],
+            'members': [
+                {
+                    'chat_id': member.chat_id,
+                    'user_id': member.user_id,
+                    'last_connect': self._iso(member.last_connect),
+                    'cautions': member.cautions,
+                    'banned': member.banned,
+                    'banned_till': self._iso(member.banned_till),
+                    'unread_count': member.unread_count,
+                    'last_read_message_id': member.last_read_message_id
+                }
+                for member in self._members.values()
+            ],
+            'messages': [
+                {
+                    'id': message.id,
+                    'chat_id': message.chat_id,
+                    'author_id': message.author_id,
+                    'text': message.text,
+                    'pub_date': self._iso(message.pub_date)
+                }
+                for message in self._messages.values()
+            ],
+            'comments': [
+                {**asdict(comment), 'created': self._iso(comment.created)}
+                for comment in self._comments.values()
+            ],
+            'idempotency_keys': [list(key) for key in self._idempotency_keys]
+        }
+
+    def _rotate_log(self) -> tuple[dict, list[str]]:
+        """
+        Start a new log file, unless the current one is empty, and capture state
+        covered by the previous ones. Only logs starting before the current one
+        are returned, every entry of them is in the captured state.
+        """
+        self.sync()
+        if self._lsn >= self._log_lsn:
+            self._log.close()
+            self._open_log()
+        old_logs = [
+            log_path
+            for log_path in glob.glob(os.path.join(self.data_dir, self.LOG_FILE_PATTERN))
+            if int(os.path.basename(log_path)[4:-4]) < self._log_lsn
+        ]
+        return self._dump_state(), old_logs
+
+    def _write_snapshot(self, state: dict, old_logs: list[str]) -> None:
+        path = os.path.join(self.data_dir, self.SNAPSHOT_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(state, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        for log_path in old_logs:
+            os.remove(log_path)
+        logger.info('Snapshot at lsn %s saved.', state['lsn'])
+
+    def snapshot(self) -> None:
+        self._write_snapshot(*self._rotate_log())
+
+    def _restore(self) -> int:
+        self._load_snapshot()
+        replayed = 0
+        for log_path in sorted(glob.glob(os.path.join(self.data_dir, self.LOG_FILE_PATTERN))):
+            replayed += self._replay_log(log_path)
+        logger.info('Memory storage restored at lsn %s.', self._lsn)
+        return replayed
+
+    def _load_snapshot(self) -> None:
+        snapshot_path = os.path.join(self.data_dir, self.SNAPSHOT_FILE)
+        if not os.path.exists(snapshot_path):
+            return
+        with open(snapshot_path, encoding='utf-8') as file:
+            state = json.load(file)
+        for user in state['users']:
+            self._apply_create_user(user)
+        for chat in state['chats']:
+            self._apply_create_chat(chat)
+        for message in state['messages']:
+            self._apply_add_message(message)
+        for comment in state['comments']:
+            self._apply_add_comment(comment)
+        for member in state['members']:
+            self._apply_save_member(member)
+        self._idempotency_keys.update(
+            tuple(key) for key in state.get('idempotency_keys', [])
+        )
+        self._ids.update(state['ids'])
+        self._lsn = state['lsn']
+
+    def _replay_log(self, log_path: str) -> int:
+        """
+        Apply log entries newer than the restored state, returns their number.
+        """
+        replayed = 0
+        with open(log_path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning('Skip torn log entry in %s', log_path)
+                    break
+                if entry['lsn'] <= self._lsn:
+                    continue
+                self._apply(entry)
+                self._lsn = entry['lsn']
+                replayed += 1
+        return replayed
+
+    async def run_maintenance(self) -> None:
+        loop = asyncio.get_running_loop()
+        last_snapshot = loop.time()
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            self.sync()
+            if loop.time() - last_snapshot >= self.snapshot_interval:
+                last_snapshot = loop.time()
+                await loop.run_in_executor(None, self._write_snapshot, *self._rotate_log())
+
+    def close(self) -> None:
+        self.snapshot()
+        self._log.close()
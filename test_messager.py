@@ -1,18 +1,38 @@
+import asyncio
 import datetime
+import http.client
 import json
-import os
+import logging
+import socket
 import time
 
 import h11
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
+import protocol
+from admission import AdmissionController
+from capture import REDACTED, TrafficRecorder, read_capture
+from client import Client
+from coalescing import ReadCoalescer
+from connections import ConnectionManager, TimerWheel
+from database import DatabaseSettings, create_db_engine, memory_database_url
 from enums import ChatType
-from models import Chat, ChatUser, Comment, Message, User
-
-
-basedir = os.path.abspath(os.path.dirname(__file__))
-engine = create_engine('sqlite:///' + os.path.join(basedir, 'data.sqlite'), echo=True)
+from idempotency import IdempotencyCache
+from models import Chat, ChatArchive, ChatUser, Comment, Message, User
+from presence import PresenceRegistry
+from protocol import HTTPProtocol, router
+from provisioning import provision_users, read_user_names, write_tokens
+from replay import Replayer, latency_report, read_tokens
+from retention import RetentionJob, create_archive_engine
+from rooms import RoomDirectory
+from router import RateLimiter
+from scheduler import BAN_EXPIRY, RATE_WINDOW, ModerationScheduler
+from search import encode_cursor
+from serialization import JSONCodec, MessagePackCodec, negotiate
+from server import EmbeddedServer
+from storage import MemoryStorage, MessageRecord, SQLStorage
+from tracing import RequestTracer
+from utils import SamplingFilter
 
 
 def test_connection(client_one):
@@ -41,13 +61,13 @@ def test_get_encode_body_from_data_method(protocol_object):
     assert t_dict == json.loads(result.decode('utf-8'))
 
 
-def test_get_token(client_one):
-    with open('client.txt') as file:
+def test_get_token(client_one, db_engine, tokens_file):
+    with open(tokens_file) as file:
         for line in file:
             user_name, token = line.split()
             if user_name == client_one.user_name:
                 break
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         client_obj = session.query(User).filter_by(user_name=client_one.user_name).first()
 
     assert client_one._token.split()[1] == token
@@ -55,7 +75,6 @@ def test_get_token(client_one):
 
 
 def test_get_status(client_one):
-    time.sleep(1)
     client_one.get_status()
     result = client_one.last_status
     assert result.get('connected_as')
@@ -63,13 +82,11 @@ def test_get_status(client_one):
     assert result.get('chats')
 
 
-def test_send_message_to_public_chat(client_one):
-    time.sleep(1)
+def test_send_message_to_public_chat(client_one, db_engine):
     message_text = str(time.time())
     client_one.send_message(message=message_text)
-    time.sleep(2)
     response, chat_info = client_one.response, client_one.last_chat_info
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         message_obj = session.query(Message).filter_by(text=message_text).first()
     assert message_obj
     assert response['info'] == 'Message have sent!'
@@ -79,9 +96,9 @@ def test_send_message_to_public_chat(client_one):
             break
 
 
-def test_message_limit(client_one):
+def test_message_limit(client_one, db_engine):
     start_time = datetime.datetime.now()
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         user_obj = session.query(User).filter_by(user_name=client_one.user_name).first()
         user_obj.messages_in_hour_in_public_chat = 20
         user_obj.start_chatting_in_public_chat = start_time
@@ -89,29 +106,28 @@ def test_message_limit(client_one):
     message_text = 'test_limit'
     client_one.send_message(message=message_text)
     response, chat_info = client_one.response, client_one.last_chat_info
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         message_obj = session.query(Message).filter_by(text=message_text).first()
     finish_time = (start_time + datetime.timedelta(minutes=60)).strftime("%d.%m.%Y, %H:%M:%S")
     assert message_obj is None
     assert response['warning'].startswith('message limit has been reached')
     assert response['warning'].endswith(finish_time)
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         user_obj = session.query(User).filter_by(user_name=client_one.user_name).first()
         user_obj.messages_in_hour_in_public_chat = 0
         user_obj.start_chatting_in_public_chat = start_time
         session.commit()
 
 
-def test_comment(client_one, client_two):
+def test_comment(client_one, client_two, db_engine):
     message_text = str(time.time())
     client_one.send_message(message=message_text)
-    time.sleep(2)
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         message_obj = session.query(Message).filter_by(text=message_text).first()
     comment_text = str(time.time())
     client_two.add_comment(message_obj.id, comment=comment_text)
     response, chat_info = client_two.response, client_two.last_chat_info
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         comment_obj = session.query(Comment).filter_by(text=comment_text).first()
         assert comment_obj
         assert comment_obj.message_id == message_obj.id
@@ -119,23 +135,21 @@ def test_comment(client_one, client_two):
         assert comment_obj.author.user_name == client_two.user_name
 
 
-def test_private_message(client_one, client_two):
+def test_private_message(client_one, client_two, db_engine):
     message_text = str(time.time())
     client_one.send_message(receiver=client_two.user_name, message=message_text)
-    time.sleep(4)
     client_two.connect_to_chat(chat_name=client_one.user_name)
     assert client_two.last_chat_info.get('unread_messages')
     assert client_two.last_chat_info['unread_messages'][0]['message_text'] == message_text
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         message_obj = session.query(Message).filter_by(text=message_text).first()
         chat_obj = session.query(Chat).filter_by(id=message_obj.chat_id).first()
         assert chat_obj
         assert message_obj
-    time.sleep(2)
 
 
-def test_report(client_one, client_two):
-    with Session(engine) as session:
+def test_report(client_one, client_two, db_engine):
+    with Session(db_engine) as session:
         user_obj = session.query(User).filter_by(user_name=client_one.user_name).first()
         chat_obj = session.query(Chat).filter_by(name='public_chat').first()
         chat_user_obj = session.query(ChatUser).filter_by(
@@ -145,17 +159,15 @@ def test_report(client_one, client_two):
         ).first()
         chat_user_obj.cautions = 2
         session.commit()
-    time.sleep(2)
     client_two.report(report_on=client_one.user_name, chat_type=ChatType.PUBLIC)
-    time.sleep(2)
     message_text = str(time.time())
     client_one.send_message(message=message_text)
     response, chat_info = client_one.response, client_one.last_chat_info
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         message_obj = session.query(Message).filter_by(text=message_text).first()
     assert message_obj is None
     assert response['warning'].startswith('You are banned!')
-    with Session(engine) as session:
+    with Session(db_engine) as session:
         user_obj = session.query(User).filter_by(user_name=client_one.user_name).first()
         chat_obj = session.query(Chat).filter_by(name='public_chat').first()
         chat_user_obj = session.query(ChatUser).filter_by(
@@ -169,4 +181,902 @@ def test_report(client_one, client_two):
         chat_user_obj.banned = False
         chat_user_obj.banned_till = None
         session.commit()
-    time.sleep(2)
+
+
+def test_request_tracer_counts_queries(db_engine):
+    tracer = RequestTracer(slow_request_ms=0)
+    tracer.instrument(db_engine)
+    with tracer.trace('GET', '/status') as request_trace:
+        with Session(db_engine) as session:
+            session.query(User).first()
+            session.query(User).first()
+    assert request_trace.query_count == 2
+    assert len(request_trace.queries) == 1
+    assert request_trace.duration >= request_trace.query_time
+
+
+def test_sampling_filter():
+    sampling_filter = SamplingFilter(rate=0, messages=['sampled'])
+    record = logging.LogRecord('protocol', logging.INFO, __file__, 0, 'sampled', None, None)
+    assert not sampling_filter.filter(record)
+    record.msg = 'not sampled'
+    assert sampling_filter.filter(record)
+    record.msg, record.levelno = 'sampled', logging.ERROR
+    assert sampling_filter.filter(record)
+    assert any(
+        isinstance(configured, SamplingFilter)
+        and 'Message add to database.' in configured.messages
+        for configured in logging.getLogger('storage').filters
+    )
+
+
+def test_database_pragmas(monkeypatch, tmp_path):
+    monkeypatch.setenv('MESSENGER_DB_BUSY_TIMEOUT', '1234')
+    settings = DatabaseSettings(synchronous='FULL')
+    assert settings.busy_timeout == 1234
+    assert settings.synchronous == 'FULL'
+    file_engine = create_db_engine(DatabaseSettings(url=f'sqlite:///{tmp_path}/pragmas.sqlite'))
+    with file_engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1
+    memory_engine = create_db_engine(DatabaseSettings(url=memory_database_url('pragmas')))
+    with memory_engine.connect() as first, memory_engine.connect() as second:
+        first.exec_driver_sql('CREATE TABLE shared (id INTEGER)')
+        assert second.exec_driver_sql('SELECT count(*) FROM shared').scalar() == 0
+
+
+def test_memory_storage_restore(tmp_path):
+    memory_storage = MemoryStorage(data_dir=str(tmp_path))
+    user = memory_storage.create_user('memory_user')
+    public_chat = memory_storage.get_public_chat()
+    memory_storage.join_chat(public_chat.id, user.id)
+    message = memory_storage.add_message(public_chat.id, user.id, 'memory message')
+    comment = memory_storage.add_comment(message.id, user.id, 'memory comment')
+    memory_storage.sync()
+
+    restored = MemoryStorage(data_dir=str(tmp_path))
+    assert restored.get_user_by_token(user.token).user_name == 'memory_user'
+    unread = restored.unread_messages(public_chat.id, datetime.datetime.min)
+    assert [item.text for item in unread] == ['memory message']
+    assert unread[0].comments[0].text == 'memory comment'
+    assert [item.text for item in restored.comments(message.id, None, 10)] == ['memory comment']
+    assert restored.comments(message.id, comment.id, 10) == []
+    exported = restored.export_messages(public_chat.id, 0, 10)
+    assert [(item.text, item.comments_number) for item in exported] == [('memory message', 1)]
+    assert restored.get_member(public_chat.id, user.id).last_connect == message.pub_date
+    restored.close()
+
+    from_snapshot = MemoryStorage(data_dir=str(tmp_path))
+    assert from_snapshot.chat_summaries(user.id)[0].messages_number == 1
+    assert from_snapshot.create_user('memory_user_2').id == user.id + 1
+
+
+def test_memory_storage_back_to_back_snapshots(tmp_path):
+    memory_storage = MemoryStorage(data_dir=str(tmp_path))
+    memory_storage.snapshot()
+    memory_storage.snapshot()
+    memory_storage.create_user('snapshot_user')
+    memory_storage.sync()
+    assert len(list(tmp_path.glob(MemoryStorage.LOG_FILE_PATTERN))) == 1
+
+    restored = MemoryStorage(data_dir=str(tmp_path))
+    assert restored.get_user_by_name('snapshot_user') is not None
+    restored.close()
+
+
+def test_retention_job_archives_old_messages(sql_engine, tmp_path):
+    archive_engine = create_archive_engine(f'sqlite:///{tmp_path}/archive.sqlite')
+    old_date = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+    with Session(sql_engine) as session:
+        user_obj = User(user_name='retention_user', token='retention_token')
+        chat_obj = session.query(Chat).filter_by(name='public_chat').one()
+        old_message = Message(text='old', author=user_obj, chat=chat_obj, pub_date=old_date)
+        Comment(text='old comment', author=user_obj, message=old_message)
+        Message(text='new', author=user_obj, chat=chat_obj)
+        session.add(user_obj)
+        session.commit()
+        chat_id = chat_obj.id
+    job = RetentionJob(
+        engine=sql_engine,
+        archive_engine=archive_engine,
+        retention={ChatType.PUBLIC: datetime.timedelta(days=1)}
+    )
+    assert asyncio.run(job.run_once()) == 1
+    with Session(sql_engine) as session:
+        assert [message.text for message in session.query(Message)] == ['new']
+        assert session.query(Comment).count() == 0
+        assert session.get(ChatArchive, chat_id).messages_number == 1
+    archived = SQLStorage(sql_engine, archive_engine).archived_messages(chat_id, None, 20)
+    assert [message.text for message in archived] == ['old']
+    assert archived[0].author_name == 'retention_user'
+    assert archived[0].comments[0].text == 'old comment'
+    assert archived[0].comments[0].author_name == 'retention_user'
+    marker = SQLStorage(sql_engine, archive_engine).archive_marker(chat_id)
+    assert marker.archived_till == old_date and marker.messages_number == 1
+    assert SQLStorage(sql_engine).archive_marker(chat_id) is None
+    archive_url = f'sqlite:///{tmp_path}/archive.sqlite'
+    with EmbeddedServer(engine=sql_engine, archive_url=archive_url) as server:
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        connection.request(
+            'POST',
+            '/connect',
+            body=b'{"archive": true, "messages_number": 1}',
+            headers={'Authorization': 'Bearer retention_token'}
+        )
+        result = json.loads(connection.getresponse().read())
+        connection.close()
+    assert result['archive']['messages_number'] == 1 and result['next'] == archived[0].id
+    assert [message['message_text'] for message in result['messages']] == ['old']
+
+
+def test_search_in_user_chats(storage):
+    author = storage.create_user('search_author')
+    reader = storage.create_user('search_reader')
+    stranger = storage.create_user('search_stranger')
+    public_chat = storage.get_public_chat()
+    for user in (author, reader):
+        storage.join_chat(public_chat.id, user.id)
+    private_chat = storage.create_private_chat(author.id, reader.id)
+    first = storage.add_message(public_chat.id, author.id, 'hello world')
+    storage.add_comment(first.id, reader.id, 'hello hello world')
+    storage.add_message(private_chat.id, author.id, 'secret world')
+
+    hits = storage.search(reader.id, 'Hello', 10)
+    assert [hit.kind for hit in hits] == ['comment', 'message']
+    assert hits[0].message_id == first.id
+    assert hits[0].author_name == 'search_reader'
+    first_page = storage.search(reader.id, 'world', 2)
+    next_page = storage.search(reader.id, 'world', 2, encode_cursor(first_page[-1]))
+    assert len(first_page) == 2
+    assert sorted(hit.text for hit in first_page + next_page) == [
+        'hello hello world', 'hello world', 'secret world'
+    ]
+    assert [hit.text for hit in storage.search(stranger.id, 'secret', 10)] == []
+    assert storage.search(reader.id, 'hello secret', 10) == []
+    assert storage.search(reader.id, '!!!', 10) == []
+
+
+def test_search_without_words(client_one, test_server):
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    headers = {'Authorization': client_one._token}
+    for query in ('!!!', 'world'):
+        connection.request('POST', '/search', body=json.dumps({'query': query}), headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == (400 if query == '!!!' else 200)
+    connection.close()
+
+
+def test_failed_request(client_one, test_server, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('storage failure')
+
+    monkeypatch.setattr(test_server.server.storage, 'search', fail)
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    headers = {'Authorization': client_one._token}
+    for target, body, status in [
+        ('/search', {'query': 'world'}, 500),
+        ('/connect', {'messages_number': 'abc'}, 400),
+        ('/connect', {'before_id': -1}, 400),
+        ('/connect', {'messages_number': 5}, 200),
+    ]:
+        connection.request('POST', target, body=json.dumps(body), headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == status
+    connection.close()
+
+
+def test_history_loads_comments_in_batch(sql_engine):
+    with Session(sql_engine) as session:
+        user_obj = User(user_name='history_user', token='history_token')
+        chat_obj = session.query(Chat).filter_by(name='public_chat').one()
+        user_obj.chats.append(chat_obj)
+        for number in range(5):
+            message_obj = Message(text=f'message {number}', author=user_obj, chat=chat_obj)
+            for comment_number in range(number):
+                Comment(text=f'comment {comment_number}', author=user_obj, message=message_obj)
+        session.add(user_obj)
+        session.commit()
+        chat_id = chat_obj.id
+    tracer = RequestTracer(slow_request_ms=0)
+    tracer.instrument(sql_engine)
+    history_storage = SQLStorage(sql_engine)
+    with tracer.trace('POST', '/connect') as request_trace:
+        messages = history_storage.unread_messages(chat_id, datetime.datetime.min)
+    assert request_trace.query_count == 2
+    assert [message.comments_number for message in messages] == [0, 1, 2, 3, 4]
+    assert [comment.text for comment in messages[4].comments] == [
+        'comment 0', 'comment 1', 'comment 2'
+    ]
+    assert messages[4].comments[0].author_name == 'history_user'
+    with tracer.trace('GET', '/status') as request_trace:
+        summaries = history_storage.chat_summaries(messages[0].author_id)
+    assert request_trace.query_count == 1
+    assert [(summary.title, summary.messages_number) for summary in summaries] == [
+        ('public_chat', 5)
+    ]
+    first_page = history_storage.comments(messages[4].id, None, 3)
+    next_page = history_storage.comments(messages[4].id, first_page[-1].id, 3)
+    assert [comment.text for comment in next_page] == ['comment 3']
+    missed = history_storage.messages_after(chat_id, messages[1].id, 2)
+    assert [message.text for message in missed] == ['message 2', 'message 3']
+    exported = history_storage.export_messages(chat_id, messages[3].id, 2)
+    assert [comment.text for comment in exported[0].comments] == [
+        'comment 0', 'comment 1', 'comment 2', 'comment 3'
+    ]
+    assert len(exported) == 1 and exported[0].comments_number == 4
+
+
+def test_unread_counters(storage):
+    author = storage.create_user('unread_author')
+    reader = storage.create_user('unread_reader')
+    public_chat = storage.get_public_chat()
+    for user in (author, reader):
+        storage.join_chat(public_chat.id, user.id)
+    private_chat = storage.create_private_chat(author.id, reader.id)
+    first = storage.add_message(public_chat.id, author.id, 'first')
+    storage.add_message(public_chat.id, author.id, 'second')
+    storage.add_message(private_chat.id, author.id, 'private')
+    counters = {
+        counter.title: counter.unread_count
+        for counter in storage.unread_counters(reader.id)
+    }
+    assert counters == {'public_chat': 2, 'unread_author': 1}
+    missed = storage.messages_after(public_chat.id, first.id, 10)
+    assert [message.text for message in missed] == ['second']
+    exported = storage.export_messages(public_chat.id, first.id, 10)
+    assert [message.text for message in exported] == ['second']
+    assert storage.unread_counters(author.id)[0].unread_count == 0
+
+    storage.mark_read(public_chat.id, reader.id, first.id, datetime.datetime.utcnow())
+    member = storage.get_member(public_chat.id, reader.id)
+    assert member.unread_count == 1
+    assert member.last_read_message_id == first.id
+
+
+def test_multicast_private_messages(storage):
+    author = storage.create_user('announcer')
+    storage.create_users(['reader_1', 'reader_2', 'blocker'])
+    reader = storage.get_user_by_name('reader_1')
+    blocker = storage.get_user_by_name('blocker')
+    existing_chat = storage.create_private_chat(author.id, reader.id)
+    blocked_chat = storage.create_private_chat(author.id, blocker.id)
+    member = storage.get_member(blocked_chat.id, author.id)
+    member.banned = True
+    member.banned_till = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    storage.save_member(member)
+
+    statuses = storage.add_private_messages(
+        author.id,
+        ['reader_1', 'reader_2', 'reader_2', 'blocker', 'nobody', 'announcer'],
+        'announcement'
+    )
+    assert statuses == {
+        'reader_1': 'sent',
+        'reader_2': 'sent',
+        'blocker': 'banned',
+        'nobody': 'not_found',
+        'announcer': 'self'
+    }
+    now = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+    assert [
+        message.text
+        for message in storage.last_messages(existing_chat.id, now, 10)
+    ] == ['announcement']
+    new_reader = storage.get_user_by_name('reader_2')
+    new_chat = storage.get_private_chat(author.id, new_reader.id)
+    assert storage.get_member(new_chat.id, new_reader.id).unread_count == 1
+    assert not storage.last_messages(blocked_chat.id, now, 10)
+
+
+def test_timer_wheel_and_connection_limits():
+    async def fire_timers():
+        wheel = TimerWheel(resolution=0.01, slots=8)
+        wheel.start()
+        fired = []
+        wheel.call_later(0.03, lambda: fired.append('short'))
+        wheel.call_later(0.15, lambda: fired.append('long'))
+        wheel.call_later(0.02, lambda: fired.append('cancelled')).cancel()
+        await asyncio.sleep(0.1)
+        assert fired == ['short']
+        await asyncio.sleep(0.1)
+        wheel.stop()
+        return fired
+
+    assert asyncio.run(fire_timers()) == ['short', 'long']
+    connections = ConnectionManager(max_connections=3, max_connections_per_ip=2)
+    assert connections.acquire('10.0.0.1')
+    assert connections.acquire('10.0.0.1')
+    assert not connections.acquire('10.0.0.1')
+    assert connections.acquire('10.0.0.2')
+    assert not connections.acquire('10.0.0.3')
+    connections.release('10.0.0.1')
+    assert connections.per_ip == {'10.0.0.1': 1, '10.0.0.2': 1}
+
+
+def test_request_read_timeout(db_engine):
+    with EmbeddedServer(engine=db_engine, keep_alive_timeout=10, request_timeout=1) as server:
+        with socket.create_connection(('127.0.0.1', server.port), timeout=8) as sock:
+            started = time.monotonic()
+            sock.sendall(b'GET /status HTTP/1.1\r\nHost: local')
+            assert sock.recv(65536) == b''
+            assert time.monotonic() - started < 3
+
+
+def test_connection_drain():
+    async def drain():
+        connections = ConnectionManager()
+        connections.start()
+        server = await asyncio.get_running_loop().create_server(
+            lambda: HTTPProtocol(connections=connections), '127.0.0.1', 0
+        )
+        port = server.sockets[0].getsockname()[1]
+        idle_reader, _ = await asyncio.open_connection('127.0.0.1', port)
+        busy_reader, busy_writer = await asyncio.open_connection('127.0.0.1', port)
+        await asyncio.sleep(0.05)
+        busy_writer.write(b'GET /unknown HTTP/1.1\r\nHost: test\r\n')
+        await asyncio.sleep(0.05)
+        server.close()
+        drained = asyncio.create_task(connections.drain(timeout=5))
+        assert await idle_reader.read() == b''
+        busy_writer.write(b'\r\n')
+        response = await busy_reader.read()
+        aborted = await drained
+        connections.stop()
+        return response, aborted, connections.active
+
+    response, aborted, active = asyncio.run(drain())
+    assert response.startswith(b'HTTP/1.1 404') and b'connection: close' in response.lower()
+    assert aborted == 0 and active == 0
+
+
+def test_capture_and_replay(client_one, tmp_path, db_engine, tokens_file):
+    capture_file = str(tmp_path / 'capture.log')
+    captured = [
+        {'t': 0.0, 'm': 'GET', 'p': '/status', 'b': b'', 'u': client_one.user_name,
+         'h': [['Host', 'test'], ['Authorization', REDACTED]]},
+        {'t': 0.01, 'm': 'GET', 'p': '/unknown?page=1', 'b': b'', 'h': [['Host', 'test']]}
+    ]
+
+    async def capture_and_replay():
+        recorder = TrafficRecorder(capture_file)
+        server = await asyncio.get_running_loop().create_server(
+            lambda: HTTPProtocol(storage=SQLStorage(db_engine), recorder=recorder), '127.0.0.1', 0
+        )
+        replayer = Replayer(
+            port=server.sockets[0].getsockname()[1],
+            speed=None,
+            connections=2,
+            tokens=read_tokens(tokens_file)
+        )
+        await replayer.replay(captured)
+        recorder.close()
+        replayed = await replayer.replay(list(read_capture(capture_file)))
+        server.close()
+        return replayed
+
+    replayed = asyncio.run(capture_and_replay())
+    entries = sorted(read_capture(capture_file), key=lambda entry: entry['p'])
+    assert [(entry['p'], entry['s'], entry.get('u')) for entry in entries] == [
+        ('/status', 200, client_one.user_name),
+        ('/unknown?page=1', 404, None)
+    ]
+    assert ['authorization', REDACTED] in entries[0]['h']
+    assert client_one._token.split()[1] not in open(capture_file).read()
+    report = latency_report(replayed)
+    assert sorted(report) == ['GET /status', 'GET /unknown']
+    assert report['GET /status']['requests'] == 1
+    assert report['GET /status']['status_mismatches'] == 0
+
+
+def test_presence_registry():
+    presence = PresenceRegistry()
+    changes = []
+    presence.subscribe(changes.append)
+    presence.connection_made()
+    presence.join(1, 'first')
+    presence.join(2, 'second')
+    presence.leave(2)
+    assert [user.user_name for user in presence.publish()] == ['first']
+    presence.leave(1)
+    presence.join(1, 'first')
+    assert not presence.publish()
+    presence.connection_lost(1)
+    presence.publish()
+    assert [(user.user_name, user.online) for user in changes[-1]] == [('first', False)]
+    assert presence.open_connections == 0
+    assert [user.user_name for user in presence.users(['second', 'unknown'])] == ['second']
+    assert presence.users() == []
+    presence.joined_public_chat(2)
+    assert [user.user_name for user in presence.users()] == ['second']
+    assert len(changes) == 2
+
+
+def test_presence_endpoint(client_one, test_server):
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    connection.request(
+        'GET',
+        '/presence?users=test_client1,nobody',
+        headers={'Authorization': client_one._token}
+    )
+    response = connection.getresponse()
+    result = json.loads(response.read())
+    assert response.status == 200
+    assert result['online'] == 1 and result['unknown'] == ['nobody']
+    assert result['users'][0]['user_name'] == 'test_client1'
+    connection.close()
+
+
+def test_presence_of_public_chat(test_server):
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    connection.request('POST', '/get-token', body=json.dumps({'user_name': 'presence_client'}))
+    headers = {'Authorization': f"Bearer {json.loads(connection.getresponse().read())['token']}"}
+
+    def public_chat_users():
+        connection.request('GET', '/presence', headers=headers)
+        return [user['user_name'] for user in json.loads(connection.getresponse().read())['users']]
+
+    assert 'presence_client' not in public_chat_users()
+    body = json.dumps({'messages_number': 1})
+    connection.request('POST', '/connect', body=body, headers=headers)
+    connection.getresponse().read()
+    assert 'presence_client' in public_chat_users()
+    connection.close()
+
+
+def test_idempotency_cache():
+    cache = IdempotencyCache(max_entries=2, ttl=60)
+    cache.put(1, 'first', ['first response'])
+    cache.put(1, 'second', ['second response'])
+    assert cache.get(1, 'first') == ['first response']
+    cache.put(2, 'first', ['other user response'])
+    assert cache.get(1, 'second') is None
+    assert cache.get(1, 'first') == ['first response']
+    expired = IdempotencyCache(ttl=0)
+    expired.put(1, 'key', ['response'])
+    assert expired.get(1, 'key') is None and not len(expired)
+
+
+def test_idempotent_send(client_one, client_two, test_server, db_engine, monkeypatch):
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    headers = {'Authorization': client_one._token, 'Idempotency-Key': 'send-once'}
+    responses = []
+    for _ in range(2):
+        connection.request('POST', '/send', body=b'{"message": "sent once"}', headers=headers)
+        response = connection.getresponse()
+        responses.append((response.status, response.read()))
+    connection.close()
+    assert responses[0] == responses[1] and responses[0][0] == 201
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    connection.request(
+        'POST',
+        '/send',
+        body=b'{"message": "sent once"}',
+        headers={**headers, 'Accept': 'application/msgpack'}
+    )
+    response = connection.getresponse()
+    assert response.getheader('Content-Type') == 'application/msgpack'
+    assert MessagePackCodec.decode(response.read()) == json.loads(responses[0][1])
+    body = json.dumps({'message': 'multicast once', 'send_to': ['test_client2']})
+    headers['Idempotency-Key'] = 'multicast-once'
+    statuses = []
+    for _ in range(2):
+        connection.request('POST', '/send', body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        statuses.append(response.status)
+        monkeypatch.setattr(test_server.server.idempotency, 'get', lambda user_id, key: None)
+    connection.close()
+    assert statuses == [201, 422]
+    with Session(db_engine) as session:
+        assert session.query(Message).filter_by(
+            text='sent once',
+            idempotency_key='send-once'
+        ).count() == 1
+    sql_storage = SQLStorage(db_engine)
+    user = sql_storage.get_user_by_name('test_client1')
+    assert sql_storage.idempotency_key_used(user.id, 'send-once')
+    assert not sql_storage.idempotency_key_used(user.id, 'other-key')
+
+
+def test_client_reconnect_resumes_after_last_seen(db_engine, tokens_file):
+    first_server = EmbeddedServer(engine=db_engine).start()
+    port = first_server.port
+    reader = Client(
+        'test_resume_reader',
+        server_port=port,
+        tokens_file=tokens_file,
+        reconnect_backoff=0.05
+    )
+    first_server.stop()
+    with EmbeddedServer(engine=db_engine, port=port):
+        writer = Client('test_resume_writer', server_port=port, tokens_file=tokens_file)
+        texts = [f'missed {number}' for number in range(3)]
+        for text in texts:
+            writer.send_message(message=text)
+        reader.get_status()
+        assert reader.last_status['connected_as'] == 'test_resume_reader'
+        missed = reader.missed_messages[('chat_with', 'public_chat')]
+        assert [message['message_text'] for message in missed] == texts
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request(
+            'POST',
+            '/connect',
+            body=json.dumps({'after_id': missed[0]['id'], 'messages_number': 1}),
+            headers={'Authorization': reader._token}
+        )
+        page = json.loads(connection.getresponse().read())
+        assert page['messages'] == [] and page['next'] == missed[1]['id']
+        connection.request(
+            'POST',
+            '/connect',
+            body=b'{"after_id": -1}',
+            headers={'Authorization': reader._token}
+        )
+        assert connection.getresponse().status == 400
+        connection.close()
+        writer.close_connection()
+        reader.close_connection()
+
+
+def test_room_directory(tmp_path):
+    room_storage = MemoryStorage(data_dir=str(tmp_path))
+    rooms = RoomDirectory(room_storage, message_rate=1, message_burst=1, coalesce_reads=True)
+    public_room = rooms.get('public_chat')
+    games = rooms.create('games')
+    assert rooms.create('games') is None and rooms.get('missing') is None
+    assert [room.chat.name for room in rooms.rooms()] == ['public_chat', 'games']
+    assert rooms.by_chat_id(games.chat.id) is games
+    assert games.coalescer is not public_room.coalescer
+    assert games.rate_limiter.acquire(1) == 0 and games.rate_limiter.acquire(1) > 0
+    assert public_room.rate_limiter.acquire(1) == 0
+    other_process = RoomDirectory(room_storage)
+    other_process.rooms()
+    room_storage.create_public_chat('music')
+    assert other_process.get('music').chat.name == 'music'
+    room_storage.close()
+
+
+def test_rooms_endpoints(client_one, client_two, test_server):
+    room_name = f'room-{time.time()}'
+    client_one.create_room(room_name)
+    assert client_one.response['info'] == 'Room have created!'
+    client_two.create_room(room_name)
+    assert client_two.response['error'] == 'Room with this name already exists'
+    client_two.send_message(room=room_name, message='hello room')
+    assert client_two.response['info'] == 'Message have sent!'
+    assert client_two.last_chat_info['messages'][0]['message_text'] == 'hello room'
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    connection.request('GET', '/rooms', headers={'Authorization': client_one._token})
+    rooms = json.loads(connection.getresponse().read())['rooms']
+    assert {'public_chat', room_name} <= {room['name'] for room in rooms}
+    connection.request(
+        'POST', '/rooms/join', body=b'{"name": "missing room"}',
+        headers={'Authorization': client_one._token}
+    )
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 404
+    body = json.dumps({'name': f'{room_name}-retried'})
+    for target, key, status in [
+        ('/rooms', 'create-once', 201),
+        ('/rooms', 'create-once', 201),
+        ('/rooms/join', 'join-first', 200),
+        ('/rooms/join', 'join-second', 200),
+    ]:
+        headers = {'Authorization': client_one._token, 'Idempotency-Key': f'{key}-{room_name}'}
+        connection.request('POST', target, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == status
+    connection.close()
+
+
+def test_read_coalescer():
+    start = datetime.datetime(2022, 1, 1)
+    messages = [
+        MessageRecord(index, 1, 1, 'author', str(index), start + datetime.timedelta(minutes=index))
+        for index in range(10, 0, -1)
+    ]
+    loads = []
+
+    def load(limit):
+        loads.append(limit)
+        return messages[:limit]
+
+    coalescer = ReadCoalescer(unread_window=3, ttl=60)
+    window = coalescer.window(1, 2, load)
+    assert coalescer.window(1, 2, load) is window and loads == [5]
+    assert window.page(start + datetime.timedelta(minutes=8), 2) == (2, 3)
+    assert window.page(start + datetime.timedelta(minutes=9, seconds=30), 2) == (1, 1)
+    assert window.page(start, 2) is None
+    coalescer.invalidate(2)
+    assert coalescer.window(1, 2, load) is window
+    coalescer.invalidate(1)
+    assert coalescer.window(1, 2, load) is not window and loads == [5, 5]
+    coalescer.invalidate()
+    small = coalescer.window(1, 20, load)
+    assert small.complete and small.page(start, 20) == (10, 10)
+
+
+def test_msgpack_negotiation(test_server):
+    assert negotiate([]) == (JSONCodec, JSONCodec)
+    assert negotiate([(b'accept', b'application/msgpack')]) == (JSONCodec, MessagePackCodec)
+    assert negotiate([
+        (b'content-type', b'application/msgpack; charset=binary'),
+        (b'accept', b'text/html, application/json')
+    ]) == (MessagePackCodec, JSONCodec)
+    assert negotiate([(b'content-type', b'application/x-msgpack')]) == (
+        MessagePackCodec, MessagePackCodec
+    )
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    headers = {'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
+    for body in [MessagePackCodec.encode({'user_name': 'msgpack_client'}), b'\xc1']:
+        connection.request('POST', '/get-token', body=body, headers=headers)
+        response = connection.getresponse()
+        result = MessagePackCodec.decode(response.read())
+        assert response.getheader('Content-Type') == 'application/msgpack'
+        assert ('token' in result) if response.status == 200 else response.status == 400
+    connection.close()
+
+
+def test_admission_control():
+    async def submit_requests() -> tuple[list, list]:
+        served, rejected = [], []
+        assert admission.submit(False, lambda: served.append('status'), rejected.append) == 0
+        assert admission.submit(True, lambda: served.append('history'), rejected.append) == 0
+        assert admission.submit(True, lambda: served.append('search'), rejected.append) == 1
+        assert admission.submit(False, lambda: served.append('send'), rejected.append) == 0
+        await asyncio.sleep(0.01)
+        return served, rejected
+
+    admission = AdmissionController(
+        max_queued=2,
+        max_queued_expensive=1,
+        queue_timeout_expensive=0.0
+    )
+    served, rejected = asyncio.run(submit_requests())
+    assert served == ['status', 'send'] and rejected == [1]
+    assert admission.stats() == {
+        'cheap': {'queued': 0, 'served': 2, 'rejected': 0, 'expired': 0},
+        'expensive': {'queued': 0, 'served': 0, 'rejected': 1, 'expired': 1}
+    }
+
+
+def test_overloaded_expensive_endpoints(db_engine):
+    with EmbeddedServer(engine=db_engine, max_queued_expensive=0) as server:
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        connection.request('POST', '/get-token', body=b'{"user_name": "test_overloaded"}')
+        token = json.loads(connection.getresponse().read())['token']
+        headers = {'Authorization': f'Bearer {token}'}
+        connection.request('POST', '/connect', body=b'{}', headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 503 and response.getheader('Retry-After') == '2'
+        connection.request('GET', '/status', headers=headers)
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())['connected_as'] == 'test_overloaded'
+        connection.close()
+
+
+def test_failed_queued_request(client_one, test_server, monkeypatch):
+    def fail(headers):
+        raise RuntimeError('negotiation failure')
+
+    headers = {'Authorization': client_one._token}
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    for status in (500, 200):
+        if status == 500:
+            monkeypatch.setattr(protocol, 'negotiate', fail)
+        else:
+            monkeypatch.undo()
+        connection.request('GET', '/status', headers=headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == status
+    connection.close()
+    with socket.create_connection(('127.0.0.1', test_server.port), timeout=5) as sock:
+        sock.sendall(b'GET /status HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(65536):
+            pass
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    connection.request('GET', '/status', headers=headers)
+    assert connection.getresponse().status == 200
+    connection.close()
+
+
+def test_export_chat(monkeypatch):
+    monkeypatch.setattr(protocol, 'EXPORT_BATCH_SIZE', 2)
+    with EmbeddedServer() as server:
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        tokens = {}
+        for user_name in ('test_exporter', 'test_export_friend'):
+            connection.request('POST', '/get-token', body=json.dumps({'user_name': user_name}))
+            tokens[user_name] = json.loads(connection.getresponse().read())['token']
+        headers = {'Authorization': f"Bearer {tokens['test_exporter']}"}
+        bodies = [{'message': f'export {number}'} for number in range(5)]
+        bodies.append({'message': 'private export', 'send_to': 'test_export_friend'})
+        for body in bodies:
+            connection.request('POST', '/send', body=json.dumps(body), headers=headers)
+            connection.getresponse().read()
+        connection.request(
+            'POST',
+            '/comment',
+            body=b'{"message_id": 1, "comment": "exported comment"}',
+            headers=headers
+        )
+        connection.getresponse().read()
+        exports = {}
+        room_body = b'{"name": "test_export_friend"}'
+        connection.request('POST', '/rooms', body=room_body, headers=headers)
+        connection.getresponse().read()
+        for query in (
+                'room=public_chat',
+                'user=test_export_friend',
+                'room=unknown_chat',
+                'room=public_chat&user=test_export_friend',
+                ''
+        ):
+            connection.request('GET', f'/export?{query}', headers=headers)
+            response = connection.getresponse()
+            exports[query] = (response, response.read())
+        connection.close()
+    response, body = exports['room=public_chat']
+    assert response.status == 200 and response.getheader('Transfer-Encoding') == 'chunked'
+    lines = [json.loads(line) for line in body.splitlines()]
+    assert [line['message_text'] for line in lines] == [f'export {number}' for number in range(5)]
+    assert lines[0]['comments_number'] == 1
+    assert lines[0]['message_comments'][0]['comment_text'] == 'exported comment'
+    response, body = exports['user=test_export_friend']
+    assert [json.loads(line)['message_text'] for line in body.splitlines()] == ['private export']
+    assert exports['room=unknown_chat'][0].status == 404 and exports[''][0].status == 400
+    assert exports['room=public_chat&user=test_export_friend'][0].status == 400
+
+
+def test_export_cancelled_on_disconnect(monkeypatch):
+    def endless_export(chat_id: int, after_id: int, limit: int) -> list[MessageRecord]:
+        exported.append(after_id)
+        return [MessageRecord(
+            id=after_id + 1,
+            chat_id=chat_id,
+            author_id=1,
+            author_name='test_endless_exporter',
+            text='endless export',
+            pub_date=datetime.datetime.utcnow()
+        )]
+
+    exported = []
+    monkeypatch.setattr(protocol, 'EXPORT_BATCH_SIZE', 1)
+    with EmbeddedServer() as server:
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        connection.request('POST', '/get-token', body=b'{"user_name": "test_endless_exporter"}')
+        token = json.loads(connection.getresponse().read())['token']
+        connection.close()
+        monkeypatch.setattr(server.server.storage, 'export_messages', endless_export)
+        with socket.create_connection(('127.0.0.1', server.port), timeout=5) as sock:
+            sock.sendall(
+                b'GET /export?room=public_chat HTTP/1.1\r\nHost: localhost\r\n'
+                b'Authorization: Bearer ' + token.encode('ascii') + b'\r\n\r\n'
+            )
+            received = b''
+            while b'endless export' not in received:
+                received += sock.recv(65536)
+            sock.shutdown(socket.SHUT_WR)
+            time.sleep(0.2)
+            exported_number = len(exported)
+            time.sleep(0.2)
+            assert len(exported) == exported_number
+
+
+def test_export_waits_for_transport():
+    async def schedule_paused_export() -> tuple[bool, bool]:
+        export_protocol = HTTPProtocol()
+        export_protocol._export = (1, 0)
+        export_protocol.pause_writing()
+        export_protocol._schedule_export()
+        paused = export_protocol._export_scheduled
+        export_protocol.resume_writing()
+        resumed = export_protocol._export_scheduled
+        export_protocol._export = None
+        await asyncio.sleep(0)
+        return paused, resumed
+
+    assert asyncio.run(schedule_paused_export()) == (False, True)
+
+
+def test_router():
+    assert router.split_target(b'/status?verbose=1') == (b'/status', b'verbose=1')
+    route, error_code = router.resolve(b'GET', b'/status')
+    assert route.path == b'/status' and route.auth and error_code is None
+    assert not router.resolve(b'POST', b'/get-token')[0].auth
+    assert router.resolve(b'DELETE', b'/send') == (None, 405)
+    assert router.resolve(b'GET', b'/unknown') == (None, 404)
+    rate_limiter = RateLimiter(rate=1, burst=2)
+    assert not rate_limiter.acquire('client') and not rate_limiter.acquire('client')
+    assert 0 < rate_limiter.acquire('client') <= 1
+    assert not rate_limiter.acquire('other_client')
+
+
+def test_routing_errors(test_server):
+    connection = http.client.HTTPConnection('127.0.0.1', test_server.port, timeout=5)
+    for method, target, body, status in [
+        ('GET', '/unknown', None, 404),
+        ('DELETE', '/send', None, 405),
+        ('POST', '/get-token', b'{not json', 400),
+        ('POST', '/get-token', b'[]', 400),
+        ('GET', '/status?verbose=1', None, 401),
+    ]:
+        connection.request(method, target, body=body)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == status
+        if status == 405:
+            assert response.getheader('Allow') == 'POST'
+    connection.close()
+
+
+def test_moderation_scheduler(tmp_path):
+    moderation_storage = MemoryStorage(data_dir=str(tmp_path))
+    scheduler = ModerationScheduler(moderation_storage, rate_window=datetime.timedelta(minutes=60))
+    user = moderation_storage.create_user('moderated_user')
+    public_chat = moderation_storage.get_public_chat()
+    now = datetime.datetime.utcnow()
+    member = moderation_storage.join_chat(public_chat.id, user.id)
+    member.cautions, member.banned = 2, True
+    member.banned_till = now + datetime.timedelta(hours=4)
+    moderation_storage.save_member(member)
+    user.messages_in_hour_in_public_chat = 20
+    user.start_chatting_in_public_chat = now
+    moderation_storage.save_user(user)
+
+    assert scheduler.run_due(now) == {}
+    assert scheduler.run_due(now + datetime.timedelta(minutes=61)) == {RATE_WINDOW: 1}
+    assert moderation_storage.get_user_by_name('moderated_user').messages_in_hour_in_public_chat == 0
+    assert moderation_storage.get_member(public_chat.id, user.id).banned
+    assert scheduler.run_due(now + datetime.timedelta(hours=5)) == {BAN_EXPIRY: 1}
+    member = moderation_storage.get_member(public_chat.id, user.id)
+    assert not member.banned and member.cautions == 0
+    assert moderation_storage.next_ban_expiry() is None
+    moderation_storage.close()
+
+
+def test_provision_users(sql_engine, tmp_path):
+    users_file = tmp_path / 'users.csv'
+    users_file.write_text('user_name\nbulk_1\nbulk_2\nbulk_3\nbulk_1\nbulk 6\n')
+    provisioning_storage = SQLStorage(sql_engine)
+    provisioning_storage.create_user('bulk_2')
+    tokens_file = str(tmp_path / 'client.txt')
+
+    users = provision_users(provisioning_storage, read_user_names(str(users_file)), chunk_size=2)
+    assert write_tokens(users, tokens_file) == 2
+    with open(tokens_file) as file:
+        issued = dict(line.split() for line in file)
+    assert sorted(issued) == ['bulk_1', 'bulk_3']
+    user = provisioning_storage.get_user_by_token(issued['bulk_3'])
+    assert user.user_name == 'bulk_3'
+    public_chat = provisioning_storage.get_public_chat()
+    assert provisioning_storage.get_member(public_chat.id, user.id) is None
+    assert provisioning_storage.join_chat(public_chat.id, user.id).unread_count == 0
+
+    jsonl_file = tmp_path / 'users.jsonl'
+    jsonl_file.write_text('{"user_name": "bulk_4"}\n\n{"user_name": "bulk_5"}\n')
+    assert list(read_user_names(str(jsonl_file))) == ['bulk_4', 'bulk_5']
+
+
+def test_user_names_with_whitespace(db_engine):
+    with EmbeddedServer(engine=db_engine, admin_token='test_admin_token') as server:
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        for target, body, headers in [
+            ('/admin/users', {'user_names': ['test_bulk_ok', 'test bulk']}, {
+                'Authorization': 'Bearer test_admin_token'
+            }),
+            ('/get-token', {'user_name': 'test spaced'}, {}),
+        ]:
+            connection.request('POST', target, body=json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 400
+        connection.close()
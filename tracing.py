@@ -0,0 +1,156 @@
+import contextlib
+import contextvars
+import cProfile
+import os
+import random
+import re
+import time
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from utils import get_logger_for_module
+
+
+logger = get_logger_for_module(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class RequestTrace:
+    """Queries issued and time spent while serving one request."""
+
+    def __init__(self, method: str, target: str) -> None:
+        self.method = method
+        self.target = target
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.query_count = 0
+        self.query_time = 0.0
+        self.queries = {}
+        self.stages = {}
+        self.profiler = None
+
+    def add_query(self, statement: str, duration: float) -> None:
+        self.query_count += 1
+        self.query_time += duration
+        stats = self.queries.setdefault(statement, [0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+
+    def add_stage(self, name: str, duration: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+
+
+def record_stage(name: str, duration: float) -> None:
+    """
+    Add time spent in a request processing stage to the current trace.
+    """
+    if trace := _current_trace.get():
+        trace.add_stage(name, duration)
+
+
+class RequestTracer:
+    """
+    Per-request SQL tracing and slow request profiler.
+    Counts queries of the instrumented engines per request and logs
+    only requests slower than the threshold, with their query breakdown.
+    """
+
+    def __init__(
+            self,
+            slow_request_ms: float = 200.0,
+            profile_sample_rate: float = 0.0,
+            profile_dir: str = 'profiles',
+            top_queries: int = 10
+    ) -> None:
+        """
+        :param slow_request_ms: latency threshold for logging a request;
+        :param profile_sample_rate: share of requests run under cProfile (0..1);
+        :param profile_dir: directory for dumped cProfile stats;
+        :param top_queries: number of statements in the slow request breakdown.
+        """
+        self.slow_request_ms = slow_request_ms
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self.top_queries = top_queries
+
+    def instrument(self, engine: Engine) -> None:
+        if event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            return
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        duration = time.perf_counter() - conn.info['query_start_time'].pop()
+        if trace := _current_trace.get():
+            trace.add_query(statement, duration)
+
+    @contextlib.contextmanager
+    def trace(self, method: str, target: str) -> Iterator[RequestTrace]:
+        """
+        Trace everything executed inside the block as one request.
+        """
+        request_trace = RequestTrace(method, target)
+        token = _current_trace.set(request_trace)
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            request_trace.profiler = self._start_profiler()
+        try:
+            yield request_trace
+        finally:
+            _current_trace.reset(token)
+            request_trace.duration = time.perf_counter() - request_trace.started
+            if request_trace.profiler:
+                request_trace.profiler.disable()
+                self._dump_profile(request_trace)
+            if request_trace.duration * 1000 >= self.slow_request_ms:
+                self._log_slow_request(request_trace)
+
+    @staticmethod
+    def _start_profiler() -> Optional[cProfile.Profile]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            logger.warning('Can not profile request, another profiler is active.')
+            return
+        return profiler
+
+    def _dump_profile(self, request_trace: RequestTrace) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        target = request_trace.target.strip('/').replace('/', '_') or 'root'
+        file_name = os.path.join(
+            self.profile_dir,
+            f'{time.time_ns()}-{request_trace.method}-{target}.prof'
+        )
+        request_trace.profiler.dump_stats(file_name)
+        logger.info('Profile of %s %s saved to %s', request_trace.method, request_trace.target, file_name)
+
+    def _log_slow_request(self, request_trace: RequestTrace) -> None:
+        lines = [
+            f'Slow request {request_trace.method} {request_trace.target}: '
+            f'{request_trace.duration * 1000:.1f} ms, '
+            f'{request_trace.query_count} queries in {request_trace.query_time * 1000:.1f} ms'
+        ]
+        if request_trace.stages:
+            lines.append('    stages: ' + ', '.join(
+                f'{name} {duration * 1000:.1f} ms'
+                for name, duration in request_trace.stages.items()
+            ))
+        queries = sorted(
+            request_trace.queries.items(),
+            key=lambda item: item[1][1],
+            reverse=True
+        )
+        for statement, (count, duration) in queries[:self.top_queries]:
+            statement = _WHITESPACE.sub(' ', statement).strip()
+            lines.append(f'    {count}x {duration * 1000:.1f} ms: {statement[:200]}')
+        logger.warning('\n'.join(lines))
@@ -1,11 +1,116 @@
+import atexit
 import logging.config
+import logging.handlers
+import os
+import queue
+import random
+from typing import Optional
 
 import yaml
 
 
-def get_logger_for_module(name: str) -> logging.Logger:
-    with open('logging_config.yaml', 'r') as f:
+LOGGING_CONFIG_FILE = 'logging_config.yaml'
+
+_listeners = []
+_config_file = None
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only a share of records at or below the given level.
+    Records of higher levels are always passed.
+    """
+
+    def __init__(
+            self,
+            rate: float = 1.0,
+            level: str = 'INFO',
+            messages: Optional[list[str]] = None
+    ) -> None:
+        """
+        :param rate: share of records passed (0..1);
+        :param level: records above this level are never sampled;
+        :param messages: sample only records with these message templates, all if omitted.
+        """
+        super().__init__()
+        self.rate = rate
+        self.level = logging.getLevelName(level)
+        self.messages = set(messages) if messages else None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+        if self.messages is not None and record.msg not in self.messages:
+            return True
+        return random.random() < self.rate
+
+
+def _move_handlers_to_background() -> None:
+    """
+    Replace handlers of configured loggers with queue handlers,
+    original handlers format and write records on listener threads.
+    """
+    queue_handlers = {}
+    manager = logging.Logger.manager
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        handlers = tuple(logger.handlers)
+        key = tuple(id(handler) for handler in handlers)
+        if key not in queue_handlers:
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(
+                log_queue,
+                *handlers,
+                respect_handler_level=True
+            )
+            listener.start()
+            _listeners.append(listener)
+            queue_handlers[key] = logging.handlers.QueueHandler(log_queue)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handlers[key])
+
+
+def setup_logging(config_file: str = LOGGING_CONFIG_FILE) -> None:
+    """
+    Configure logging once per process.
+    """
+    global _config_file
+    if _config_file:
+        return
+    with open(config_file, 'r') as f:
         config = yaml.safe_load(f.read())
-        logging.config.dictConfig(config)
+    logging.config.dictConfig(config)
+    _move_handlers_to_background()
+    _config_file = config_file
+
+
+def stop_logging() -> None:
+    """
+    Write out queued records and stop listener threads.
+    """
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def _restart_logging_after_fork() -> None:
+    global _config_file
+    config_file, _config_file = _config_file, None
+    _listeners.clear()
+    if config_file:
+        setup_logging(config_file)
 
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_logging_after_fork)
+
+
+def get_logger_for_module(name: str) -> logging.Logger:
+    setup_logging()
     return logging.getLogger(name)